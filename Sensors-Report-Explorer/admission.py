@@ -0,0 +1,369 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from flask import request, session, g, jsonify
+
+import metrics
+from keycloak_auth import get_keycloak_auth
+from token_manager import get_token_manager
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true').lower() in ('true', 't', '1', 'yes')
+# Routes under these prefixes are admission-controlled (the ones that hit Orion-LD, QuantumLeap
+# and the data-product manager); notifications, auth, SSE and static files are not
+ADMISSION_PATH_PREFIXES = tuple(
+    prefix.strip() for prefix in os.environ.get('ADMISSION_PATH_PREFIXES', '/api/ngsi-ld/,/api/quantum/,/api/dataProducts').split(',')
+    if prefix.strip())
+# Default limits (per worker): sustained requests/s, burst size and concurrent requests.
+# Keep the tenant concurrency below UPSTREAM_MAX_CONCURRENCY so other tenants always find a free slot.
+ADMISSION_TENANT_RATE = float(os.environ.get('ADMISSION_TENANT_RATE', '50'))
+ADMISSION_TENANT_BURST = float(os.environ.get('ADMISSION_TENANT_BURST', '100'))
+ADMISSION_TENANT_CONCURRENCY = int(os.environ.get('ADMISSION_TENANT_CONCURRENCY', '6'))
+ADMISSION_USER_RATE = float(os.environ.get('ADMISSION_USER_RATE', '20'))
+ADMISSION_USER_BURST = float(os.environ.get('ADMISSION_USER_BURST', '40'))
+ADMISSION_USER_CONCURRENCY = int(os.environ.get('ADMISSION_USER_CONCURRENCY', '4'))
+# How long a request over a concurrency limit waits for a slot before it is rejected, and how
+# many requests per tenant/user may wait at a time (the rest are rejected at once)
+ADMISSION_WAIT_SECONDS = float(os.environ.get('ADMISSION_WAIT_SECONDS', '1'))
+ADMISSION_MAX_WAITING = int(os.environ.get('ADMISSION_MAX_WAITING', '2'))
+# Tokens taken by expensive routes: "/api/ngsi-ld/v1/export/entities=20,/api/quantum/v2/history=5"
+ADMISSION_ROUTE_COSTS = os.environ.get(
+    'ADMISSION_ROUTE_COSTS', '/api/ngsi-ld/v1/export/entities=20,/api/quantum/v2/history=5')
+# JSON file with limits that override the above; re-read when it changes, so limits can be
+# updated live (e.g. from a mounted ConfigMap) without a restart
+ADMISSION_LIMITS_FILE = os.environ.get('ADMISSION_LIMITS_FILE', '')
+ADMISSION_RELOAD_SECONDS = float(os.environ.get('ADMISSION_RELOAD_SECONDS', '5'))
+
+# Tenants known besides those in the limits file. Requests without a valid token only get the bucket
+# of a known tenant, and metrics name only known tenants; everything else counts as "other"
+ADMISSION_KNOWN_TENANTS = {
+    tenant.strip().lower() for tenant in os.environ.get('ADMISSION_KNOWN_TENANTS', '').split(',') if tenant.strip()}
+# Token claims naming the caller's tenant(s), in order of precedence (as read by the frontend)
+ADMISSION_TENANT_CLAIMS = tuple(
+    claim.strip() for claim in os.environ.get('ADMISSION_TENANT_CLAIMS', 'TenantId,tenant_id,tenantId,Tenant,tenant').split(',')
+    if claim.strip())
+
+# Tenant headers in order of precedence; tenants the broker treats as its default share one bucket
+TENANT_HEADERS = ('NGSILD-Tenant', 'Fiware-Service')
+DEFAULT_TENANTS = ('', 'synchro', 'default')
+OTHER_TENANT = 'other'
+
+metrics.registry.describe('explorer_admission_rejected_total', 'counter', 'Requests rejected by admission control')
+
+
+def parse_costs(value):
+    return {
+        route.strip(): float(cost)
+        for route, _, cost in (item.partition('=') for item in (value or '').split(','))
+        if route.strip() and cost
+    }
+
+
+class Limit:
+    """Rate (tokens/s), burst (bucket size) and concurrency of one tenant or user"""
+
+    __slots__ = ('rate', 'burst', 'concurrency')
+
+    def __init__(self, rate, burst, concurrency):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.concurrency = int(concurrency)
+
+    def updated(self, settings):
+        """Return a copy with the given keys of a limits-file entry applied"""
+        return Limit(settings.get('rate', self.rate), settings.get('burst', self.burst),
+                     settings.get('concurrency', self.concurrency))
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'updated', 'in_flight', 'waiting')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.in_flight = 0
+        self.waiting = 0
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, scope, reason, retry_after):
+        super().__init__(f"{scope} {reason} limit exceeded")
+        self.scope = scope
+        self.reason = reason
+        self.retry_after = max(int(math.ceil(retry_after)), 1)
+
+
+class AdmissionController:
+    """
+    Token-bucket rate limits plus concurrency limits, keyed by tenant and by user.
+    A request is admitted only when both its tenant and its user have a token and a free
+    concurrency slot, so one tenant's export cannot starve the others of worker threads.
+    """
+
+    def __init__(self, limits_file=ADMISSION_LIMITS_FILE):
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._buckets = {}
+        self.limits_file = limits_file
+        self._limits_mtime = None
+        self._checked_at = None
+        self.tenant_limit = Limit(ADMISSION_TENANT_RATE, ADMISSION_TENANT_BURST, ADMISSION_TENANT_CONCURRENCY)
+        self.user_limit = Limit(ADMISSION_USER_RATE, ADMISSION_USER_BURST, ADMISSION_USER_CONCURRENCY)
+        self.tenant_limits = {}
+        self.route_costs = parse_costs(ADMISSION_ROUTE_COSTS)
+        self._defaults = (self.tenant_limit, self.user_limit, dict(self.route_costs))
+        self.admitted = 0
+        self.waited = 0
+        self.rejected = 0
+        self.reloads = 0
+        self.reload_checks()
+
+    def limit_for(self, scope, key):
+        if scope == 'tenant':
+            return self.tenant_limits.get(key, self.tenant_limit)
+        return self.user_limit
+
+    def tenant_label(self, tenant):
+        """The tenant itself when it is known (default, limits file or ADMISSION_KNOWN_TENANTS), else 'other'"""
+        if tenant == 'default' or tenant in self.tenant_limits or tenant in ADMISSION_KNOWN_TENANTS:
+            return tenant
+        return OTHER_TENANT
+
+    def reload_checks(self):
+        """Re-read the limits file when it changed and drop idle buckets; cheap enough to call per request"""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < ADMISSION_RELOAD_SECONDS:
+            return
+        self._checked_at = now
+        if self.limits_file:
+            try:
+                mtime = os.stat(self.limits_file).st_mtime
+                if mtime != self._limits_mtime:
+                    with open(self.limits_file) as f:
+                        self.apply(json.load(f))
+                    self._limits_mtime = mtime
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"Could not load admission limits from {self.limits_file}: {str(e)}")
+        self._sweep()
+
+    def apply(self, config):
+        """
+        Apply a limits document, replacing earlier ones:
+        {"tenant": {...}, "user": {...}, "tenants": {"<tenant>": {...}}, "route_costs": {"<route>": 10}}
+        where each {...} may set rate, burst and concurrency.
+        """
+        tenant_default, user_default, route_costs = self._defaults
+        tenant_limit = tenant_default.updated(config.get('tenant', {}))
+        user_limit = user_default.updated(config.get('user', {}))
+        tenant_limits = {
+            str(tenant).lower(): tenant_limit.updated(settings)
+            for tenant, settings in config.get('tenants', {}).items()
+        }
+        costs = dict(route_costs)
+        costs.update({route: float(cost) for route, cost in config.get('route_costs', {}).items()})
+        self.tenant_limit, self.user_limit, self.tenant_limits, self.route_costs = tenant_limit, user_limit, tenant_limits, costs
+        self.reloads += 1
+        logger.info("Admission limits loaded: tenant %s/s, user %s/s, %s tenant override(s)",
+                    tenant_limit.rate, user_limit.rate, len(tenant_limits))
+
+    def _sweep(self):
+        # A full, idle bucket is the same as no bucket
+        now = time.monotonic()
+        with self._lock:
+            idle = []
+            for key, bucket in self._buckets.items():
+                limit = self.limit_for(*key)
+                if bucket.in_flight == 0 and bucket.waiting == 0 and bucket.tokens + (now - bucket.updated) * limit.rate >= limit.burst:
+                    idle.append(key)
+            for key in idle:
+                del self._buckets[key]
+
+    def acquire(self, keys, cost=1):
+        """
+        Take cost tokens and a concurrency slot for every (scope, key) or none of them.
+        A request over a rate limit is rejected at once; one over a concurrency limit waits up
+        to ADMISSION_WAIT_SECONDS for a slot, unless ADMISSION_MAX_WAITING requests are already
+        waiting for it. Raises AdmissionRejected naming the limit hit.
+        """
+        deadline = time.monotonic() + ADMISSION_WAIT_SECONDS
+        waiting_on = None
+        with self._slot_freed:
+            try:
+                while True:
+                    now = time.monotonic()
+                    buckets = []
+                    busy = None
+                    for scope, key in keys:
+                        limit = self.limit_for(scope, key)
+                        bucket = self._buckets.get((scope, key))
+                        if bucket is None:
+                            bucket = self._buckets[(scope, key)] = _Bucket(limit.burst, now)
+                        bucket.tokens = min(limit.burst, bucket.tokens + (now - bucket.updated) * limit.rate)
+                        bucket.updated = now
+                        if bucket.tokens < min(cost, limit.burst):
+                            self.rejected += 1
+                            retry_after = (min(cost, limit.burst) - bucket.tokens) / limit.rate if limit.rate > 0 else 60
+                            raise AdmissionRejected(scope, 'rate', retry_after)
+                        if bucket.in_flight >= limit.concurrency:
+                            busy = (scope, bucket)
+                            break
+                        buckets.append(bucket)
+
+                    if busy is None:
+                        for bucket in buckets:
+                            bucket.tokens -= cost
+                            bucket.in_flight += 1
+                        self.admitted += 1
+                        return buckets
+
+                    # Waiting requests hold a server thread too, so only a few may queue per key
+                    scope, bucket = busy
+                    if waiting_on is not bucket:
+                        if waiting_on is not None:
+                            waiting_on.waiting -= 1
+                            waiting_on = None
+                        if bucket.waiting >= ADMISSION_MAX_WAITING:
+                            now = deadline
+                        else:
+                            bucket.waiting += 1
+                            waiting_on = bucket
+                            self.waited += 1
+                    if now >= deadline:
+                        self.rejected += 1
+                        raise AdmissionRejected(scope, 'concurrency', 1)
+                    self._slot_freed.wait(deadline - now)
+            finally:
+                if waiting_on is not None:
+                    waiting_on.waiting -= 1
+
+    def release(self, buckets):
+        with self._slot_freed:
+            for bucket in buckets:
+                bucket.in_flight -= 1
+            self._slot_freed.notify_all()
+
+    def stats(self):
+        with self._lock:
+            in_flight = sum(bucket.in_flight for (scope, _), bucket in self._buckets.items() if scope == 'tenant')
+            tracked = len(self._buckets)
+        return {
+            'admitted': self.admitted,
+            'waited': self.waited,
+            'rejected': self.rejected,
+            'in_flight': in_flight,
+            'tracked_keys': tracked,
+            'limit_reloads': self.reloads
+        }
+
+
+admission_controller = AdmissionController()
+
+
+def normalize_tenant(value):
+    value = value.strip().lower()
+    return 'default' if value in DEFAULT_TENANTS else value
+
+
+def token_tenants():
+    """The tenants named in the request's validated token ([] without a tenant claim), or None without a valid token"""
+    token = get_token_manager().current_access_token()
+    if not token:
+        scheme, _, token = (request.headers.get('Authorization') or '').partition(' ')
+        if scheme.lower() != 'bearer':
+            token = None
+    if not token:
+        return None
+    try:
+        claims = get_keycloak_auth().validate_token(token)
+    except Exception:
+        return None
+    if not claims.get('active'):
+        return None
+    for claim in ADMISSION_TENANT_CLAIMS:
+        value = claims.get(claim)
+        if value:
+            return [normalize_tenant(str(tenant)) for tenant in (value if isinstance(value, list) else [value])
+                    if str(tenant).strip()]
+    return []
+
+
+def request_tenant():
+    """
+    The tenant whose limits apply. With a validated token naming tenants, the requested tenant
+    if the token names it, else the token's first tenant, so headers cannot pick another
+    tenant's bucket. Otherwise the requested tenant if it is known, else "other".
+    """
+    requested = 'default'
+    for name in TENANT_HEADERS:
+        value = request.headers.get(name)
+        if value:
+            requested = normalize_tenant(value)
+            break
+    tenants = token_tenants()
+    if tenants:
+        return requested if requested in tenants else tenants[0]
+    return admission_controller.tenant_label(requested)
+
+
+def request_user():
+    """The session id of logged-in users, else a digest of the bearer token, else the client address"""
+    sid = session.get('sid')
+    if sid:
+        return f"session:{sid}"
+    authorization = request.headers.get('Authorization')
+    if authorization:
+        return 'token:' + hashlib.sha1(authorization.encode('utf-8')).hexdigest()[:16]
+    return f"address:{request.remote_addr}"
+
+
+def _before_request():
+    if request.method == 'OPTIONS' or not request.path.startswith(ADMISSION_PATH_PREFIXES):
+        return None
+    admission_controller.reload_checks()
+    tenant = request_tenant()
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    cost = admission_controller.route_costs.get(route, 1)
+    try:
+        g.admission_buckets = admission_controller.acquire((('tenant', tenant), ('user', request_user())), cost)
+    except AdmissionRejected as e:
+        metrics.registry.inc('explorer_admission_rejected_total',
+                             (('tenant', admission_controller.tenant_label(tenant)), ('scope', e.scope), ('reason', e.reason)))
+        logger.debug("Rejected %s %s for tenant %s: %s", request.method, request.path, tenant, e)
+        response = jsonify({'error': str(e), 'tenant': tenant})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    return None
+
+
+def _after_request(response):
+    # Streamed responses (exports) keep their slot until the body has been sent
+    if response.is_streamed:
+        buckets = g.pop('admission_buckets', None)
+        if buckets:
+            response.call_on_close(lambda: admission_controller.release(buckets))
+    return response
+
+
+def _teardown_request(error):
+    buckets = g.pop('admission_buckets', None)
+    if buckets:
+        admission_controller.release(buckets)
+
+
+def init_app(app):
+    """Apply per-tenant and per-user admission control to the broker-facing API routes"""
+    if not ADMISSION_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -1,6 +1,6 @@
 import os
 import requests
-from flask import Flask, request, redirect, jsonify, session, make_response, send_from_directory, Response, g
+from flask import Flask, request, redirect, jsonify, session, make_response, Response, g
 from flask_cors import CORS
 from urllib.parse import urlencode
 import logging
@@ -9,17 +9,32 @@ import base64
 import uuid
 import time
 import sys
-from queue import Queue
+import threading
+from queue import Empty
 import secrets
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from keycloak_auth import KeycloakAuth
+import log_config
+# Queue-based logging, configured before the modules below log at import time
+log_config.configure_logging()
+
+from keycloak_auth import get_keycloak_auth, auth_blueprint
+from token_manager import get_token_manager
+from session_store import get_session_store, ServerSideSessionInterface
+import admission
+import compression
+import metrics
+import resilience
+from subscription_manager import subscription_manager, relay
+import tracing
+import upstream
+from context_cache import context_blueprint, context_cache
 
 # =====================
 # Global Configuration
 # =====================
 
 # Environment variables (with defaults)
-LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG').upper()
+LOG_LEVEL = log_config.LOG_LEVEL
 SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key')  # Change in production
 CORS_ORIGINS = os.environ.get('CORS_ORIGINS', '*')
 QUANTUM_LEAP_URL = os.environ.get('QUANTUM_LEAP_URL', 'http://162.244.27.122:8668')
@@ -29,6 +44,17 @@ SECURE_COOKIES = os.environ.get('SECURE_COOKIES', 'false').lower() in ('true', '
 HOST = os.environ.get('HOST', '0.0.0.0')
 PORT = int(os.environ.get('PORT', '5000'))
 DEBUG_MODE = os.environ.get('DEBUG', 'true').lower() in ('true', 't', '1', 'yes')
+# Notification micro-batching: coalesce notifications for up to the window (ms) or max items per SSE frame
+NOTIFICATION_BATCH_WINDOW_MS = int(os.environ.get('NOTIFICATION_BATCH_WINDOW_MS', '50'))
+NOTIFICATION_BATCH_MAX_ITEMS = int(os.environ.get('NOTIFICATION_BATCH_MAX_ITEMS', '100'))
+# Idle SSE streams get a comment frame this often, so disconnected clients are noticed and released
+NOTIFICATION_KEEPALIVE_SECONDS = int(os.environ.get('NOTIFICATION_KEEPALIVE_SECONDS', '15'))
+# Concurrent SSE streams per worker. Each stream holds a worker thread for its lifetime, so this stays
+# below WEB_THREADS (half of them by default) to leave threads for API requests; streams over it get 503
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', str(max(int(os.environ.get('WEB_THREADS', '16')) // 2, 1))))
+SSE_RETRY_AFTER_SECONDS = int(os.environ.get('SSE_RETRY_AFTER_SECONDS', '10'))
+sse_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+metrics.registry.describe('explorer_sse_rejected_total', 'counter', 'SSE streams refused because the worker had SSE_MAX_STREAMS open')
 # Quantum Lead configuration from environment variables
 # QUANTUM_LEAP_CONFIG = {
 #     'base_url': os.environ.get('QUANTUM_LEAP_URL', 'http://quantumleap:8668')
@@ -38,16 +64,28 @@ DEBUG_MODE = os.environ.get('DEBUG', 'true').lower() in ('true', 't', '1', 'yes'
 JWT_SECRET = os.environ.get('JWT_SECRET', 'default-secret')
 AUTH_API_URL = os.environ.get('AUTH_API_URL', 'http://localhost:5000')
 
-# Set up logging based on environment variable
-log_level_name = LOG_LEVEL
-log_level = getattr(logging, log_level_name, logging.DEBUG)
-logging.basicConfig(level=log_level)
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app with secret key from environment
 app = Flask(__name__, static_folder='.')
 app.secret_key = SECRET_KEY  # Change in production
 
+# Keep session data server-side; the cookie only carries the session id
+app.session_interface = ServerSideSessionInterface(get_session_store())
+app.config['SESSION_COOKIE_SECURE'] = SECURE_COOKIES
+
+# Request/upstream metrics on /metrics (registered first so sizes are measured after compression)
+metrics.init_app(app)
+# Optional W3C traceparent propagation and span export
+tracing.init_app(app)
+# Per-route sampling of DEBUG/INFO records (LOG_SAMPLE_RATES)
+log_config.init_app(app)
+# Per-tenant and per-user rate and concurrency limits on the broker-facing routes (429 + Retry-After)
+admission.init_app(app)
+
+# Negotiated gzip/brotli/zstd compression of large JSON responses
+compression.init_app(app)
+
 # Parse allowed origins for CORS
 cors_origins = CORS_ORIGINS
 if cors_origins != '*':
@@ -57,7 +95,7 @@ if cors_origins != '*':
 CORS(app, 
      resources={r"/*": {"origins": cors_origins}},
      supports_credentials=True,
-     allow_headers=["Content-Type", "Authorization", "NGSILD-Tenant"],
+     allow_headers=["Content-Type", "Authorization", "NGSILD-Tenant", "traceparent"],
      methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"])
 
 # Frontend URL detection
@@ -85,22 +123,82 @@ def get_frontend_url():
 
 
 
-# Queue to store notifications
-notification_queue = Queue()
-
 # Serve static files (for development)
 @app.route('/', defaults={'path': 'index.html'})
 @app.route('/<path:path>')
 def serve_static(path):
     return app.send_static_file(path)
 
-@app.route('/api/schemas/<path:filename>')
-def serve_schema(filename):
-    """Serve JSON schema files from the js/schemas directory"""
-    return send_from_directory('js/schemas', filename)
 
 
 
+def enqueue_notification(notification):
+    """Log an Orion-LD notification and fan it out to the SSE clients of every worker"""
+    if not notification or not notification.get('data'):
+        return False
+
+    for entity in notification['data']:
+        entity_id = entity.get('id')
+        entity_type = entity.get('type')
+        logger.info("Entity Update - ID: %s, Type: %s", entity_id, entity_type)
+
+        # Log changed attributes (serialising values is only worth it when DEBUG is on)
+        if logger.isEnabledFor(logging.DEBUG):
+            for attr_name, attr_value in entity.items():
+                if attr_name not in ['id', 'type']:
+                    logger.debug("  Changed attribute: %s = %s", attr_name, json.dumps(attr_value))
+
+    # Queue the notification for this worker's SSE clients and relay it to the other workers
+    subscription_manager.dispatch(notification)
+    relay.publish(notification)
+    return True
+
+def next_notification_batch(notification_queue):
+    """
+    Wait up to NOTIFICATION_KEEPALIVE_SECONDS for a notification on an SSE client's queue
+    (returning an empty batch if none arrives), then keep draining it until the batch
+    window elapses or the batch holds NOTIFICATION_BATCH_MAX_ITEMS entities
+    """
+    try:
+        notifications = [notification_queue.get(timeout=NOTIFICATION_KEEPALIVE_SECONDS)]
+    except Empty:
+        return []
+    item_count = len(notifications[0].get('data', []))
+    deadline = time.monotonic() + NOTIFICATION_BATCH_WINDOW_MS / 1000.0
+    while item_count < NOTIFICATION_BATCH_MAX_ITEMS:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            notification = notification_queue.get(timeout=remaining)
+        except Empty:
+            break
+        notifications.append(notification)
+        item_count += len(notification.get('data', []))
+    return notifications
+
+def format_notification_batch(notifications):
+    """
+    Coalesce a list of notifications into one compact SSE frame. Updates to the same
+    entity are merged so the UI can apply the whole batch in a single render pass.
+    """
+    entities = {}
+    for notification in notifications:
+        for entity in notification.get('data', []):
+            entity_key = entity.get('id') or id(entity)
+            if entity_key in entities:
+                entities[entity_key].update(entity)
+            else:
+                entities[entity_key] = dict(entity)
+
+    frame = {
+        'type': 'NotificationBatch',
+        'notifications': len(notifications),
+        'subscriptionIds': sorted({n['subscriptionId'] for n in notifications if n.get('subscriptionId')}),
+        'data': list(entities.values())
+    }
+    return f"data: {json.dumps(frame, separators=(',', ':'))}\n\n"
+
 @app.route('/api/notifications', methods=['POST'])
 def receive_notification():
     """
@@ -109,29 +207,20 @@ def receive_notification():
     try:
         # Log the full notification
         logger.info("Received notification from Orion-LD")
-        logger.debug("Notification headers:")
-        for header, value in request.headers.items():
-            logger.debug(f"  {header}: {value}")
-        
         # Get the notification data
         notification = request.json
-        logger.debug("Notification body:")
-        logger.debug(json.dumps(notification, indent=2))
-
-        # Extract and log specific notification details
-        if notification.get('data'):
-            for entity in notification['data']:
-                entity_id = entity.get('id')
-                entity_type = entity.get('type')
-                logger.info(f"Entity Update - ID: {entity_id}, Type: {entity_type}")
-                
-                # Log changed attributes
-                for attr_name, attr_value in entity.items():
-                    if attr_name not in ['id', 'type']:
-                        logger.info(f"  Changed attribute: {attr_name} = {json.dumps(attr_value)}")
-            
-            # Add notification to queue for SSE clients
-            notification_queue.put(notification)
+        # Dumping headers and body is only worth it when DEBUG is on (headers are redacted by log_config)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Notification headers: %s", dict(request.headers))
+            logger.debug("Notification body: %s", json.dumps(notification, indent=2))
+
+        # The route is public: only Orion-LD knows the secret of the shared subscriptions
+        if not subscription_manager.authentic(notification, request.headers):
+            logger.warning("Refused a notification for %s without the shared subscription secret",
+                           notification.get('subscriptionId'))
+            return jsonify({'status': 'error', 'message': 'Notification secret missing or wrong'}), 401
+
+        enqueue_notification(notification)
 
         return jsonify({'status': 'success', 'message': 'Notification received and logged'}), 200
     
@@ -139,24 +228,88 @@ def receive_notification():
         logger.error(f"Error processing notification: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/api/notifications/batch', methods=['POST'])
+def receive_notification_batch():
+    """
+    Receive several Orion-LD notifications in one request, either as a JSON array
+    or as an object with a 'notifications' array
+    """
+    try:
+        payload = request.get_json(force=True)
+        notifications = payload.get('notifications') if isinstance(payload, dict) else payload
+        if not isinstance(notifications, list):
+            return jsonify({'status': 'error', 'message': 'Expected a list of notifications'}), 400
+
+        logger.info("Received batch of %s notifications from Orion-LD", len(notifications))
+        if not all(subscription_manager.authentic(notification, request.headers) for notification in notifications):
+            logger.warning("Refused a notification batch without the shared subscription secret")
+            return jsonify({'status': 'error', 'message': 'Notification secret missing or wrong'}), 401
+        accepted = sum(1 for notification in notifications
+                       if isinstance(notification, dict) and enqueue_notification(notification))
+
+        return jsonify({'status': 'success', 'received': len(notifications), 'accepted': accepted}), 200
+
+    except Exception as e:
+        logger.error(f"Error processing notification batch: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @app.route('/api/notifications/stream')
 def notification_stream():
     """
-    Server-Sent Events endpoint for streaming notifications to clients
+    Server-Sent Events endpoint for streaming notifications to clients.
+    With ?type=<entity type> (optionally &attrs=<watched attributes>&tenant=<tenant>) the client
+    joins the shared Orion-LD subscription for that set, created on first use; without it the
+    client receives every notification this backend gets.
+    Notifications arriving within NOTIFICATION_BATCH_WINDOW_MS are sent as one batched frame.
+    At most SSE_MAX_STREAMS streams are open per worker; further clients get 503 with Retry-After.
     """
+    if not sse_slots.acquire(blocking=False):
+        metrics.registry.inc('explorer_sse_rejected_total')
+        response = jsonify({'error': 'Too many notification streams on this server, retry later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SSE_RETRY_AFTER_SECONDS)
+        return response
+
+    try:
+        entity_type = request.args.get('type')
+        if entity_type:
+            headers = NGSI_LD_Utils.build_headers(request.headers)
+            tenant = request.args.get('tenant') or headers.get('NGSILD-Tenant')
+            if tenant and tenant.lower() in DEFAULT_TENANTS:
+                tenant = None
+            attrs = request.args.get('attrs', '').split(',')
+            listener, error = subscription_manager.subscribe(tenant, entity_type, attrs, headers, session.get('sid'))
+            if error is not None:
+                sse_slots.release()
+                status_code, message = error
+                return jsonify({'error': 'Could not subscribe to notifications', 'details': message}), status_code
+        else:
+            listener = subscription_manager.listen_all()
+    except Exception:
+        sse_slots.release()
+        raise
+
     def generate():
         while True:
-            # Get notification from queue (blocking)
-            notification = notification_queue.get()
-            
-            # Format as SSE
-            data = f"data: {json.dumps(notification)}\n\n"
-            yield data
-            
-            # Mark task as done
-            notification_queue.task_done()
-
-    return Response(generate(), mimetype='text/event-stream')
+            # Get the next batch of this client's notifications (blocking)
+            notifications = next_notification_batch(listener.queue)
+            if not notifications:
+                yield ": keepalive\n\n"
+                continue
+
+            # Format as a single SSE frame
+            yield format_notification_batch(notifications)
+
+    def close():
+        # Runs even when the client disconnects before the first frame
+        subscription_manager.unsubscribe(listener)
+        sse_slots.release()
+        metrics.registry.gauge_add('explorer_sse_subscribers', value=-1)
+
+    metrics.registry.gauge_add('explorer_sse_subscribers', value=1)
+    response = Response(generate(), mimetype='text/event-stream')
+    response.call_on_close(close)
+    return response
 
 # Health check endpoint
 @app.route('/health')
@@ -174,11 +327,41 @@ except Exception as e:
     logger.warning(f"Could not read backend version.txt: {e}")
 
 # Import blueprints from endpoints.py
-from endpoints import blueprints
+from endpoints import blueprints, quantum_lead_metadata_cache, quantum_lead_tile_cache, NGSI_LD_Utils, DEFAULT_TENANTS
+from data_product_catalog import data_product_catalog
+from entity_state import live_entity_cache
+from upload_relay import upload_stats
 
 # Register blueprints
 for blueprint in blueprints:
     app.register_blueprint(blueprint)
+app.register_blueprint(auth_blueprint)
+app.register_blueprint(context_blueprint)
+
+# Build the Keycloak client once at startup (pooled HTTP session, JWKS cache); OIDC discovery runs in the background
+keycloak_auth = get_keycloak_auth()
+token_manager = get_token_manager()
+# Warm the local @context copies so entity editing never waits on the remote context host
+context_cache.preload()
+
+# Cache, pool and queue statistics exported on /metrics
+metrics.registry.register_collector('explorer_response_cache', quantum_lead_metadata_cache.stats, (('cache', 'quantum_lead_metadata'),))
+metrics.registry.register_collector('explorer_response_cache', context_cache.cache.stats, (('cache', 'ngsi_ld_context'),))
+metrics.registry.register_collector('explorer_tile_cache', quantum_lead_tile_cache.stats)
+metrics.registry.register_collector('explorer_single_flight', upstream.single_flight.stats)
+metrics.registry.register_collector('explorer_token_cache', keycloak_auth.token_cache.stats)
+metrics.registry.register_collector('explorer_token_manager', token_manager.stats)
+metrics.registry.register_collector('explorer_data_product_catalog', data_product_catalog.stats)
+metrics.registry.register_collector('explorer_uploads', upload_stats.stats)
+metrics.registry.register_collector('explorer_trace_spans', tracing.exporter.stats)
+metrics.registry.register_collector('explorer_log_records', log_config.stats)
+metrics.registry.register_collector('explorer_admission', admission.admission_controller.stats)
+# Circuit state (0 closed, 1 half-open, 2 open), bulkhead usage and rejections per upstream
+for upstream_service in ('orion-ld', 'quantumleap', 'data-product-manager'):
+    metrics.registry.register_collector('explorer_upstream_guard', resilience.get_guard(upstream_service).stats,
+                                        (('upstream', upstream_service),))
+metrics.registry.register_collector('explorer_shared_subscriptions', subscription_manager.stats)
+metrics.registry.register_collector('explorer_live_entity_cache', live_entity_cache.stats)
 
 
 # Create new routes for login, logout, and token validation
@@ -190,9 +373,8 @@ def login():
         state = secrets.token_urlsafe(16)
 
         # Build the Keycloak login URL with OIDC parameters
-        keycloak = KeycloakAuth()
-        auth_url = f"{keycloak.auth_url}?client_id={keycloak.client_id}&response_type=code&redirect_uri={keycloak.redirect_uri}&state={state}&scope=openid profile email"
-        logger.debug(f"Redirecting to Keycloak login URL: {auth_url}")
+        auth_url = keycloak_auth.login_url(state)
+        logger.debug("Redirecting to Keycloak login URL: %s", auth_url)
         # Redirect the browser to the Keycloak login page
         return redirect(auth_url)
     except Exception as e:
@@ -201,12 +383,14 @@ def login():
 
 @app.route('/api/auth/logout', methods=['GET'])
 def logout():
-    keycloak = KeycloakAuth()
-    logout_url = keycloak.logout_url
-    # Clear session data
+    keycloak_auth.ensure_discovered()
+    logout_url = keycloak_auth.logout_url
+    # Stop refreshing this session's tokens and clear session data
+    if session.get('sid'):
+        token_manager.remove(session['sid'])
     session.clear()
     # Redirect to Keycloak logout URL
-    logger.debug(f"Redirecting to Keycloak logout URL: {logout_url}")
+    logger.debug("Redirecting to Keycloak logout URL: %s", logout_url)
     return redirect(logout_url)
 
 @app.route('/api/auth/validate', methods=['POST'])
@@ -219,8 +403,7 @@ def validate_token():
             return jsonify({'error': 'Token is required'}), 400
 
         # Validate token using Keycloak
-        keycloak = KeycloakAuth()
-        user_info = keycloak.validate_token(token)
+        user_info = keycloak_auth.validate_token(token)
         return jsonify({'user_info': user_info}), 200
     except Exception as e:
         logger.error(f"Token validation failed: {str(e)}")
@@ -235,8 +418,7 @@ def get_user_info():
             return jsonify({'error': 'Authorization token is required'}), 401
 
         # Validate token and retrieve user info
-        keycloak = KeycloakAuth()
-        user_info = keycloak.validate_token(token.split(' ')[1])
+        user_info = keycloak_auth.validate_token(token.split(' ')[1])
         return jsonify({'user_info': user_info}), 200
     except Exception as e:
         logger.error(f"Failed to retrieve user info: {str(e)}")
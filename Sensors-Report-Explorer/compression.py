@@ -0,0 +1,157 @@
+import gzip
+import logging
+import os
+import zlib
+
+from flask import request, make_response
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+# Optional encoders: brotli and zstd are offered only when their packages are installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', 'true').lower() in ('true', 't', '1', 'yes')
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '5'))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get('COMPRESSION_ZSTD_LEVEL', '3'))
+
+COMPRESSIBLE_MIMETYPES = (
+    'application/json', 'application/ld+json', 'application/geo+json', 'application/x-ndjson',
+    'application/javascript', 'text/'
+)
+
+# Server preference order when the client accepts several encodings equally
+AVAILABLE_ENCODINGS = tuple(
+    encoding for encoding, available in (('zstd', zstandard), ('br', brotli), ('gzip', True)) if available
+)
+
+
+def decode_content(content, encoding):
+    """Decode an upstream body that was sent with a Content-Encoding"""
+    if encoding == 'gzip':
+        return gzip.decompress(content)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(content)
+        except zlib.error:
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+    if encoding == 'br' and brotli is not None:
+        return brotli.decompress(content)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(content)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def client_accepts(encoding):
+    return request.accept_encodings[encoding] > 0
+
+
+def negotiate_encoding():
+    """Pick the best encoding the client accepts, or None"""
+    return request.accept_encodings.best_match(AVAILABLE_ENCODINGS)
+
+
+def make_upstream_response(upstream_response):
+    """
+    Build a Flask response from an UpstreamResponse. Bodies the upstream already
+    compressed are passed through untouched when the client accepts that encoding.
+    """
+    encoding = getattr(upstream_response, 'content_encoding', None)
+    if encoding and client_accepts(encoding):
+        response = make_response(upstream_response.encoded_content, upstream_response.status_code)
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+    else:
+        response = make_response(upstream_response.content, upstream_response.status_code)
+    content_type = upstream_response.headers.get('Content-Type')
+    if content_type:
+        response.headers['Content-Type'] = content_type
+    return response
+
+
+class _Compressor:
+    """Incremental compressor with a flush after every chunk so streamed lines reach the client promptly"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compressobj()
+        elif encoding == 'br':
+            self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk):
+        if self.encoding == 'zstd':
+            return self._compressor.compress(chunk) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == 'br':
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'zstd':
+            return self._compressor.flush()
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress_bytes(data, encoding):
+    compressor = _Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_stream(iterable, encoding):
+    compressor = _Compressor(encoding)
+    for chunk in iterable:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if chunk:
+            yield compressor.compress(chunk)
+    yield compressor.finish()
+
+
+def compress_response(response):
+    """after_request hook compressing JSON/text responses per Accept-Encoding"""
+    if (not COMPRESSION_ENABLED
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or response.direct_passthrough
+            or response.mimetype == 'text/event-stream'
+            or not response.mimetype.startswith(COMPRESSIBLE_MIMETYPES)):
+        return response
+
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(compress_bytes(data, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if response.headers.get('ETag', '').startswith('"'):
+        # The encoded body differs from the identity one, so its validator becomes weak
+        response.headers['ETag'] = 'W/' + response.headers['ETag']
+    return response
+
+
+def init_app(app):
+    """Enable negotiated response compression on the Flask app"""
+    app.after_request(compress_response)
+    logger.info(f"Response compression enabled for encodings: {', '.join(AVAILABLE_ENCODINGS)}")
@@ -0,0 +1,169 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+from urllib.parse import urlparse
+
+from flask import Blueprint, request, jsonify, make_response
+
+import upstream
+from response_cache import ResponseCache
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+SCHEMA_DIR = os.environ.get('SCHEMA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'js', 'schemas'))
+# max-age for schema URLs without a ?v=<hash> version; versioned URLs are immutable
+SCHEMA_MAX_AGE = int(os.environ.get('SCHEMA_MAX_AGE', '300'))
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Remote JSON-LD @context documents served from the Explorer under /api/contexts/<name>
+NGSI_LD_CONTEXTS = [
+    url.strip() for url in os.environ.get(
+        'NGSI_LD_CONTEXTS', 'https://ngsi-ld.sensorsreport.net/synchro-context.jsonld').split(',')
+    if url.strip()
+]
+CONTEXT_CACHE_TTL = int(os.environ.get('CONTEXT_CACHE_TTL', '3600'))
+# Keep serving the last good copy for this long when the context host is unreachable
+CONTEXT_CACHE_STALE_TTL = int(os.environ.get('CONTEXT_CACHE_STALE_TTL', '604800'))
+
+
+class Schema:
+    """A schema file loaded in memory with its content hash"""
+
+    __slots__ = ('name', 'content', 'mimetype', 'digest', 'etag')
+
+    def __init__(self, name, content):
+        self.name = name
+        self.content = content
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/json'
+        self.digest = hashlib.sha256(content).hexdigest()[:16]
+        self.etag = f'"{self.digest}"'
+
+
+class SchemaStore:
+    """Schemas preloaded from SCHEMA_DIR at startup and served from memory"""
+
+    def __init__(self, directory=SCHEMA_DIR):
+        self.directory = directory
+        self.schemas = {}
+        self.load()
+
+    def load(self):
+        """(Re)load every file below the schema directory"""
+        schemas = {}
+        if os.path.isdir(self.directory):
+            for root, _, files in os.walk(self.directory):
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    name = os.path.relpath(path, self.directory).replace(os.sep, '/')
+                    with open(path, 'rb') as f:
+                        schemas[name] = Schema(name, f.read())
+        else:
+            logger.warning(f"Schema directory {self.directory} not found")
+        self.schemas = schemas
+        logger.info(f"Preloaded {len(schemas)} schema(s) from {self.directory}")
+
+    def index(self):
+        """Versioned URLs of all schemas, for clients that want immutable caching"""
+        return {name: f"/api/schemas/{name}?v={schema.digest}" for name, schema in sorted(self.schemas.items())}
+
+    def make_response(self, name):
+        schema = self.schemas.get(name)
+        if schema is None:
+            return jsonify({'error': f"Schema {name} not found"}), 404
+
+        # Weak comparison: compressed responses carry a weak W/"..." ETag
+        if request.if_none_match.contains_weak(schema.digest):
+            response = make_response('', 304)
+        else:
+            response = make_response(schema.content)
+            response.headers['Content-Type'] = schema.mimetype
+        response.headers['ETag'] = schema.etag
+        if request.args.get('v') == schema.digest:
+            response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers['Cache-Control'] = f"public, max-age={SCHEMA_MAX_AGE}"
+        return response
+
+
+class ContextCache:
+    """
+    Local copies of the remote @context documents in NGSI_LD_CONTEXTS. They are fetched in
+    the background at startup, refreshed after CONTEXT_CACHE_TTL and the last good copy
+    is served while the remote host is down.
+    """
+
+    def __init__(self, urls=NGSI_LD_CONTEXTS):
+        self.urls = {os.path.basename(urlparse(url).path): url for url in urls}
+        self.cache = ResponseCache('ngsi_ld_context', ttl=CONTEXT_CACHE_TTL, stale_ttl=CONTEXT_CACHE_STALE_TTL,
+                                   max_entries=max(len(self.urls), 1))
+
+    def _fetcher(self, url):
+        def fetch():
+            response = upstream.get(url, headers={'Accept': 'application/ld+json, application/json'})
+            return response.content, response.status_code, 'application/ld+json'
+        return fetch
+
+    def get(self, name):
+        """Return (entry, state) for a configured context, or None when the name is unknown"""
+        url = self.urls.get(name)
+        if url is None:
+            return None
+        return self.cache.get_or_fetch(url, self._fetcher(url))
+
+    def preload(self):
+        """Fetch all configured contexts in a background thread so startup never waits on them"""
+        def worker():
+            for name in self.urls:
+                try:
+                    entry, _ = self.get(name)
+                    logger.info(f"Preloaded @context {name}: status {entry.status_code}")
+                except Exception as e:
+                    logger.warning(f"Could not preload @context {name}: {str(e)}")
+
+        threading.Thread(target=worker, name='context-preload', daemon=True).start()
+
+
+schema_store = SchemaStore()
+context_cache = ContextCache()
+
+# Blueprint for schemas and cached @context documents
+context_blueprint = Blueprint('context', __name__)
+
+
+@context_blueprint.route('/api/schemas', methods=['GET'])
+def list_schemas():
+    """List the available schemas with their versioned URLs"""
+    return jsonify(schema_store.index())
+
+
+@context_blueprint.route('/api/schemas/<path:filename>', methods=['GET'])
+def serve_schema(filename):
+    """Serve a preloaded JSON schema with a strong ETag"""
+    return schema_store.make_response(filename)
+
+
+@context_blueprint.route('/api/contexts', methods=['GET'])
+def list_contexts():
+    """List the @context documents served locally and their source URLs"""
+    return jsonify({name: {'url': f"/api/contexts/{name}", 'source': url} for name, url in context_cache.urls.items()})
+
+
+@context_blueprint.route('/api/contexts/<name>', methods=['GET'])
+@context_blueprint.route('/context/<name>', methods=['GET'])
+def serve_context(name):
+    """Serve a cached copy of a remote JSON-LD @context document"""
+    try:
+        result = context_cache.get(name)
+        if result is None:
+            return jsonify({'error': f"Unknown @context {name}"}), 404
+        entry, state = result
+        response = ResponseCache.make_response(entry, state)
+        if entry.status_code == 200:
+            response.headers['Cache-Control'] = f"public, max-age={CONTEXT_CACHE_TTL}"
+        return response
+    except Exception as e:
+        logger.error(f"Error serving @context {name}: {str(e)}")
+        return jsonify({'error': str(e)}), 502
@@ -0,0 +1,254 @@
+import bisect
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import upstream
+from response_cache import CachedResponse
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+# Catalog freshness; older catalogs are refreshed in the background while still being served
+DATA_PRODUCT_CATALOG_TTL = int(os.environ.get('DATA_PRODUCT_CATALOG_TTL', '30'))
+DATA_PRODUCT_SEARCH_PAGE_SIZE = int(os.environ.get('DATA_PRODUCT_SEARCH_PAGE_SIZE', '50'))
+DATA_PRODUCT_SEARCH_MAX_PAGE_SIZE = int(os.environ.get('DATA_PRODUCT_SEARCH_MAX_PAGE_SIZE', '500'))
+
+TOKEN_PATTERN = re.compile(r'[0-9a-z]+')
+# Weight of a query term found in each field when ranking full-text results
+FIELD_WEIGHTS = (('name', 4), ('tags', 3), ('glossary_terms', 3), ('owner', 2), ('description', 1))
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+def product_id(product):
+    return product.get('_id') or product.get('id')
+
+
+def extract_products(document):
+    """Return the list of data products from a catalog response"""
+    if isinstance(document, list):
+        return document
+    if isinstance(document, dict):
+        for key in ('data_products', 'dataProducts', 'data', 'items'):
+            if isinstance(document.get(key), list):
+                return document[key]
+    return []
+
+
+class DataProductCatalog:
+    """
+    In-process copy of the data-product catalog with an inverted index for search.
+    Refreshes are conditional (If-None-Match) and only products whose content changed
+    are re-indexed, so keeping a catalog of thousands of products current stays cheap.
+    """
+
+    def __init__(self, ttl=DATA_PRODUCT_CATALOG_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._products = {}
+        self._digests = {}
+        self._weights = {}
+        self._index = {}
+        self._facets = {'tags': {}, 'glossary_terms': {}, 'owner': {}}
+        self._vocabulary = None
+        self._upstream_etag = None
+        self.response = None
+        self.loaded_at = None
+        self.refreshes = 0
+        self.not_modified = 0
+        self.reindexed = 0
+        self.searches = 0
+
+    @staticmethod
+    def catalog_url():
+        return f"{os.environ.get('DATA_PRODUCT_URL')}/dataProducts"
+
+    def is_fresh(self):
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    def ensure_loaded(self):
+        """
+        Load the catalog on first use; refresh a stale one in the background. After an
+        invalidation the previous catalog is still served if the refresh fails.
+        """
+        if self.loaded_at is None:
+            try:
+                self.refresh()
+            except Exception as e:
+                if self.response is None:
+                    raise
+                logger.warning("Serving the previous data product catalog: %s", e)
+        elif not self.is_fresh() and not self._refresh_lock.locked():
+            threading.Thread(target=self._background_refresh, name='data-product-catalog', daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning(f"Data product catalog refresh failed: {str(e)}")
+
+    def invalidate(self):
+        """Force a refresh on next use, e.g. after a data product was created or deleted through the Explorer"""
+        self.loaded_at = None
+
+    def refresh(self):
+        """Fetch the catalog (conditionally) and re-index the products that changed"""
+        with self._refresh_lock:
+            if self.is_fresh():
+                return
+            headers = {'Accept': 'application/json'}
+            if self._upstream_etag and self.response is not None:
+                headers['If-None-Match'] = self._upstream_etag
+            response = upstream.get(self.catalog_url(), headers=headers)
+            if response.status_code == 304:
+                self.not_modified += 1
+                self.loaded_at = time.monotonic()
+                return
+            if response.status_code != 200:
+                raise RuntimeError(f"Data product manager returned {response.status_code}")
+
+            products = extract_products(response.json())
+            self._apply(products)
+            self._upstream_etag = response.headers.get('ETag')
+            self.response = CachedResponse(response.content, 200, response.headers.get('Content-Type'), self.ttl)
+            self.loaded_at = time.monotonic()
+            self.refreshes += 1
+
+    def _apply(self, products):
+        seen = set()
+        changed = 0
+        with self._lock:
+            for product in products:
+                if not isinstance(product, dict) or product_id(product) is None:
+                    continue
+                pid = str(product_id(product))
+                seen.add(pid)
+                digest = hashlib.sha1(json.dumps(product, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+                if self._digests.get(pid) == digest:
+                    continue
+                self._unindex(pid)
+                self._index_product(pid, product, digest)
+                changed += 1
+            removed = [pid for pid in self._products if pid not in seen]
+            for pid in removed:
+                self._unindex(pid)
+            if changed or removed:
+                self._vocabulary = None
+        self.reindexed += changed
+        logger.debug("Data product catalog: %s products, %s re-indexed, %s removed", len(seen), changed, len(removed))
+
+    def _index_product(self, pid, product, digest):
+        weights = {}
+        for field, weight in FIELD_WEIGHTS:
+            value = product.get(field)
+            values = value if isinstance(value, list) else [value] if value else []
+            for item in values:
+                for token in tokenize(item):
+                    if weights.get(token, 0) < weight:
+                        weights[token] = weight
+        for token in weights:
+            self._index.setdefault(token, set()).add(pid)
+        for field, facet in self._facets.items():
+            for value in self._facet_values(product, field):
+                facet.setdefault(value, set()).add(pid)
+        self._products[pid] = product
+        self._digests[pid] = digest
+        self._weights[pid] = weights
+
+    def _unindex(self, pid):
+        product = self._products.pop(pid, None)
+        if product is None:
+            return
+        for token in self._weights.pop(pid):
+            ids = self._index[token]
+            ids.discard(pid)
+            if not ids:
+                del self._index[token]
+        for field, facet in self._facets.items():
+            for value in self._facet_values(product, field):
+                ids = facet[value]
+                ids.discard(pid)
+                if not ids:
+                    del facet[value]
+        del self._digests[pid]
+
+    @staticmethod
+    def _facet_values(product, field):
+        value = product.get(field)
+        values = value if isinstance(value, list) else [value] if value else []
+        return {str(item).lower() for item in values}
+
+    def _matching_ids(self, term):
+        """Ids of products containing a token starting with term (prefix match for search-as-you-type)"""
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._index)
+        vocabulary = self._vocabulary
+        ids = set()
+        tokens = set()
+        position = bisect.bisect_left(vocabulary, term)
+        while position < len(vocabulary) and vocabulary[position].startswith(term):
+            token = vocabulary[position]
+            ids |= self._index[token]
+            tokens.add(token)
+            position += 1
+        return ids, tokens
+
+    def search(self, text=None, tags=(), glossary_terms=(), owner=None, page=1, page_size=DATA_PRODUCT_SEARCH_PAGE_SIZE):
+        """
+        Return one page of products matching all filters. Tags and glossary terms must all be
+        present; every word of text must prefix-match a token of the name, tags, glossary
+        terms, owner or description. Text results are ranked by field weight, others by name.
+        """
+        self.searches += 1
+        page = max(page, 1)
+        page_size = min(max(page_size, 1), DATA_PRODUCT_SEARCH_MAX_PAGE_SIZE)
+        with self._lock:
+            candidates = None
+            filters = [('tags', tag) for tag in tags] + [('glossary_terms', term) for term in glossary_terms]
+            if owner:
+                filters.append(('owner', owner))
+            for field, value in filters:
+                ids = self._facets[field].get(value.lower(), set())
+                candidates = set(ids) if candidates is None else candidates & ids
+
+            scores = None
+            for term in tokenize(text or ''):
+                ids, tokens = self._matching_ids(term)
+                candidates = set(ids) if candidates is None else candidates & ids
+                if scores is None:
+                    scores = {}
+                for pid in candidates:
+                    weights = self._weights[pid]
+                    scores[pid] = scores.get(pid, 0) + max((weights[token] for token in tokens if token in weights), default=0)
+
+            if candidates is None:
+                candidates = self._products.keys()
+            if scores is not None:
+                ordered = sorted(candidates, key=lambda pid: (-scores.get(pid, 0), str(self._products[pid].get('name', '')).lower()))
+            else:
+                ordered = sorted(candidates, key=lambda pid: str(self._products[pid].get('name', '')).lower())
+            start = (page - 1) * page_size
+            items = [self._products[pid] for pid in ordered[start:start + page_size]]
+
+        return {'total': len(ordered), 'page': page, 'page_size': page_size, 'items': items}
+
+    def stats(self):
+        return {
+            'products': len(self._products),
+            'tokens': len(self._index),
+            'refreshes': self.refreshes,
+            'not_modified': self.not_modified,
+            'reindexed': self.reindexed,
+            'searches': self.searches
+        }
+
+
+data_product_catalog = DataProductCatalog()
@@ -1,7 +1,25 @@
-from flask import Blueprint, request, jsonify, make_response
+from flask import Blueprint, request, jsonify, make_response, Response, g
 import requests
 import os
+import json
+import csv
+import io
+import itertools
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from response_cache import ResponseCache
+import upstream
+import tracing
+import timeseries
+import time
+from tile_cache import TileCache
+from token_manager import get_token_manager
+from compression import make_upstream_response
+from data_product_catalog import data_product_catalog, DATA_PRODUCT_SEARCH_PAGE_SIZE
+from upload_relay import RequestBodyStream, UploadTooLarge, upload_stats, DATA_PRODUCT_MAX_UPLOAD_BYTES
+from resilience import UpstreamUnavailable, pool_size
+from entity_state import live_entity_cache
 
 # Initialize logging
 logger = logging.getLogger(__name__)
@@ -9,6 +27,25 @@ logger = logging.getLogger(__name__)
 # Blueprint for NGSI-LD Endpoints
 ngsi_ld_blueprint = Blueprint('ngsi_ld', __name__)
 
+# Page size used when walking Orion-LD pagination for exports (Orion-LD caps limit at 1000)
+NGSI_LD_EXPORT_PAGE_SIZE = int(os.environ.get('NGSI_LD_EXPORT_PAGE_SIZE', '1000'))
+# Fan-out pools never exceed their upstream's bulkhead (UPSTREAM_MAX_CONCURRENCY), see resilience.pool_size
+NGSI_LD_MAX_WORKERS = pool_size('orion-ld', int(os.environ.get('NGSI_LD_MAX_WORKERS', '8')))
+ngsi_ld_executor = ThreadPoolExecutor(max_workers=NGSI_LD_MAX_WORKERS, thread_name_prefix='ngsi-ld')
+EXPORT_CSV_COLUMNS = ['id', 'type', 'attribute', 'attributeType', 'value', 'unitCode', 'observedAt']
+# Batch operations are split into chunks of this size and sent with bounded concurrency
+NGSI_LD_BATCH_SIZE = int(os.environ.get('NGSI_LD_BATCH_SIZE', '100'))
+NGSI_LD_BATCH_CONCURRENCY = pool_size('orion-ld', int(os.environ.get('NGSI_LD_BATCH_CONCURRENCY', '4')))
+ngsi_ld_batch_executor = ThreadPoolExecutor(max_workers=NGSI_LD_BATCH_CONCURRENCY, thread_name_prefix='ngsi-ld-batch')
+BATCH_OPERATIONS = ('create', 'upsert', 'update', 'delete')
+# Client headers forwarded to Orion-LD and QuantumLeap; everything else stays at the Explorer
+FORWARDED_HEADERS = (
+    'Accept', 'Authorization', 'Content-Type', 'Link', 'NGSILD-Tenant', 'NGSILD-Path',
+    'Fiware-Service', 'Fiware-ServicePath', 'Fiware-Correlator'
+)
+# Tenants that map to the broker's default tenant, i.e. no NGSILD-Tenant header
+DEFAULT_TENANTS = ('synchro', 'default')
+
 class NGSI_LD_Endpoints:
     @staticmethod
     def validate_subscription_payload(payload):
@@ -48,16 +85,16 @@ class NGSI_LD_Endpoints:
         try:
             logger.debug("Processing request for get_all_subscriptions endpoint")
             headers = request.headers
-            logger.debug(f"Request headers: {headers}")
+            logger.debug("Request headers: %s", headers)
             target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/subscriptions"
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            headers = NGSI_LD_Utils.check_headers(headers)
+            response = upstream.get(target_url, headers=headers)
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error getting subscriptions: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/subscriptions/<subscription_id>', methods=['GET'])
@@ -66,16 +103,16 @@ class NGSI_LD_Endpoints:
         try:
             logger.debug("Processing request for get_subscription endpoint")
             headers = request.headers
-            logger.debug(f"Request headers: {headers}")
+            logger.debug("Request headers: %s", headers)
             target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/subscriptions/{subscription_id}"
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            headers = NGSI_LD_Utils.check_headers(headers)
+            response = upstream.get(target_url, headers=headers)
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error getting subscription {subscription_id}: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/subscriptions', methods=['POST'])
@@ -87,13 +124,13 @@ class NGSI_LD_Endpoints:
             headers = NGSI_LD_Utils.check_payload(payload, request.headers)
             headers = NGSI_LD_Utils.check_headers(headers)
             target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/subscriptions"
-            logger.debug(f"Target URL: {target_url}")
-            response = requests.post(target_url, headers=headers, json=payload)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            response = upstream.request('POST', target_url, headers=headers, json=payload)
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error creating subscription: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/subscriptions/<subscription_id>', methods=['PATCH'])
@@ -105,13 +142,13 @@ class NGSI_LD_Endpoints:
             headers = NGSI_LD_Utils.check_payload(payload, request.headers)
             headers = NGSI_LD_Utils.check_headers(headers)
             target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/subscriptions/{subscription_id}"
-            logger.debug(f"Target URL: {target_url}")
-            response = requests.patch(target_url, headers=headers, json=payload)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            response = upstream.request('PATCH', target_url, headers=headers, json=payload)
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error updating subscription {subscription_id}: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/subscriptions/<subscription_id>', methods=['DELETE'])
@@ -120,15 +157,15 @@ class NGSI_LD_Endpoints:
         try:
             logger.debug("Processing request for delete_subscription endpoint")
             headers = request.headers
-            NGSI_LD_Utils.check_headers(headers)
+            headers = NGSI_LD_Utils.check_headers(headers)
             target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/subscriptions/{subscription_id}"
-            logger.debug(f"Target URL: {target_url}")
-            response = requests.delete(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            response = upstream.request('DELETE', target_url, headers=headers)
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error deleting subscription {subscription_id}: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/subscriptions', methods=['OPTIONS'])
@@ -150,23 +187,31 @@ class NGSI_LD_Endpoints:
         try:
             logger.debug("Processing request for get_entities endpoint")
             headers = request.headers
-            logger.debug(f"Request headers: {headers}")
-            NGSI_LD_Utils.check_headers(headers)
+            logger.debug("Request headers: %s", headers)
+            headers = NGSI_LD_Utils.check_headers(headers)
 
             # Extract query parameters
             query_params = request.args.to_dict()
-            logger.debug(f"Query parameters: {query_params}")
+            logger.debug("Query parameters: %s", query_params)
+
+            # Subscribed types are answered from the live entity state when it holds all of them
+            cached = live_entity_cache.query_entities(headers, query_params)
+            if cached is not None:
+                return cached
+
             context_broker_url = os.environ.get('CONTEXT_BROKER_URL')
             target_url = f"{context_broker_url}/ngsi-ld/v1/entities"
 
             # Send request with query parameters
-            logger.debug(f"Sending request to {target_url} with headers and query parameters")
-            response = requests.get(target_url, headers=headers, params=query_params)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Sending request to %s with headers and query parameters", target_url)
+            started = live_entity_cache.clock()
+            response = upstream.get(target_url, headers=headers, params=query_params)
+            logger.debug("Response status code: %s", response.status_code)
+            live_entity_cache.learn(headers, query_params, response, started)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error fetching entities: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/entities/<entity_id>', methods=['GET'])
@@ -175,16 +220,22 @@ class NGSI_LD_Endpoints:
         try:
             logger.debug("Processing request for get_entity endpoint")
             headers = request.headers
-            logger.debug(f"Request headers: {headers}")
+            logger.debug("Request headers: %s", headers)
             target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/entities/{entity_id}"
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            headers = NGSI_LD_Utils.check_headers(headers)
+            query_params = request.args.to_dict()
+            cached = live_entity_cache.read_entity(headers, entity_id, query_params)
+            if cached is not None:
+                return cached
+            started = live_entity_cache.clock()
+            response = upstream.get(target_url, headers=headers, params=query_params)
+            logger.debug("Response status code: %s", response.status_code)
+            live_entity_cache.learn(headers, query_params, response, started)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error fetching entity {entity_id}: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/entities', methods=['POST'])
@@ -196,13 +247,15 @@ class NGSI_LD_Endpoints:
             headers = NGSI_LD_Utils.check_payload(payload, request.headers)
             headers = NGSI_LD_Utils.check_headers(headers)
             target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/entities"
-            logger.debug(f"Target URL: {target_url}")
-            response = requests.post(target_url, headers=headers, json=payload)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            response = upstream.request('POST', target_url, headers=headers, json=payload)
+            logger.debug("Response status code: %s", response.status_code)
+            if response.status_code < 300 and isinstance(payload, dict):
+                live_entity_cache.written(headers, payload.get('id'), payload.get('type'))
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error creating entity: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/entities/<entity_id>', methods=['PUT'])
@@ -214,13 +267,14 @@ class NGSI_LD_Endpoints:
             headers = NGSI_LD_Utils.check_payload(payload, request.headers)
             headers = NGSI_LD_Utils.check_headers(headers)
             target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/entities/{entity_id}"
-            logger.debug(f"Target URL: {target_url}")
-            response = requests.put(target_url, headers=headers, json=payload)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            response = upstream.request('PUT', target_url, headers=headers, json=payload)
+            logger.debug("Response status code: %s", response.status_code)
+            live_entity_cache.written(headers, entity_id)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error replacing entity {entity_id}: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/entities/<entity_id>', methods=['PATCH'])
@@ -232,13 +286,14 @@ class NGSI_LD_Endpoints:
             headers = NGSI_LD_Utils.check_payload(payload, request.headers)
             headers = NGSI_LD_Utils.check_headers(headers)
             target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/entities/{entity_id}"
-            logger.debug(f"Target URL: {target_url}")
-            response = requests.patch(target_url, headers=headers, json=payload)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            response = upstream.request('PATCH', target_url, headers=headers, json=payload)
+            logger.debug("Response status code: %s", response.status_code)
+            live_entity_cache.written(headers, entity_id)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error updating entity {entity_id}: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/entities/<entity_id>', methods=['DELETE'])
@@ -247,52 +302,316 @@ class NGSI_LD_Endpoints:
         try:
             logger.debug("Processing request for delete_entity endpoint")
             headers = request.headers
-            NGSI_LD_Utils.check_headers(headers)
+            headers = NGSI_LD_Utils.check_headers(headers)
             target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/entities/{entity_id}"
-            logger.debug(f"Target URL: {target_url}")
-            response = requests.delete(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            response = upstream.request('DELETE', target_url, headers=headers)
+            logger.debug("Response status code: %s", response.status_code)
+            if response.status_code < 300:
+                live_entity_cache.written(headers, entity_id, deleted=True)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error deleting entity {entity_id}: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
+
+    @staticmethod
+    def iter_entity_pages(target_url, headers, params):
+        """
+        Yield pages of entities from Orion-LD, following the Link rel="next" header when the
+        broker sends one and limit/offset otherwise. The next page is prefetched while the
+        current one is being consumed, so at most two pages are held in memory.
+        """
+        def fetch(url, page_params):
+            response = upstream.get(url, headers=headers, params=page_params)
+            if response.status_code != 200:
+                raise RuntimeError(f"Orion-LD returned {response.status_code}: {response.text}")
+            return response
+
+        limit = int(params.get('limit', NGSI_LD_EXPORT_PAGE_SIZE))
+        offset = int(params.get('offset', 0))
+        page_params = dict(params, limit=limit, offset=offset)
+        pending = ngsi_ld_executor.submit(tracing.wrap(fetch), target_url, page_params)
+
+        while pending is not None:
+            response = pending.result()
+            entities = response.json()
+            next_link = requests.utils.parse_header_links(response.headers.get('Link', ''))
+            next_url = next((link['url'] for link in next_link if link.get('rel') == 'next'), None)
+
+            pending = None
+            if next_url:
+                pending = ngsi_ld_executor.submit(tracing.wrap(fetch), next_url, None)
+            elif len(entities) >= limit:
+                page_params = dict(page_params, offset=page_params['offset'] + len(entities))
+                pending = ngsi_ld_executor.submit(tracing.wrap(fetch), target_url, page_params)
+
+            yield entities
+
+    @staticmethod
+    def entity_csv_rows(entity):
+        """Flatten an entity into one CSV row per attribute"""
+        for attr_name, attr_value in entity.items():
+            if attr_name in ('id', 'type', '@context'):
+                continue
+            for instance in attr_value if isinstance(attr_value, list) else [attr_value]:
+                if isinstance(instance, dict):
+                    value = instance.get('value', instance.get('object'))
+                    yield [entity.get('id'), entity.get('type'), attr_name, instance.get('type'),
+                           value if isinstance(value, (str, int, float)) else json.dumps(value),
+                           instance.get('unitCode'), instance.get('observedAt')]
+                else:
+                    yield [entity.get('id'), entity.get('type'), attr_name, None,
+                           instance if isinstance(instance, (str, int, float)) else json.dumps(instance), None, None]
+
+    @staticmethod
+    @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/export/entities', methods=['GET'])
+    def export_entities():
+        """
+        Stream every entity matching the query (type, q, attrs, ...) as NDJSON or CSV,
+        walking Orion-LD pagination server-side. Use format=ndjson|csv.
+        """
+        try:
+            logger.debug("Processing request for export_entities endpoint")
+            headers = NGSI_LD_Utils.check_headers(request.headers)
+            query_params = request.args.to_dict()
+            output_format = query_params.pop('format', 'ndjson')
+            if output_format not in ('ndjson', 'csv'):
+                return jsonify({'error': 'format must be ndjson or csv'}), 400
+            target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/entities"
+            logger.debug("Exporting entities from %s as %s", target_url, output_format)
+            pages = NGSI_LD_Endpoints.iter_entity_pages(target_url, headers, query_params)
+
+            # Fetch the first page before streaming so upstream errors still map to an HTTP status
+            try:
+                first_page = next(pages)
+            except StopIteration:
+                first_page = []
+
+            def generate_ndjson():
+                for page in itertools.chain([first_page], pages):
+                    for entity in page:
+                        yield json.dumps(entity, separators=(',', ':')) + '\n'
+
+            def generate_csv():
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(EXPORT_CSV_COLUMNS)
+                for page in itertools.chain([first_page], pages):
+                    for entity in page:
+                        writer.writerows(NGSI_LD_Endpoints.entity_csv_rows(entity))
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+
+            if output_format == 'csv':
+                response = Response(generate_csv(), mimetype='text/csv')
+            else:
+                response = Response(generate_ndjson(), mimetype='application/x-ndjson')
+            response.headers['Content-Disposition'] = f"attachment; filename=entities.{output_format}"
+            return response
+        except Exception as e:
+            logger.error(f"Error exporting entities: {str(e)}")
+            return NGSI_LD_Utils.error_response(e)
+
+    @staticmethod
+    def send_batch_chunk(target_url, headers, params, chunk, entity_ids):
+        """Send one entityOperations chunk and return (success_ids, errors)"""
+        try:
+            response = upstream.request('POST', target_url, headers=headers, params=params, json=chunk)
+        except Exception as e:
+            status = getattr(e, 'status_code', 502)
+            return [], [{'entityId': entity_id, 'error': {'status': status, 'detail': str(e)}} for entity_id in entity_ids]
+
+        if response.status_code == 207:
+            result = response.json()
+            return result.get('success', []), result.get('errors', [])
+        if 200 <= response.status_code < 300:
+            created = response.json() if response.content and response.status_code == 201 else None
+            return created if isinstance(created, list) else entity_ids, []
+
+        detail = response.text
+        return [], [{'entityId': entity_id, 'error': {'status': response.status_code, 'detail': detail}}
+                    for entity_id in entity_ids]
+
+    @staticmethod
+    def find_invalid_batch_item(payload, operation):
+        """
+        Return an error message for the first item that is not an entity with an id (or, for
+        delete, an entity id), or None when the whole batch is well-formed
+        """
+        for index, item in enumerate(payload):
+            if operation == 'delete' and isinstance(item, str) and item:
+                continue
+            if not isinstance(item, dict):
+                return f"Item {index} must be a JSON object" + (" or an entity id" if operation == 'delete' else "")
+            if not isinstance(item.get('id'), str) or not item['id']:
+                return f"Item {index} has no id"
+        return None
+
+    @staticmethod
+    @ngsi_ld_blueprint.route('/api/ngsi-ld/v1/entityOperations/<operation>', methods=['POST'])
+    def batch_entity_operation(operation):
+        """
+        Create, upsert, update or delete many entities using NGSI-LD batch operations.
+        The payload is split into NGSI_LD_BATCH_SIZE chunks that are sent concurrently,
+        and the per-entity outcome of every chunk is merged into one report.
+        """
+        try:
+            logger.debug("Processing request for batch_entity_operation endpoint (%s)", operation)
+            if operation not in BATCH_OPERATIONS:
+                return jsonify({'error': f"operation must be one of {', '.join(BATCH_OPERATIONS)}"}), 400
+            payload = request.get_json(force=True)
+            if not isinstance(payload, list):
+                return jsonify({'error': 'Payload must be a JSON array'}), 400
+            invalid = NGSI_LD_Endpoints.find_invalid_batch_item(payload, operation)
+            if invalid is not None:
+                return jsonify({'error': invalid}), 400
+
+            if operation == 'delete':
+                items = [item['id'] if isinstance(item, dict) else item for item in payload]
+                entity_ids = items
+                headers = NGSI_LD_Utils.check_payload(None, request.headers)
+                headers['Content-Type'] = 'application/json'
+            else:
+                items = payload
+                entity_ids = [item['id'] for item in payload]
+                ld_item = next((item for item in payload if '@context' in item), payload[0] if payload else None)
+                headers = NGSI_LD_Utils.check_payload(ld_item, request.headers)
+            headers = NGSI_LD_Utils.check_headers(headers)
+
+            target_url = f"{os.environ.get('CONTEXT_BROKER_URL')}/ngsi-ld/v1/entityOperations/{operation}"
+            params = request.args.to_dict()
+            futures = [
+                ngsi_ld_batch_executor.submit(tracing.wrap(NGSI_LD_Endpoints.send_batch_chunk), target_url, headers, params,
+                                              items[start:start + NGSI_LD_BATCH_SIZE],
+                                              entity_ids[start:start + NGSI_LD_BATCH_SIZE])
+                for start in range(0, len(items), NGSI_LD_BATCH_SIZE)
+            ]
+            logger.debug("Sending %s entities to %s in %s chunks", len(items), target_url, len(futures))
+
+            success, errors = [], []
+            for future in futures:
+                chunk_success, chunk_errors = future.result()
+                success.extend(chunk_success)
+                errors.extend(chunk_errors)
+
+            # Failed entities are only marked dirty: a failed chunk may have been partly applied
+            deleted = set(success) if operation == 'delete' else set()
+            entity_types = {item.get('id'): item.get('type') for item in items if isinstance(item, dict)}
+            for entity_id in entity_ids:
+                live_entity_cache.written(headers, entity_id, entity_types.get(entity_id), deleted=entity_id in deleted)
+
+            return jsonify({
+                'operation': operation,
+                'total': len(items),
+                'chunks': len(futures),
+                'success': success,
+                'errors': errors
+            }), 207 if errors else 200
+        except Exception as e:
+            logger.error(f"Error running batch {operation}: {str(e)}")
+            return NGSI_LD_Utils.error_response(e)
 
 class NGSI_LD_Utils:
     @staticmethod
-    def check_headers(request_headers):
-        """Modify request headers for NGSI-LD requests"""
-        logger.debug("Processing check_headers method")
-        tenant_id = request_headers.get('NGSILD-Tenant')
-        logger.debug(f"Tenant ID: {tenant_id}")
-        headers = dict(request_headers)  # Create a mutable copy of headers
-        if tenant_id:
-            logger.debug(f"Using tenant: {tenant_id}")
-
-            # Remove header if tenant_id is 'Synchro' or 'default'
-            if tenant_id.lower() in ['synchro', 'default']:
-                logger.debug(f"Removing tenant header for tenant: {tenant_id}")
-                headers.pop('NGSILD-Tenant', None)
+    def error_response(e):
+        """JSON error for a failed request: 503 with Retry-After when an upstream is unavailable, 500 otherwise"""
+        if isinstance(e, UpstreamUnavailable):
+            response = jsonify({'error': str(e), 'upstream': e.upstream})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+        return jsonify({'error': str(e)}), 500
+
+    @staticmethod
+    def build_headers(request_headers):
+        """
+        Build the upstream header dict from the client headers: only FORWARDED_HEADERS are kept,
+        so cookies, Host and hop-by-hop headers never reach the brokers, the default tenant is
+        dropped and the session's proactively refreshed token replaces the browser's one.
+        """
+        headers = {}
+        for name in FORWARDED_HEADERS:
+            value = request_headers.get(name)
+            if value:
+                headers[name] = value
+
+        tenant_id = headers.get('NGSILD-Tenant')
+        if tenant_id and tenant_id.lower() in DEFAULT_TENANTS:
+            logger.debug("Removing tenant header for tenant: %s", tenant_id)
+            del headers['NGSILD-Tenant']
+
+        access_token = get_token_manager().current_access_token()
+        if access_token:
+            headers['Authorization'] = f"Bearer {access_token}"
         return headers
 
+    @staticmethod
+    def upstream_headers():
+        """Return a copy of the current request's upstream headers, built once per request"""
+        headers = g.get('upstream_headers')
+        if headers is None:
+            headers = g.upstream_headers = NGSI_LD_Utils.build_headers(request.headers)
+        return dict(headers)
+
+    @staticmethod
+    def check_headers(request_headers):
+        """Return the headers for an NGSI-LD or Quantum Lead upstream call"""
+        if isinstance(request_headers, dict):
+            # Already built by check_payload
+            return request_headers
+        return NGSI_LD_Utils.upstream_headers()
+
     @staticmethod
     def check_payload(payload, request_headers):
-        """Check the payload and set the appropriate Content-Type header"""
+        """Return the upstream headers with the Content-Type matching the payload"""
         logger.debug("Processing check_payload method")
-        headers = dict(request_headers)  # Create a mutable copy of headers
+        headers = NGSI_LD_Utils.upstream_headers()
         if payload:
-            logger.debug(f"Payload: {payload}")
-            if '@context' in payload or "@context" in payload:
-                logger.debug("Setting Content-Type to application/ld+json")
+            if '@context' in payload:
                 headers['Content-Type'] = 'application/ld+json'
             else:
-                logger.debug("Setting Content-Type to application/json")
                 headers['Content-Type'] = 'application/json'
+            logger.debug("Content-Type set to %s", headers['Content-Type'])
         return headers
 
 # Blueprint for Quantum Lead Endpoints
 quantum_lead_blueprint = Blueprint('quantum_lead', __name__)
 
+# Tenant-aware cache for Quantum Lead metadata routes (types, attributes, version, health)
+quantum_lead_metadata_cache = ResponseCache(
+    'quantum_lead_metadata',
+    ttl=int(os.environ.get('QUANTUM_LEAP_CACHE_TTL', '60')),
+    stale_ttl=int(os.environ.get('QUANTUM_LEAP_CACHE_STALE_TTL', '300')),
+    max_entries=int(os.environ.get('QUANTUM_LEAP_CACHE_MAX_ENTRIES', '256'))
+)
+QUANTUM_LEAP_HEALTH_CACHE_TTL = int(os.environ.get('QUANTUM_LEAP_HEALTH_CACHE_TTL', '10'))
+# Default and maximum number of points returned by the downsampling endpoints
+QUANTUM_LEAP_DOWNSAMPLE_BUCKETS = int(os.environ.get('QUANTUM_LEAP_DOWNSAMPLE_BUCKETS', '500'))
+QUANTUM_LEAP_DOWNSAMPLE_MAX_BUCKETS = int(os.environ.get('QUANTUM_LEAP_DOWNSAMPLE_MAX_BUCKETS', '10000'))
+# Tiled history cache for zoom/pan over QuantumLeap ranges
+quantum_lead_tile_cache = TileCache()
+TILE_MAX_PER_REQUEST = int(os.environ.get('TILE_MAX_PER_REQUEST', '500'))
+# Bounded pool for concurrent multi-entity history fetches (by default as large as the QuantumLeap bulkhead)
+QUANTUM_LEAP_MAX_WORKERS = pool_size('quantumleap', int(os.environ.get('QUANTUM_LEAP_MAX_WORKERS', '0')))
+QUANTUM_LEAP_HISTORY_MAX_SERIES = int(os.environ.get('QUANTUM_LEAP_HISTORY_MAX_SERIES', '200'))
+quantum_lead_executor = ThreadPoolExecutor(max_workers=QUANTUM_LEAP_MAX_WORKERS, thread_name_prefix='quantum-lead')
+
 class Quantum_Lead_Endpoints:
+    @staticmethod
+    def get_cached_metadata(target_url, ttl=None):
+        """Serve a Quantum Lead metadata GET through the tenant-aware response cache"""
+        headers = NGSI_LD_Utils.check_headers(request.headers)
+
+        def fetch():
+            response = upstream.get(target_url, headers=headers)
+            return response.content, response.status_code, response.headers.get('Content-Type')
+
+        key = ResponseCache.make_key(target_url, headers)
+        entry, state = quantum_lead_metadata_cache.get_or_fetch(key, fetch, ttl=ttl)
+        logger.debug("Cache %s for %s, status code: %s", state, target_url, entry.status_code)
+        return ResponseCache.make_response(entry, state)
+
     @staticmethod
     @quantum_lead_blueprint.route('/api/quantum/version', methods=['GET'])
     def get_version():
@@ -300,16 +619,11 @@ class Quantum_Lead_Endpoints:
         try:
             logger.debug("Processing request for get_version endpoint")
             target_url = f"{os.environ.get('QUANTUM_LEAP_URL')}/version"
-            headers = request.headers
-            logger.debug(f"Request headers: {headers}")
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            return Quantum_Lead_Endpoints.get_cached_metadata(target_url)
         except Exception as e:
             logger.error(f"Error fetching Quantum Lead version: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @quantum_lead_blueprint.route('/api/quantum/health', methods=['GET'])
@@ -318,16 +632,11 @@ class Quantum_Lead_Endpoints:
         try:
             logger.debug("Processing request for get_health endpoint")
             target_url = f"{os.environ.get('QUANTUM_LEAP_URL')}/health"
-            headers = request.headers
-            logger.debug(f"Request headers: {headers}")
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            return Quantum_Lead_Endpoints.get_cached_metadata(target_url, ttl=QUANTUM_LEAP_HEALTH_CACHE_TTL)
         except Exception as e:
             logger.error(f"Error fetching Quantum Lead health status: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @quantum_lead_blueprint.route('/api/quantum/v2/entities', methods=['GET'])
@@ -337,15 +646,15 @@ class Quantum_Lead_Endpoints:
             logger.debug("Processing request for get_entities endpoint")
             target_url = f"{os.environ.get('QUANTUM_LEAP_URL')}/v2/entities"
             headers = request.headers
-            logger.debug(f"Request headers: {headers}")
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Request headers: %s", headers)
+            logger.debug("Target URL: %s", target_url)
+            headers = NGSI_LD_Utils.check_headers(headers)
+            response = upstream.get(target_url, headers=headers)
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error fetching Quantum Lead entities: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @quantum_lead_blueprint.route('/api/quantum/v2/types', methods=['GET'])
@@ -354,52 +663,42 @@ class Quantum_Lead_Endpoints:
         try:
             logger.debug("Processing request for get_types endpoint")
             target_url = f"{os.environ.get('QUANTUM_LEAP_URL')}/v2/types"
-            headers = request.headers
-            logger.debug(f"Request headers: {headers}")
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            return Quantum_Lead_Endpoints.get_cached_metadata(target_url)
         except Exception as e:
             logger.error(f"Error fetching Quantum Lead types: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @quantum_lead_blueprint.route('/api/quantum/v2/types/<entity_type>/attrs', methods=['GET'])
-    def get_type_attributes(self, entity_type):
+    def get_type_attributes(entity_type):
         """Fetches attributes for a specific entity type from Quantum Lead"""
         try:
             logger.debug("Processing request for get_type_attributes endpoint")
             target_url = f"{os.environ.get('QUANTUM_LEAP_URL')}/v2/types/{entity_type}/attrs"
-            headers = request.headers
-            logger.debug(f"Request headers: {headers}")
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            return Quantum_Lead_Endpoints.get_cached_metadata(target_url)
         except Exception as e:
             logger.error(f"Error fetching Quantum Lead type attributes: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @quantum_lead_blueprint.route('/api/quantum/v2/entities/<entity_id>/attrs/<attr_name>', methods=['GET'])
-    def get_entity_attribute_values(self, entity_id, attr_name):
+    def get_entity_attribute_values(entity_id, attr_name):
         """Fetches time series values for an entity attribute from Quantum Lead"""
         try:
             logger.debug("Processing request for get_entity_attribute_values endpoint")
             target_url = f"{os.environ.get('QUANTUM_LEAP_URL')}/v2/entities/{entity_id}/attrs/{attr_name}"
             headers = request.headers
-            logger.debug(f"Request headers: {headers}")
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Request headers: %s", headers)
+            logger.debug("Target URL: %s", target_url)
+            headers = NGSI_LD_Utils.check_headers(headers)
+            response = upstream.get(target_url, headers=headers, params=request.args.to_dict())
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error fetching Quantum Lead entity attribute values: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @quantum_lead_blueprint.route('/api/quantum/v2/entities/<entity_id>/attrs/<attr_name>/value', methods=['GET'])
@@ -409,15 +708,15 @@ class Quantum_Lead_Endpoints:
             logger.debug("Processing request for get_entity_attribute_last_value endpoint")
             target_url = f"{os.environ.get('QUANTUM_LEAP_URL')}/v2/entities/{entity_id}/attrs/{attr_name}/value"
             headers = request.headers
-            logger.debug(f"Request headers: {headers}")
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Request headers: %s", headers)
+            logger.debug("Target URL: %s", target_url)
+            headers = NGSI_LD_Utils.check_headers(headers)
+            response = upstream.get(target_url, headers=headers)
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error fetching Quantum Lead entity attribute last value: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @quantum_lead_blueprint.route('/api/quantum/v2/entities/<entity_id>/attrs', methods=['GET'])
@@ -427,40 +726,257 @@ class Quantum_Lead_Endpoints:
             logger.debug("Processing request for get_entity_attributes endpoint")
             target_url = f"{os.environ.get('QUANTUM_LEAP_URL')}/v2/entities/{entity_id}/attrs"
             headers = request.headers
-            logger.debug(f"Request headers: {headers}")
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Request headers: %s", headers)
+            logger.debug("Target URL: %s", target_url)
+            headers = NGSI_LD_Utils.check_headers(headers)
+            response = upstream.get(target_url, headers=headers)
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error fetching Quantum Lead entity attributes: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @quantum_lead_blueprint.route('/api/quantum/v2/entities/<entity_id>', methods=['GET'])
-    def get_entity_values(self, entity_id):
+    def get_entity_values(entity_id):
         """Fetches all values for all attributes of an entity from Quantum Lead"""
         try:
             logger.debug("Processing request for get_entity_values endpoint")
             target_url = f"{os.environ.get('QUANTUM_LEAP_URL')}/v2/entities/{entity_id}"
             headers = request.headers
-            logger.debug(f"Request headers: {headers}")
-            logger.debug(f"Target URL: {target_url}")
-            NGSI_LD_Utils.check_headers(headers)
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Request headers: %s", headers)
+            logger.debug("Target URL: %s", target_url)
+            headers = NGSI_LD_Utils.check_headers(headers)
+            response = upstream.get(target_url, headers=headers, params=request.args.to_dict())
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error fetching Quantum Lead entity values: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
+
+    @staticmethod
+    def get_downsample_options():
+        """Read buckets/method from the query string and return (buckets, method, start, end, upstream params)"""
+        buckets = int(request.args.get('buckets', QUANTUM_LEAP_DOWNSAMPLE_BUCKETS))
+        if buckets < 1 or buckets > QUANTUM_LEAP_DOWNSAMPLE_MAX_BUCKETS:
+            raise ValueError(f"buckets must be between 1 and {QUANTUM_LEAP_DOWNSAMPLE_MAX_BUCKETS}")
+        method = request.args.get('method', 'lttb')
+        if method not in timeseries.DOWNSAMPLE_METHODS:
+            raise ValueError(f"method must be one of {', '.join(timeseries.DOWNSAMPLE_METHODS)}")
+
+        # fromDate/toDate/lastN and any other Quantum Lead options are forwarded upstream
+        params = {key: value for key, value in request.args.items() if key not in ('buckets', 'method')}
+        start = timeseries.parse_timestamp(params['fromDate']) if 'fromDate' in params else None
+        end = timeseries.parse_timestamp(params['toDate']) if 'toDate' in params else None
+        return buckets, method, start, end, params
+
+    @staticmethod
+    @quantum_lead_blueprint.route('/api/quantum/v2/entities/<entity_id>/attrs/<attr_name>/downsample', methods=['GET'])
+    def get_entity_attribute_downsampled(entity_id, attr_name):
+        """Fetches time series values for an entity attribute and downsamples them server-side"""
+        try:
+            logger.debug("Processing request for get_entity_attribute_downsampled endpoint")
+            try:
+                buckets, method, start, end, params = Quantum_Lead_Endpoints.get_downsample_options()
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+            target_url = f"{os.environ.get('QUANTUM_LEAP_URL')}/v2/entities/{entity_id}/attrs/{attr_name}"
+            logger.debug("Target URL: %s", target_url)
+            headers = NGSI_LD_Utils.check_headers(request.headers)
+            response = upstream.get(target_url, headers=headers, params=params)
+            logger.debug("Response status code: %s", response.status_code)
+            if response.status_code != 200:
+                return make_upstream_response(response)
+
+            data = response.json()
+            index = data.get('index', [])
+            try:
+                values = timeseries.to_float(data.get('values', []))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 422
+            result = timeseries.downsample(timeseries.parse_index(index), values, buckets, method, start, end)
+
+            return jsonify({
+                'entityId': data.get('entityId', entity_id),
+                'attrName': data.get('attrName', attr_name),
+                'method': method,
+                'buckets': buckets,
+                'sourcePoints': len(index),
+                **result
+            }), 200
+        except Exception as e:
+            logger.error(f"Error downsampling Quantum Lead entity attribute values: {str(e)}")
+            return NGSI_LD_Utils.error_response(e)
+
+    @staticmethod
+    @quantum_lead_blueprint.route('/api/quantum/v2/entities/<entity_id>/downsample', methods=['GET'])
+    def get_entity_downsampled(entity_id):
+        """Fetches all attribute values of an entity and downsamples each numeric attribute server-side"""
+        try:
+            logger.debug("Processing request for get_entity_downsampled endpoint")
+            try:
+                buckets, method, start, end, params = Quantum_Lead_Endpoints.get_downsample_options()
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+            target_url = f"{os.environ.get('QUANTUM_LEAP_URL')}/v2/entities/{entity_id}"
+            logger.debug("Target URL: %s", target_url)
+            headers = NGSI_LD_Utils.check_headers(request.headers)
+            response = upstream.get(target_url, headers=headers, params=params)
+            logger.debug("Response status code: %s", response.status_code)
+            if response.status_code != 200:
+                return make_upstream_response(response)
+
+            data = response.json()
+            index = data.get('index', [])
+            times = timeseries.parse_index(index)
+            attributes = []
+            skipped = []
+            for attribute in data.get('attributes', []):
+                try:
+                    values = timeseries.to_float(attribute.get('values', []))
+                except ValueError:
+                    skipped.append(attribute.get('attrName'))
+                    continue
+                attributes.append({
+                    'attrName': attribute.get('attrName'),
+                    **timeseries.downsample(times, values, buckets, method, start, end)
+                })
+
+            return jsonify({
+                'entityId': data.get('entityId', entity_id),
+                'method': method,
+                'buckets': buckets,
+                'sourcePoints': len(index),
+                'attributes': attributes,
+                'skippedAttributes': skipped
+            }), 200
+        except Exception as e:
+            logger.error(f"Error downsampling Quantum Lead entity values: {str(e)}")
+            return NGSI_LD_Utils.error_response(e)
+
+    @staticmethod
+    @quantum_lead_blueprint.route('/api/quantum/v2/entities/<entity_id>/attrs/<attr_name>/tiles', methods=['GET'])
+    def get_entity_attribute_tiles(entity_id, attr_name):
+        """Fetches an attribute history range through the tile cache (resolution in seconds, 0 for raw)"""
+        try:
+            logger.debug("Processing request for get_entity_attribute_tiles endpoint")
+            try:
+                if 'fromDate' not in request.args:
+                    raise ValueError("fromDate is required")
+                start = timeseries.parse_timestamp(request.args['fromDate'])
+                end = timeseries.parse_timestamp(request.args['toDate']) if 'toDate' in request.args else int(time.time() * 1000)
+                resolution = int(request.args.get('resolution', '0'))
+                if resolution < 0 or end < start:
+                    raise ValueError("resolution must be >= 0 and toDate must not be before fromDate")
+                span = TileCache.tile_span_ms(resolution)
+                if end // span - start // span + 1 > TILE_MAX_PER_REQUEST:
+                    raise ValueError(f"Requested range spans more than {TILE_MAX_PER_REQUEST} tiles, use a coarser resolution")
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+            headers = NGSI_LD_Utils.check_headers(request.headers)
+            try:
+                times, values, fetched, cached = quantum_lead_tile_cache.get_range(
+                    os.environ.get('QUANTUM_LEAP_URL'), entity_id, attr_name, headers, start, end, resolution)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 422
+            logger.debug("Tiles fetched: %s, served from cache: %s", fetched, cached)
+
+            return jsonify({
+                'entityId': entity_id,
+                'attrName': attr_name,
+                'resolution': resolution,
+                'tiles': {'fetched': fetched, 'cached': cached},
+                'index': timeseries.format_index(times),
+                'values': values.tolist()
+            }), 200
+        except Exception as e:
+            logger.error(f"Error fetching Quantum Lead attribute tiles: {str(e)}")
+            return NGSI_LD_Utils.error_response(e)
+
+    @staticmethod
+    def fetch_attribute_history(base_url, entity_id, attr_name, headers, params):
+        """Fetch one attribute history from Quantum Lead; safe to run outside the request context"""
+        target_url = f"{base_url}/v2/entities/{entity_id}/attrs/{attr_name}"
+        try:
+            response = upstream.get(target_url, headers=headers, params=params)
+            if response.status_code == 404:
+                return {'entityId': entity_id, 'attrName': attr_name, 'index': [], 'values': []}
+            if response.status_code != 200:
+                return {'entityId': entity_id, 'attrName': attr_name, 'status': response.status_code,
+                        'error': response.text}
+            data = response.json()
+            return {'entityId': entity_id, 'attrName': attr_name,
+                    'index': data.get('index', []), 'values': data.get('values', [])}
+        except Exception as e:
+            return {'entityId': entity_id, 'attrName': attr_name, 'status': getattr(e, 'status_code', 502), 'error': str(e)}
+
+    @staticmethod
+    def align_series(series):
+        """Align several histories on a shared time index, filling gaps with null"""
+        times = [timeseries.parse_index(item['index']) for item in series]
+        index = np.unique(np.concatenate(times)) if times else np.empty(0, dtype=np.int64)
+        columns = []
+        for item, item_times in zip(series, times):
+            aligned = np.full(index.size, None, dtype=object)
+            aligned[np.searchsorted(index, item_times)] = np.array(item['values'], dtype=object)
+            columns.append({'entityId': item['entityId'], 'attrName': item['attrName'], 'values': aligned.tolist()})
+        return timeseries.format_index(index), columns
+
+    @staticmethod
+    @quantum_lead_blueprint.route('/api/quantum/v2/history', methods=['GET'])
+    def get_multi_entity_history():
+        """
+        Fetches the history of several entities/attributes concurrently from Quantum Lead.
+        Query: id=<comma separated ids>, attrs=<comma separated attributes>, format=columns|ndjson,
+        plus fromDate/toDate/lastN/aggrMethod/aggrPeriod which are forwarded upstream.
+        """
+        try:
+            logger.debug("Processing request for get_multi_entity_history endpoint")
+            entity_ids = [value for value in request.args.get('id', '').split(',') if value]
+            attr_names = [value for value in request.args.get('attrs', '').split(',') if value]
+            output_format = request.args.get('format', 'columns')
+            if not entity_ids or not attr_names:
+                return jsonify({'error': 'id and attrs query parameters are required'}), 400
+            if len(entity_ids) * len(attr_names) > QUANTUM_LEAP_HISTORY_MAX_SERIES:
+                return jsonify({'error': f"At most {QUANTUM_LEAP_HISTORY_MAX_SERIES} series can be requested at once"}), 400
+            if output_format not in ('columns', 'ndjson'):
+                return jsonify({'error': 'format must be columns or ndjson'}), 400
+
+            params = {key: value for key, value in request.args.items() if key not in ('id', 'attrs', 'format')}
+            headers = NGSI_LD_Utils.check_headers(request.headers)
+            base_url = os.environ.get('QUANTUM_LEAP_URL')
+            futures = [
+                quantum_lead_executor.submit(tracing.wrap(Quantum_Lead_Endpoints.fetch_attribute_history),
+                                             base_url, entity_id, attr_name, headers, params)
+                for entity_id in entity_ids for attr_name in attr_names
+            ]
+            logger.debug("Fetching %s series from Quantum Lead", len(futures))
+
+            if output_format == 'ndjson':
+                def generate():
+                    for future in as_completed(futures):
+                        yield json.dumps(future.result(), separators=(',', ':')) + '\n'
+                return Response(generate(), mimetype='application/x-ndjson')
+
+            results = [future.result() for future in futures]
+            series = [item for item in results if 'error' not in item]
+            errors = [item for item in results if 'error' in item]
+            index, columns = Quantum_Lead_Endpoints.align_series(series)
+            return jsonify({'index': index, 'columns': columns, 'errors': errors}), 200
+        except Exception as e:
+            logger.error(f"Error fetching Quantum Lead multi-entity history: {str(e)}")
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @quantum_lead_blueprint.route('/api/quantum/v2/entities', methods=['OPTIONS'])
     @quantum_lead_blueprint.route('/api/quantum/v2/types', methods=['OPTIONS'])
+    @quantum_lead_blueprint.route('/api/quantum/v2/history', methods=['OPTIONS'])
     @quantum_lead_blueprint.route('/api/quantum/v2/types/<path:subpath>', methods=['OPTIONS'])
     @quantum_lead_blueprint.route('/api/quantum/v2/entities/<path:subpath>', methods=['OPTIONS'])
-    def handle_options(self, subpath=None):
+    def handle_options(subpath=None):
         """Handles OPTIONS requests for Quantum Lead endpoints (CORS preflight)"""
         response = make_response()
         response.headers.add('Access-Control-Allow-Origin', '*')
@@ -475,19 +991,48 @@ class Data_Product_Endpoints:
     @staticmethod
     @data_product_blueprint.route('/api/dataProducts', methods=['GET'])
     def get_all_data_products():
-        """Fetch all data products"""
+        """Fetch all data products (served from the in-process catalog)"""
         try:
             logger.debug("Processing request for get_all_data_products endpoint")
-            target_url = f"{os.environ.get('DATA_PRODUCT_URL')}/dataProducts"
-            headers = {'Accept': 'application/json'}
-            logger.debug(f"Target URL: {target_url}")
-            logger.debug(f"Request headers: {headers}")
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            if data_product_catalog.is_fresh():
+                state = 'hit'
+            else:
+                state = 'miss' if data_product_catalog.loaded_at is None else 'stale'
+            data_product_catalog.ensure_loaded()
+            return ResponseCache.make_response(data_product_catalog.response, state)
         except Exception as e:
             logger.error(f"Error fetching all data products: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
+
+    @staticmethod
+    @data_product_blueprint.route('/api/dataProducts/search', methods=['GET'])
+    def search_data_products():
+        """
+        Search the data-product catalog. Query parameters: q (full text over name, tags,
+        glossary terms, owner and description), tag and glossary_term (repeatable, all must
+        match), owner, page and page_size.
+        """
+        try:
+            logger.debug("Processing request for search_data_products endpoint")
+            try:
+                page = int(request.args.get('page', 1))
+                page_size = int(request.args.get('page_size', DATA_PRODUCT_SEARCH_PAGE_SIZE))
+            except ValueError:
+                return jsonify({'error': 'page and page_size must be integers'}), 400
+            data_product_catalog.ensure_loaded()
+            result = data_product_catalog.search(
+                text=request.args.get('q'),
+                tags=request.args.getlist('tag'),
+                glossary_terms=request.args.getlist('glossary_term'),
+                owner=request.args.get('owner'),
+                page=page,
+                page_size=page_size
+            )
+            logger.debug("Search matched %s data products", result['total'])
+            return jsonify(result)
+        except Exception as e:
+            logger.error(f"Error searching data products: {str(e)}")
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @data_product_blueprint.route('/api/dataProducts/<data_product_id>', methods=['GET'])
@@ -497,42 +1042,55 @@ class Data_Product_Endpoints:
             logger.debug("Processing request for get_data_product endpoint")
             target_url = f"{os.environ.get('DATA_PRODUCT_URL')}/dataProducts/{data_product_id}"
             headers = {'Accept': 'application/json'}
-            logger.debug(f"Target URL: {target_url}")
-            logger.debug(f"Request headers: {headers}")
-            response = requests.get(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            logger.debug("Request headers: %s", headers)
+            response = upstream.get(target_url, headers=headers)
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error fetching data product {data_product_id}: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @data_product_blueprint.route('/api/dataProducts', methods=['POST'])
     def create_data_product():
-        """Create a new data product"""
+        """
+        Create a new data product. JSON and multipart bodies are relayed to the data-product
+        manager as they arrive, without parsing or buffering the form and its files.
+        """
         try:
             logger.debug("Processing request for create_data_product endpoint")
+            content_length = request.content_length
+            if content_length is not None and content_length > DATA_PRODUCT_MAX_UPLOAD_BYTES:
+                upload_stats.reject()
+                return jsonify({'error': f"Upload exceeds {DATA_PRODUCT_MAX_UPLOAD_BYTES} bytes"}), 413
+
             if request.content_type and request.content_type.startswith('multipart/form-data'):
-                files = {}
-                data = {}
-                for key in request.form:
-                    data[key] = request.form[key]
-                for file_key in request.files:
-                    files[file_key] = request.files[file_key]
-                logger.debug(f"Form data: {data}")
-                logger.debug(f"Files: {files}")
-                response = requests.post(f"{os.environ.get('DATA_PRODUCT_URL')}/dataProducts", data=data, files=files)
+                # Keep the client's boundary so the body can be forwarded byte for byte
+                headers = {'Content-Type': request.content_type, 'Accept': 'application/json'}
             else:
-                payload = request.get_json(force=True)
                 headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
-                logger.debug(f"Payload: {payload}")
-                logger.debug(f"Request headers: {headers}")
-                response = requests.post(f"{os.environ.get('DATA_PRODUCT_URL')}/dataProducts", json=payload, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Relaying %s byte %s body", content_length, headers['Content-Type'])
+
+            body = RequestBodyStream(request.stream, content_length)
+            try:
+                response = upstream.request('POST', f"{os.environ.get('DATA_PRODUCT_URL')}/dataProducts",
+                                            data=body, headers=headers)
+            except UploadTooLarge as e:
+                body.finish(False)
+                upload_stats.reject()
+                return jsonify({'error': str(e)}), 413
+            except Exception:
+                body.finish(False)
+                raise
+            body.finish(response.status_code < 400)
+            if response.status_code < 400:
+                data_product_catalog.invalidate()
+            logger.debug("Response status code: %s", response.status_code)
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error creating data product: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @data_product_blueprint.route('/api/dataProducts', methods=['DELETE'])
@@ -542,14 +1100,15 @@ class Data_Product_Endpoints:
             logger.debug("Processing request for delete_all_data_products endpoint")
             target_url = f"{os.environ.get('DATA_PRODUCT_URL')}/dataProducts"
             headers = {'Accept': 'application/json'}
-            logger.debug(f"Target URL: {target_url}")
-            logger.debug(f"Request headers: {headers}")
-            response = requests.delete(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            logger.debug("Request headers: %s", headers)
+            response = upstream.request('DELETE', target_url, headers=headers)
+            logger.debug("Response status code: %s", response.status_code)
+            data_product_catalog.invalidate()
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error deleting all data products: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
     @staticmethod
     @data_product_blueprint.route('/api/dataProducts/<data_product_id>', methods=['DELETE'])
@@ -559,13 +1118,14 @@ class Data_Product_Endpoints:
             logger.debug("Processing request for delete_data_product endpoint")
             target_url = f"{os.environ.get('DATA_PRODUCT_URL')}/dataProducts/{data_product_id}"
             headers = {'Accept': 'application/json'}
-            logger.debug(f"Target URL: {target_url}")
-            logger.debug(f"Request headers: {headers}")
-            response = requests.delete(target_url, headers=headers)
-            logger.debug(f"Response status code: {response.status_code}")
-            return make_response(response.content, response.status_code)
+            logger.debug("Target URL: %s", target_url)
+            logger.debug("Request headers: %s", headers)
+            response = upstream.request('DELETE', target_url, headers=headers)
+            logger.debug("Response status code: %s", response.status_code)
+            data_product_catalog.invalidate()
+            return make_upstream_response(response)
         except Exception as e:
             logger.error(f"Error deleting data product {data_product_id}: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+            return NGSI_LD_Utils.error_response(e)
 
 blueprints = [ngsi_ld_blueprint, quantum_lead_blueprint, data_product_blueprint]
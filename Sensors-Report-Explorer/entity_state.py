@@ -0,0 +1,422 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import make_response
+
+import upstream
+from keycloak_auth import get_keycloak_auth
+from subscription_manager import subscription_manager, CONTEXT_BROKER_URL
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+LIVE_ENTITY_CACHE_ENABLED = os.environ.get('LIVE_ENTITY_CACHE_ENABLED', 'true').lower() in ('true', 't', '1', 'yes')
+# Entities kept per tenant (least recently used are evicted first)
+LIVE_ENTITY_CACHE_MAX_ENTRIES = int(os.environ.get('LIVE_ENTITY_CACHE_MAX_ENTRIES', '5000'))
+# Interval of the sweep that re-reads every subscribed type from Orion-LD to correct drift (0 disables)
+LIVE_ENTITY_RECONCILE_SECONDS = int(os.environ.get('LIVE_ENTITY_RECONCILE_SECONDS', '300'))
+LIVE_ENTITY_RECONCILE_PAGE_SIZE = int(os.environ.get('LIVE_ENTITY_RECONCILE_PAGE_SIZE', '1000'))
+# How long Orion-LD's answer on whether a token may read a tenant's entity type is reused
+# (never past the token's expiry) before reads from memory ask again
+LIVE_ENTITY_ACCESS_TTL_SECONDS = int(os.environ.get('LIVE_ENTITY_ACCESS_TTL_SECONDS', '60'))
+LIVE_ENTITY_ACCESS_MAX_ENTRIES = int(os.environ.get('LIVE_ENTITY_ACCESS_MAX_ENTRIES', '4096'))
+
+# Cached entities are compacted with the core context (shared subscriptions are created without a Link)
+CORE_CONTEXT = 'https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context'
+# Query parameters a read may carry and still be answered from memory
+ENTITY_READ_PARAMS = {'attrs', 'options', 'local'}
+ENTITY_QUERY_PARAMS = {'type', 'attrs', 'options', 'local', 'limit', 'offset', 'count'}
+# Orion-LD's default and largest page size
+DEFAULT_QUERY_LIMIT = 20
+MAX_QUERY_LIMIT = 1000
+
+
+def entity_types(entity):
+    entity_type = entity.get('type')
+    return entity_type if isinstance(entity_type, list) else [entity_type]
+
+
+def simplify(entity):
+    """Convert a normalized entity to its keyValues representation"""
+    def simplify_attribute(attribute):
+        if not isinstance(attribute, dict):
+            return attribute
+        if attribute.get('type') == 'Relationship':
+            return attribute.get('object')
+        if attribute.get('type') == 'LanguageProperty':
+            return attribute.get('languageMap')
+        return attribute.get('value', attribute)
+
+    result = {}
+    for name, value in entity.items():
+        if name in ('id', 'type', '@context'):
+            result[name] = value
+        elif isinstance(value, list):
+            result[name] = [simplify_attribute(instance) for instance in value]
+        else:
+            result[name] = simplify_attribute(value)
+    return result
+
+
+class LiveEntityCache:
+    """
+    Current state of the entities watched through shared subscriptions, partitioned by tenant.
+    Notifications of the shared subscriptions replace the entities they carry, plain reads
+    from Orion-LD seed it, and a periodic sweep re-reads each subscribed type to correct drift
+    (entities deleted outside the Explorer, missed notifications). Reads are answered from
+    memory only while a shared subscription notifies every change of what they ask for, and
+    only to callers whose token is valid and whom Orion-LD lets read that tenant and type.
+    """
+
+    def __init__(self, max_entries=LIVE_ENTITY_CACHE_MAX_ENTRIES, broker_url=CONTEXT_BROKER_URL):
+        self.max_entries = max_entries
+        self.broker_url = broker_url
+        self._lock = threading.Lock()
+        # tenant -> OrderedDict(entity id -> (entity, updated_at, dirty))
+        self._tenants = {}
+        # (tenant, type) pairs whose entities are all in memory
+        self._complete = set()
+        self._pending = set()
+        # (token digest, tenant, type) -> (allowed, expires_at)
+        self._access = OrderedDict()
+        self._wake = threading.Event()
+        self._worker = None
+        self._worker_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.applied = 0
+        self.evictions = 0
+        self.access_checks = 0
+        self.reconciliations = 0
+        self.drift = 0
+        self.errors = 0
+
+    # ---- state ----
+
+    def _store(self, tenant, entity, since=None):
+        """Store a full normalized entity unless a newer copy arrived since the read that produced it"""
+        entity_id = entity.get('id')
+        if not entity_id:
+            return
+        with self._lock:
+            entries = self._tenants.setdefault(tenant, OrderedDict())
+            current = entries.get(entity_id)
+            if since is not None and current is not None and current[1] > since:
+                return
+            entries[entity_id] = (entity, time.monotonic(), False)
+            entries.move_to_end(entity_id)
+            while len(entries) > self.max_entries:
+                _, (evicted, _, _) = entries.popitem(last=False)
+                self.evictions += 1
+                for entity_type in entity_types(evicted):
+                    self._complete.discard((tenant, entity_type))
+
+    def _drop_type(self, tenant, entity_type):
+        with self._lock:
+            self._complete.discard((tenant, entity_type))
+            entries = self._tenants.get(tenant, {})
+            for entity_id in [entity_id for entity_id, (entity, _, _) in entries.items()
+                              if entity_type in entity_types(entity)]:
+                del entries[entity_id]
+
+    def written(self, headers, entity_id, entity_type=None, deleted=False):
+        """
+        Record a write made through the Explorer. The entity is marked dirty, so it and the
+        lists of its type are read from Orion-LD until the write's notification, a fallback
+        read or the next reconciliation brings it up to date. A deleted entity is dropped.
+        """
+        if not entity_id:
+            return
+        tenant = headers.get('NGSILD-Tenant') or ''
+        with self._lock:
+            entries = self._tenants.get(tenant)
+            current = entries.get(entity_id) if entries is not None else None
+            if deleted:
+                if current is not None:
+                    del entries[entity_id]
+            elif current is not None:
+                # Stamped now so reads that started before the write cannot clear it
+                entries[entity_id] = (current[0], time.monotonic(), True)
+            elif entity_type and (tenant, entity_type) in self._complete:
+                # A new entity of a complete type: keep lists off memory until it arrives
+                entries[entity_id] = ({'id': entity_id, 'type': entity_type}, time.monotonic(), True)
+
+    # ---- subscription observer ----
+
+    def subscription_notified(self, subscription, notification):
+        for entity in notification.get('data') or ():
+            if isinstance(entity, dict):
+                self._store(subscription.tenant, entity)
+                self.applied += 1
+
+    def subscription_activated(self, subscription):
+        active = subscription_manager.active_subscriptions(subscription.tenant, subscription.entity_type)
+        if active == [subscription]:
+            # Changes made while the type was not subscribed were missed: start from a fresh read
+            self._drop_type(subscription.tenant, subscription.entity_type)
+        self.schedule(subscription.tenant, subscription.entity_type)
+
+    def subscription_released(self, subscription):
+        if not subscription_manager.active_subscriptions(subscription.tenant, subscription.entity_type):
+            self._drop_type(subscription.tenant, subscription.entity_type)
+
+    # ---- reads ----
+
+    @staticmethod
+    def _servable(headers, args, allowed):
+        """Only plain JSON reads with the core context, in one tenant scope, are answered from memory"""
+        if not LIVE_ENTITY_CACHE_ENABLED or set(args) - allowed:
+            return False
+        if any(headers.get(name) for name in ('NGSILD-Path', 'Fiware-Service', 'Fiware-ServicePath')):
+            return False
+        link = headers.get('Link')
+        if link and CORE_CONTEXT not in link:
+            return False
+        accept = headers.get('Accept') or 'application/json'
+        if 'application/json' not in accept and '*/*' not in accept:
+            return False
+        return args.get('options', 'normalized') in ('normalized', 'keyValues', 'simplified')
+
+    def _authorized(self, headers, tenant, entity_type):
+        """
+        True when the caller's bearer token validates locally and Orion-LD lets it read the
+        tenant's entities of this type; the broker's answer is cached per token, tenant and type
+        """
+        scheme, _, token = (headers.get('Authorization') or '').partition(' ')
+        if scheme.lower() != 'bearer' or not token:
+            return False
+        try:
+            claims = get_keycloak_auth().validate_token(token)
+        except Exception as e:
+            logger.debug("Not serving live entities to an invalid token: %s", e)
+            return False
+        if not claims.get('active'):
+            return False
+
+        now = time.time()
+        key = (hashlib.sha256(token.encode('utf-8')).digest(), tenant, entity_type)
+        with self._lock:
+            entry = self._access.get(key)
+            if entry is not None and entry[1] > now:
+                self._access.move_to_end(key)
+                return entry[0]
+        self.access_checks += 1
+        error = subscription_manager.check_access(tenant, entity_type, headers)
+        if error is not None and error[0] not in (401, 403):
+            # The broker could not answer: let the read go to it rather than remember anything
+            return False
+        expires_at = min(claims.get('exp') or now, now + LIVE_ENTITY_ACCESS_TTL_SECONDS)
+        with self._lock:
+            self._access[key] = (error is None, expires_at)
+            self._access.move_to_end(key)
+            while len(self._access) > LIVE_ENTITY_ACCESS_MAX_ENTRIES:
+                self._access.popitem(last=False)
+        return error is None
+
+    @staticmethod
+    def _render(entity, args):
+        attrs = [name for name in args.get('attrs', '').split(',') if name]
+        if attrs:
+            entity = {name: value for name, value in entity.items() if name in ('id', 'type') or name in attrs}
+        if args.get('options') in ('keyValues', 'simplified'):
+            entity = simplify(entity)
+        return entity
+
+    @staticmethod
+    def _respond(body, headers=None):
+        response = make_response(json.dumps(body, separators=(',', ':')), 200)
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['X-Cache'] = 'LIVE'
+        for name, value in (headers or {}).items():
+            response.headers[name] = value
+        return response
+
+    def read_entity(self, headers, entity_id, args):
+        """Return a response for GET /entities/{id} from memory, or None when Orion-LD must answer"""
+        if not self._servable(headers, args, ENTITY_READ_PARAMS):
+            return None
+        tenant = headers.get('NGSILD-Tenant') or ''
+        attrs = [name for name in args.get('attrs', '').split(',') if name]
+        with self._lock:
+            current = self._tenants.get(tenant, {}).get(entity_id)
+        covering = [entity_type for entity_type in entity_types(current[0])
+                    if subscription_manager.covers(tenant, entity_type, attrs)] if current is not None else []
+        if not covering or current[2] or not self._authorized(headers, tenant, covering[0]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._respond(self._render(current[0], args))
+
+    def query_entities(self, headers, args):
+        """Return a response for GET /entities?type=... from memory, or None when Orion-LD must answer"""
+        entity_type = args.get('type')
+        if not entity_type or ',' in entity_type or not self._servable(headers, args, ENTITY_QUERY_PARAMS):
+            return None
+        try:
+            limit = int(args.get('limit', DEFAULT_QUERY_LIMIT))
+            offset = int(args.get('offset', 0))
+        except ValueError:
+            return None
+        if limit < 0 or limit > MAX_QUERY_LIMIT or offset < 0:
+            return None
+        tenant = headers.get('NGSILD-Tenant') or ''
+        attrs = [name for name in args.get('attrs', '').split(',') if name]
+        with self._lock:
+            complete = (tenant, entity_type) in self._complete
+            entries = [(entity, dirty) for entity, _, dirty in self._tenants.get(tenant, {}).values()
+                       if entity_type in entity_types(entity)] if complete else []
+        if (not complete or any(dirty for _, dirty in entries) or not subscription_manager.covers(tenant, entity_type, attrs)
+                or not self._authorized(headers, tenant, entity_type)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        entities = sorted((entity for entity, _ in entries), key=lambda entity: entity['id'])
+        page = [self._render(entity, args) for entity in entities[offset:offset + limit]]
+        count = {'NGSILD-Results-Count': str(len(entities))} if args.get('count') == 'true' else None
+        return self._respond(page, count)
+
+    def learn(self, headers, args, response, since):
+        """Seed the cache from a plain (full, normalized) Orion-LD read of subscribed entities"""
+        if response.status_code != 200 or set(args) - {'type', 'limit', 'offset', 'local', 'count'}:
+            return
+        if not self._servable(headers, {}, ENTITY_READ_PARAMS):
+            return
+        tenant = headers.get('NGSILD-Tenant') or ''
+        try:
+            body = response.json()
+        except ValueError:
+            return
+        for entity in body if isinstance(body, list) else [body]:
+            if isinstance(entity, dict) and any(subscription_manager.covers(tenant, entity_type)
+                                                for entity_type in entity_types(entity)):
+                self._store(tenant, entity, since)
+
+    @staticmethod
+    def clock():
+        return time.monotonic()
+
+    # ---- reconciliation ----
+
+    def reconcile(self, tenant, entity_type):
+        """Re-read every entity of a subscribed type and replace what memory holds for it"""
+        headers = subscription_manager.broker_headers(tenant, entity_type)
+        if headers is None:
+            return
+        started = time.monotonic()
+        target_url = f"{self.broker_url}/ngsi-ld/v1/entities"
+        fetched = {}
+        offset = 0
+        while True:
+            response = upstream.get(target_url, headers=headers,
+                                    params={'type': entity_type, 'limit': LIVE_ENTITY_RECONCILE_PAGE_SIZE, 'offset': offset})
+            if response.status_code != 200:
+                raise RuntimeError(f"Orion-LD returned {response.status_code}: {response.text[:200]}")
+            page = response.json()
+            for entity in page:
+                fetched[entity.get('id')] = entity
+            if len(page) < LIVE_ENTITY_RECONCILE_PAGE_SIZE:
+                break
+            offset += len(page)
+        if len(fetched) > self.max_entries:
+            logger.warning(f"{len(fetched)} {entity_type} entities exceed LIVE_ENTITY_CACHE_MAX_ENTRIES; "
+                           f"queries of this type keep going to Orion-LD")
+            return
+
+        drift = 0
+        with self._lock:
+            # The first read of a type only loads it; later differences are corrections
+            was_complete = (tenant, entity_type) in self._complete
+            entries = self._tenants.setdefault(tenant, OrderedDict())
+            for entity_id, (entity, updated_at, _) in list(entries.items()):
+                if entity_type in entity_types(entity) and entity_id not in fetched and updated_at < started:
+                    del entries[entity_id]
+                    drift += 1
+            for entity_id, entity in fetched.items():
+                current = entries.get(entity_id)
+                if current is not None and current[1] > started:
+                    # A notification newer than this read already updated it
+                    continue
+                if current is None or current[2] or current[0] != entity:
+                    drift += 1
+        for entity in fetched.values():
+            self._store(tenant, entity, started)
+        with self._lock:
+            if len(self._tenants.get(tenant, {})) <= self.max_entries:
+                self._complete.add((tenant, entity_type))
+        self.reconciliations += 1
+        if not was_complete:
+            return
+        self.drift += drift
+        if drift:
+            logger.info(f"Reconciled {entity_type} entities of tenant '{tenant}': {drift} corrected")
+
+    def schedule(self, tenant, entity_type):
+        """Ask the background worker to reconcile a type soon"""
+        if not LIVE_ENTITY_CACHE_ENABLED:
+            return
+        with self._lock:
+            self._pending.add((tenant, entity_type))
+        self.start()
+        self._wake.set()
+
+    def start(self):
+        """Start the reconciliation worker in this process (after a fork it is started again)"""
+        if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name='entity-reconcile', daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        next_sweep = time.monotonic() + LIVE_ENTITY_RECONCILE_SECONDS
+        while True:
+            self._wake.wait(max(next_sweep - time.monotonic(), 0) if LIVE_ENTITY_RECONCILE_SECONDS else None)
+            self._wake.clear()
+            with self._lock:
+                pending, self._pending = self._pending, set()
+            if LIVE_ENTITY_RECONCILE_SECONDS and time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + LIVE_ENTITY_RECONCILE_SECONDS
+                with self._lock:
+                    pending |= {(tenant, entity_type) for tenant, entries in self._tenants.items()
+                                for entity, _, _ in entries.values() for entity_type in entity_types(entity)}
+                    pending |= self._complete
+            for tenant, entity_type in pending:
+                if not subscription_manager.covers(tenant, entity_type, ()):
+                    # Only fully subscribed types can be kept complete; partial ones are served per entity
+                    continue
+                try:
+                    self.reconcile(tenant, entity_type)
+                except Exception as e:
+                    self.errors += 1
+                    logger.warning(f"Reconciling {entity_type} entities of tenant '{tenant}' failed: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            entries = sum(len(tenant_entries) for tenant_entries in self._tenants.values())
+            tenants = len(self._tenants)
+            complete_types = len(self._complete)
+        return {
+            'entries': entries,
+            'tenants': tenants,
+            'complete_types': complete_types,
+            'hits': self.hits,
+            'misses': self.misses,
+            'applied': self.applied,
+            'evictions': self.evictions,
+            'access_checks': self.access_checks,
+            'reconciliations': self.reconciliations,
+            'drift': self.drift,
+            'errors': self.errors
+        }
+
+
+live_entity_cache = LiveEntityCache()
+subscription_manager.observe(live_entity_cache)
@@ -1,15 +1,154 @@
 import requests
 import os
 import logging
-from flask import Flask, request, jsonify, session, redirect
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+import jwt
+from requests.adapters import HTTPAdapter
+from flask import Blueprint, request, jsonify, session, redirect
+
+import metrics
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your-secret-key')
+# Blueprint for the Keycloak callback/token/refresh routes, registered by the backend app
+auth_blueprint = Blueprint('auth', __name__)
+
+# OIDC discovery document; endpoints found there override the individual URL settings
+KEYCLOAK_DISCOVERY_URL = os.environ.get('KEYCLOAK_DISCOVERY_URL', 'https://keycloak.sensorsreport.net/realms/sr/.well-known/openid-configuration')
+KEYCLOAK_HTTP_TIMEOUT = float(os.environ.get('KEYCLOAK_HTTP_TIMEOUT', '10'))
+KEYCLOAK_MAX_WORKERS = int(os.environ.get('KEYCLOAK_MAX_WORKERS', '4'))
+
+# Local JWT validation settings
+KEYCLOAK_JWKS_URL = os.environ.get('KEYCLOAK_JWKS_URL', 'https://keycloak.sensorsreport.net/realms/sr/protocol/openid-connect/certs')
+KEYCLOAK_ISSUER = os.environ.get('KEYCLOAK_ISSUER', 'https://keycloak.sensorsreport.net/realms/sr')
+KEYCLOAK_AUDIENCE = os.environ.get('KEYCLOAK_AUDIENCE', '')
+KEYCLOAK_JWT_ALGORITHMS = os.environ.get('KEYCLOAK_JWT_ALGORITHMS', 'RS256').split(',')
+# Refresh the JWKS every JWKS_REFRESH_SECONDS; keep using the last good key set for up to JWKS_MAX_STALE_SECONDS
+JWKS_REFRESH_SECONDS = int(os.environ.get('JWKS_REFRESH_SECONDS', '300'))
+JWKS_MAX_STALE_SECONDS = int(os.environ.get('JWKS_MAX_STALE_SECONDS', '3600'))
+JWKS_MIN_REFETCH_SECONDS = 10
+JWKS_FETCH_TIMEOUT_SECONDS = 5
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get('TOKEN_CACHE_MAX_ENTRIES', '4096'))
+JWT_LEEWAY_SECONDS = int(os.environ.get('JWT_LEEWAY_SECONDS', '30'))
+
+class JWKSCache:
+    """
+    Keycloak signing keys, refreshed periodically and kept through short Keycloak outages.
+    One fetch runs at a time and never under the lock: a stale key set is refreshed in the
+    background while callers keep using it, and only callers needing a key the set does not
+    have yet (first use, key rotation) wait for the fetch in flight.
+    """
+
+    def __init__(self, jwks_url, http_session=None):
+        self.jwks_url = jwks_url
+        self.http_session = http_session or requests.Session()
+        self._keys = {}
+        self._fetched_at = 0.0
+        self._attempted_at = 0.0
+        # Set when the fetch in flight completes; None while no fetch runs
+        self._fetching = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            response = self.http_session.get(self.jwks_url, timeout=JWKS_FETCH_TIMEOUT_SECONDS)
+            response.raise_for_status()
+            key_set = jwt.PyJWKSet.from_dict(response.json())
+            keys = {key.key_id: key for key in key_set.keys}
+            with self._lock:
+                self._keys = keys
+                self._fetched_at = time.monotonic()
+            logger.debug("Loaded %s signing keys from %s", len(keys), self.jwks_url)
+        except Exception as e:
+            logger.warning(f"Could not refresh JWKS from {self.jwks_url}: {str(e)}")
+        finally:
+            with self._lock:
+                fetching, self._fetching = self._fetching, None
+            fetching.set()
+
+    def get_signing_key(self, kid):
+        """Return the signing key for kid, or None when no usable key set is available"""
+        now = time.monotonic()
+        fetch = False
+        with self._lock:
+            key = self._keys.get(kid)
+            fetching = self._fetching
+            if (fetching is None and (key is None or now - self._fetched_at > JWKS_REFRESH_SECONDS)
+                    and now - self._attempted_at > JWKS_MIN_REFETCH_SECONDS):
+                self._attempted_at = now
+                fetching = self._fetching = threading.Event()
+                fetch = True
+
+        if key is not None:
+            if fetch:
+                threading.Thread(target=self._refresh, name='jwks-refresh', daemon=True).start()
+        elif fetching is not None:
+            if fetch:
+                self._refresh()
+            else:
+                fetching.wait(JWKS_FETCH_TIMEOUT_SECONDS)
+            with self._lock:
+                key = self._keys.get(kid)
+
+        if time.monotonic() - self._fetched_at > JWKS_REFRESH_SECONDS + JWKS_MAX_STALE_SECONDS:
+            return None
+        return key
+
+    def is_available(self):
+        return bool(self._keys) and time.monotonic() - self._fetched_at <= JWKS_REFRESH_SECONDS + JWKS_MAX_STALE_SECONDS
+
+
+class TokenCache:
+    """Bounded LRU of validated token claims, kept until the token expires"""
+
+    def __init__(self, max_entries=TOKEN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, claims):
+        expires_at = claims.get('exp')
+        if not expires_at:
+            return
+        with self._lock:
+            self._entries[self._key(token)] = (claims, expires_at)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
 
 class KeycloakAuth:
+    """
+    Keycloak client configuration and token operations. Build it once per process with
+    get_keycloak_auth(); it keeps a pooled HTTP session, the JWKS and the token cache.
+    """
+
     def __init__(self):
         self.auth_url = os.environ.get('KEYCLOAK_AUTH_URL', 'https://keycloak.sensorsreport.net/realms/sr/protocol/openid-connect/auth')
         self.token_url = os.environ.get('KEYCLOAK_TOKEN_URL', 'https://keycloak.sensorsreport.net/realms/sr/protocol/openid-connect/token')
@@ -18,138 +157,287 @@ class KeycloakAuth:
         self.client_id = os.environ.get('KEYCLOAK_CLIENT_ID', 'ContextBroker')
         self.client_secret = os.environ.get('KEYCLOAK_CLIENT_SECRET', '')
         self.redirect_uri = os.environ.get('REDIRECT_URI', 'https://explorer.sensorsreport.net/api/auth/callback')
+        self.introspect_url = os.environ.get('KEYCLOAK_INTROSPECT_URL', f"{self.token_url}/introspect")
+        self.jwks_url = KEYCLOAK_JWKS_URL
+        self.issuer = KEYCLOAK_ISSUER
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        metrics.instrument_session(self.session)
+        self.executor = ThreadPoolExecutor(max_workers=KEYCLOAK_MAX_WORKERS, thread_name_prefix='keycloak')
+        self.token_cache = TokenCache()
+        self.jwks_cache = JWKSCache(self.jwks_url, self.session)
+        self._discovery_lock = threading.Lock()
+        self._discovery_done = threading.Event()
+        self._discovery_pid = None
+        self._build_login_url()
+
+    def _build_login_url(self):
+        """Precompute everything in the login redirect except the per-request state"""
+        self.login_url_base = f"{self.auth_url}?" + urlencode({
+            'client_id': self.client_id,
+            'response_type': 'code',
+            'redirect_uri': self.redirect_uri,
+            'scope': 'openid profile email'
+        })
+
+    def preload(self, discovery_url=KEYCLOAK_DISCOVERY_URL):
+        """
+        Run OIDC discovery in a background thread so startup (e.g. the gunicorn master) never
+        waits on Keycloak; the configured endpoints are used until it finishes. Started again
+        in a forked worker whose parent had not finished it.
+        """
+        with self._discovery_lock:
+            if self._discovery_done.is_set() or self._discovery_pid == os.getpid():
+                return
+            self._discovery_pid = os.getpid()
+        if not discovery_url:
+            self._discovery_done.set()
+            return
+
+        def worker():
+            try:
+                self.discover(discovery_url)
+            finally:
+                self._discovery_done.set()
+
+        threading.Thread(target=worker, name='oidc-discovery', daemon=True).start()
+
+    def ensure_discovered(self):
+        """Wait (at most KEYCLOAK_HTTP_TIMEOUT) for OIDC discovery before an endpoint is used"""
+        if self._discovery_done.is_set():
+            return
+        self.preload()
+        if not self._discovery_done.wait(KEYCLOAK_HTTP_TIMEOUT):
+            logger.warning("OIDC discovery still running, using configured endpoints")
+
+    def discover(self, discovery_url=KEYCLOAK_DISCOVERY_URL):
+        """Load the endpoints from the OIDC discovery document, keeping the configured ones on failure"""
+        if not discovery_url:
+            return False
+        try:
+            response = self.session.get(discovery_url, timeout=KEYCLOAK_HTTP_TIMEOUT)
+            response.raise_for_status()
+            config = response.json()
+        except Exception as e:
+            logger.warning(f"OIDC discovery from {discovery_url} failed, using configured endpoints: {str(e)}")
+            return False
+
+        self.auth_url = config.get('authorization_endpoint', self.auth_url)
+        self.token_url = config.get('token_endpoint', self.token_url)
+        self.userinfo_url = config.get('userinfo_endpoint', self.userinfo_url)
+        self.logout_url = config.get('end_session_endpoint', self.logout_url)
+        self.introspect_url = config.get('introspection_endpoint', self.introspect_url)
+        self.jwks_url = self.jwks_cache.jwks_url = config.get('jwks_uri', self.jwks_url)
+        self.issuer = config.get('issuer', self.issuer)
+        self._build_login_url()
+        logger.info(f"Loaded OIDC configuration from {discovery_url}")
+        return True
+
+    def login_url(self, state):
+        """Return the Keycloak login redirect URL for a CSRF state value"""
+        self.ensure_discovered()
+        return f"{self.login_url_base}&{urlencode({'state': state})}"
+
+    def _token_request(self, data):
+        self.ensure_discovered()
+        data = dict(data, client_id=self.client_id, client_secret=self.client_secret)
+        response = self.session.post(self.token_url, data=data, timeout=KEYCLOAK_HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
 
     def get_token(self, username, password):
         """Get a JWT token for a user"""
         try:
-            url = f"{self.server_url}/realms/{self.realm}/protocol/openid-connect/token"
-            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-            data = {
-                'grant_type': 'password',
-                'client_id': self.client_id,
-                'client_secret': self.client_secret,
-                'username': username,
-                'password': password
-            }
-            response = requests.post(url, headers=headers, data=data)
-            response.raise_for_status()
-            token_info = response.json()
+            token_info = self._token_request({'grant_type': 'password', 'username': username, 'password': password})
             return token_info['access_token']
         except Exception as e:
             raise Exception(f"Failed to obtain token from Keycloak: {str(e)}")
 
+    def exchange_code(self, code):
+        """Exchange an authorization code for tokens"""
+        return self._token_request({'grant_type': 'authorization_code', 'code': code, 'redirect_uri': self.redirect_uri})
+
+    def refresh(self, refresh_token):
+        """Exchange a refresh token for new tokens"""
+        return self._token_request({'grant_type': 'refresh_token', 'refresh_token': refresh_token})
+
+    def exchange_code_async(self, code):
+        """Like exchange_code, but returns a concurrent.futures.Future (usable with asyncio.wrap_future)"""
+        return self.executor.submit(self.exchange_code, code)
+
+    def refresh_async(self, refresh_token):
+        """Like refresh, but returns a concurrent.futures.Future (usable with asyncio.wrap_future)"""
+        return self.executor.submit(self.refresh, refresh_token)
+
+    def introspect_token_async(self, token):
+        """Like introspect_token, but returns a concurrent.futures.Future (usable with asyncio.wrap_future)"""
+        return self.executor.submit(self.introspect_token, token)
+
     def validate_token(self, token):
-        """Validate a JWT token"""
+        """
+        Validate a JWT token. Signatures are verified locally against the cached JWKS and
+        the claims are cached until the token expires; token introspection is only used
+        when no signing keys are available.
+        """
+        claims = self.token_cache.get(token)
+        if claims is not None:
+            return claims
+        # Discovery may change the issuer and the JWKS URL
+        self.ensure_discovered()
+
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.InvalidTokenError as e:
+            raise Exception(f"Invalid token: {str(e)}")
+
+        signing_key = self.jwks_cache.get_signing_key(header.get('kid'))
+        if signing_key is None:
+            if self.jwks_cache.is_available():
+                raise Exception("Invalid token: unknown signing key")
+            return self.introspect_token(token)
+
         try:
-            url = f"{self.server_url}/realms/{self.realm}/protocol/openid-connect/token/introspect"
-            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-            data = {'token': token}
-            response = requests.post(url, headers=headers, data=data)
+            claims = jwt.decode(
+                token,
+                signing_key.key,
+                algorithms=KEYCLOAK_JWT_ALGORITHMS,
+                audience=KEYCLOAK_AUDIENCE or None,
+                issuer=self.issuer or None,
+                leeway=JWT_LEEWAY_SECONDS,
+                options={'verify_aud': bool(KEYCLOAK_AUDIENCE), 'require': ['exp']}
+            )
+        except jwt.InvalidTokenError as e:
+            raise Exception(f"Invalid token: {str(e)}")
+
+        claims['active'] = True
+        self.token_cache.put(token, claims)
+        return claims
+
+    def introspect_token(self, token):
+        """Validate a token with the Keycloak introspection endpoint"""
+        self.ensure_discovered()
+        try:
+            data = {'token': token, 'client_id': self.client_id, 'client_secret': self.client_secret}
+            response = self.session.post(self.introspect_url, data=data, timeout=KEYCLOAK_HTTP_TIMEOUT)
             response.raise_for_status()
             token_info = response.json()
+            if token_info.get('active'):
+                self.token_cache.put(token, token_info)
             return token_info
         except Exception as e:
             raise Exception(f"Failed to validate token with Keycloak: {str(e)}")
-    @app.route('/api/auth/callback', methods=['GET'])
-    def keycloak_callback():
-        logger.debug('Received callback request from Keycloak')
 
-        # Extract query parameters
-        code = request.args.get('code')
-        state = request.args.get('state')
 
-        logger.debug(f'Received code: {code}')
-        logger.debug(f'Received state: {state}')
+_keycloak_auth = None
+_keycloak_auth_lock = threading.Lock()
 
-        if not code or not state:
-            logger.error('Missing code or state in callback request')
-            return jsonify({'error': 'Missing code or state'}), 400
+def get_keycloak_auth():
+    """Return the process-wide KeycloakAuth, creating it (and starting OIDC discovery) on first use"""
+    global _keycloak_auth
+    if _keycloak_auth is None:
+        with _keycloak_auth_lock:
+            if _keycloak_auth is None:
+                keycloak = KeycloakAuth()
+                keycloak.preload()
+                _keycloak_auth = keycloak
+    return _keycloak_auth
 
-        try:
-            # Exchange authorization code for tokens
-            keycloak = KeycloakAuth()
-            token_url = keycloak.token_url
-            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-            data = {
-                'grant_type': 'authorization_code',
-                'client_id': keycloak.client_id,
-                'client_secret': keycloak.client_secret,
-                'code': code,
-                'redirect_uri': keycloak.redirect_uri
-            }
-
-            logger.debug(f'Sending token request to {token_url} with data: {data}')
-            response = requests.post(token_url, headers=headers, data=data)
-            response.raise_for_status()
 
-            token_response = response.json()
-            logger.debug(f'Token response: {token_response}')
+@auth_blueprint.route('/api/auth/callback', methods=['GET'])
+def keycloak_callback():
+    logger.debug('Received callback request from Keycloak')
 
-            # Store tokens in session
-            session['access_token'] = token_response.get('access_token')
-            session['refresh_token'] = token_response.get('refresh_token')
-            session['expires_in'] = token_response.get('expires_in')
+    # Extract query parameters
+    code = request.args.get('code')
+    state = request.args.get('state')
 
-            # Redirect to index.html on success, including the code in the URL as a query parameter
-            return redirect(f"/index.html?code={code}&state={state}")
-    
-        except requests.exceptions.RequestException as e:
-            logger.error(f'Error during token exchange: {str(e)}')
-            return jsonify({'error': 'Token exchange failed', 'details': str(e)}), 500
-        except Exception as e:
-            logger.error(f'Unexpected error: {str(e)}')
-            return jsonify({'error': 'Unexpected error occurred', 'details': str(e)}), 500
+    logger.debug("Received code: %s", code)
+    logger.debug("Received state: %s", state)
 
-    @app.route('/api/auth/token', methods=['GET', 'POST'])
-    def get_token():
-        """Retrieve the access token securely"""
-        try:
-            # Ensure the session contains the access token
-            access_token = session.get('access_token')
-            if not access_token:
-                return jsonify({'error': 'No access token found in session'}), 401
+    if not code or not state:
+        logger.error('Missing code or state in callback request')
+        return jsonify({'error': 'Missing code or state'}), 400
 
-            # Return the access token securely
-            return jsonify({'access_token': access_token}), 200
-        except Exception as e:
-            logger.error(f"Failed to retrieve access token: {str(e)}")
-            return jsonify({'error': str(e)}), 500
+    try:
+        # Exchange authorization code for tokens
+        token_response = get_keycloak_auth().exchange_code(code)
+        logger.debug('Token exchange succeeded')
 
-    @app.route('/api/auth/refresh', methods=['GET', 'POST'])
-    def refresh_token():
-        """Refresh the access token using the refresh token"""
-        try:
-            # Ensure the session contains the refresh token
-            refresh_token = session.get('refresh_token')
-            if not refresh_token:
-                return jsonify({'error': 'No refresh token found in session'}), 401
-
-            # Exchange the refresh token for a new access token
-            keycloak = KeycloakAuth()
-            token_url = keycloak.token_url
-            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-            data = {
-                'grant_type': 'refresh_token',
-                'client_id': keycloak.client_id,
-                'client_secret': keycloak.client_secret,
-                'refresh_token': refresh_token
-            }
-
-            response = requests.post(token_url, headers=headers, data=data)
-            response.raise_for_status()
+        # Store tokens in session
+        session['access_token'] = token_response.get('access_token')
+        session['refresh_token'] = token_response.get('refresh_token')
+        session['expires_in'] = token_response.get('expires_in')
 
-            token_response = response.json()
-            logger.debug(f"Token refresh response: {token_response}")
+        # Track the session server-side so its tokens are refreshed before they expire. Login moves
+        # the session to new ids, so ids handed out before it (session fixation) lead nowhere
+        from token_manager import get_token_manager
+        token_manager = get_token_manager()
+        if session.get('sid'):
+            token_manager.remove(session['sid'])
+        if hasattr(session, 'regenerate'):
+            session.regenerate()
+        session['sid'] = token_manager.register(token_response)
 
-            # Update session with new tokens
-            session['access_token'] = token_response.get('access_token')
-            session['refresh_token'] = token_response.get('refresh_token')
-            session['expires_in'] = token_response.get('expires_in')
+        # Redirect to index.html on success, including the code in the URL as a query parameter
+        return redirect(f"/index.html?code={code}&state={state}")
 
-            return jsonify({'access_token': token_response.get('access_token')}), 200
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error during token refresh: {str(e)}")
-            return jsonify({'error': 'Token refresh failed', 'details': str(e)}), 500
-        except Exception as e:
-            logger.error(f"Unexpected error: {str(e)}")
-            return jsonify({'error': 'Unexpected error occurred', 'details': str(e)}), 500
+    except requests.exceptions.RequestException as e:
+        logger.error(f'Error during token exchange: {str(e)}')
+        return jsonify({'error': 'Token exchange failed', 'details': str(e)}), 500
+    except Exception as e:
+        logger.error(f'Unexpected error: {str(e)}')
+        return jsonify({'error': 'Unexpected error occurred', 'details': str(e)}), 500
+
+@auth_blueprint.route('/api/auth/token', methods=['GET', 'POST'])
+def get_token():
+    """Retrieve the access token securely"""
+    try:
+        # Prefer the server-side tracked token, which is refreshed proactively
+        from token_manager import get_token_manager
+        access_token = get_token_manager().current_access_token() or session.get('access_token')
+        if not access_token:
+            return jsonify({'error': 'No access token found in session'}), 401
+
+        # Return the access token securely
+        return jsonify({'access_token': access_token}), 200
+    except Exception as e:
+        logger.error(f"Failed to retrieve access token: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@auth_blueprint.route('/api/auth/refresh', methods=['GET', 'POST'])
+def refresh_token():
+    """Refresh the access token using the refresh token"""
+    try:
+        # Ensure the session contains the refresh token
+        refresh_token = session.get('refresh_token')
+        if not refresh_token:
+            return jsonify({'error': 'No refresh token found in session'}), 401
+
+        # Sessions tracked server-side share any refresh already in flight
+        from token_manager import get_token_manager
+        token_manager = get_token_manager()
+        future = token_manager.refresh(session['sid']) if session.get('sid') else None
+        if future is not None:
+            access_token = future.result()
+            session['access_token'] = access_token
+            return jsonify({'access_token': access_token}), 200
+
+        # Exchange the refresh token for a new access token
+        token_response = get_keycloak_auth().refresh(refresh_token)
+        logger.debug('Token refresh succeeded')
+
+        # Update session with new tokens
+        session['access_token'] = token_response.get('access_token')
+        session['refresh_token'] = token_response.get('refresh_token')
+        session['expires_in'] = token_response.get('expires_in')
+
+        return jsonify({'access_token': token_response.get('access_token')}), 200
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error during token refresh: {str(e)}")
+        return jsonify({'error': 'Token refresh failed', 'details': str(e)}), 500
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}")
+        return jsonify({'error': 'Unexpected error occurred', 'details': str(e)}), 500
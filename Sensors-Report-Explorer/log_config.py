@@ -0,0 +1,180 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+
+from flask import request
+
+import tracing
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# text: human-readable lines | json: one JSON object per line for log shippers
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+# Records waiting for the writer thread; beyond this they are dropped instead of blocking requests
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+# Fraction of requests whose DEBUG/INFO records are kept, per route: "/api/notifications=0.1,..."
+# Warnings and errors are always kept.
+LOG_SAMPLE_RATES = {
+    route.strip(): float(rate)
+    for route, _, rate in (item.partition('=') for item in os.environ.get('LOG_SAMPLE_RATES', '').split(','))
+    if route.strip() and rate
+}
+LOG_SAMPLE_DEFAULT_RATE = float(os.environ.get('LOG_SAMPLE_DEFAULT_RATE', '1'))
+
+REDACTED = '[REDACTED]'
+# Secrets in header dumps, token responses and query strings
+SECRET_PATTERN = re.compile(
+    r"""(?i)((?:authorization|cookie|set-cookie|access_token|refresh_token|id_token|client_secret|password|secret_key|x-notification-secret)"""
+    r"""['"]?\s*[:=]\s*['"]?)(?:bearer\s+|basic\s+)?[^'"\s,;&}]+""")
+JWT_PATTERN = re.compile(r'eyJ[\w-]+\.[\w-]+\.[\w-]+')
+
+_log_sampled = contextvars.ContextVar('log_sampled', default=True)
+
+
+def redact(message):
+    if 'ey' in message:
+        message = JWT_PATTERN.sub(REDACTED, message)
+    return SECRET_PATTERN.sub(lambda match: match.group(1) + REDACTED, message)
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Runs in the request thread: drops DEBUG/INFO records of unsampled requests and stamps
+    the current trace id so the writer thread can emit it.
+    """
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING and not _log_sampled.get():
+            return False
+        span = tracing.current_span()
+        record.trace_id = span.trace_id if span is not None else None
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks. Only the message arguments are merged in the request
+    thread; timestamps, JSON encoding and redaction are left to the writer thread.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Runs after the level and sampling checks. The arguments may be mutated once the call
+        # returns (or belong to a finished request), so the message is snapshotted now.
+        record.msg = record.getMessage()
+        record.args = None
+        # Tracebacks reference live frames, so they are rendered now as well
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record):
+        return redact(super().format(record))
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with secrets redacted"""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': redact(record.getMessage()),
+            'thread': record.threadName
+        }
+        if getattr(record, 'trace_id', None):
+            entry['trace_id'] = record.trace_id
+        if record.exc_text:
+            entry['exc'] = redact(record.exc_text)
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+_handler = None
+_listener = None
+
+
+def configure_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    """
+    Route all logging through a bounded queue to a single writer thread, so request threads
+    only pay for the level check and an enqueue. Replaces any handlers set up before.
+    """
+    global _handler, _listener
+    if log_format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = RedactingFormatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(formatter)
+
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    _handler.addFilter(RequestContextFilter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(getattr(logging, level, logging.INFO))
+
+    if _listener is not None:
+        _listener.stop()
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=False)
+    _listener.start()
+
+
+@atexit.register
+def _flush():
+    # Write out whatever is still queued when the process exits
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def after_fork():
+    """Restart the writer thread in a forked worker (threads do not survive fork)"""
+    global _listener
+    if _listener is not None:
+        # The parent's queue lock may have been held by its writer thread at fork time
+        _handler.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _listener = logging.handlers.QueueListener(_handler.queue, *_listener.handlers)
+        _listener.start()
+
+
+def stats():
+    return {'queued': _handler.queue.qsize() if _handler else 0, 'dropped': _handler.dropped if _handler else 0}
+
+
+def _before_request():
+    if not LOG_SAMPLE_RATES and LOG_SAMPLE_DEFAULT_RATE >= 1:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else None
+    rate = LOG_SAMPLE_RATES.get(route, LOG_SAMPLE_DEFAULT_RATE)
+    _log_sampled.set(rate >= 1 or random.random() < rate)
+
+
+def _teardown_request(error):
+    _log_sampled.set(True)
+
+
+def init_app(app):
+    """Enable per-route sampling of DEBUG/INFO records"""
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+
@@ -0,0 +1,255 @@
+import logging
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from urllib.parse import urlparse
+
+from flask import request, g, Response
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('true', 't', '1', 'yes')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Upstream services are labelled by name instead of host:port
+UPSTREAM_SERVICE_URLS = (
+    ('orion-ld', 'CONTEXT_BROKER_URL'),
+    ('quantumleap', 'QUANTUM_LEAP_URL'),
+    ('data-product-manager', 'DATA_PRODUCT_URL'),
+    ('keycloak', 'KEYCLOAK_SERVER_URL')
+)
+
+
+class _Shard:
+    """Per-thread metric values; only the owning thread writes, scrapes read"""
+
+    __slots__ = ('counters', 'histograms', '__weakref__')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms recorded into per-thread shards, so the hot path takes no lock.
+    Shards are merged when /metrics is scraped; shards of finished threads are folded into
+    a retired shard so short-lived request threads do not accumulate.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = _Shard()
+        self._help = {}
+        self._collectors = []
+        self._gauges = {}
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+        return shard
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            # Bucket counts (non-cumulative, last one is +Inf), then sum
+            histogram = histograms[key] = [buckets] + [0] * (len(buckets) + 1) + [0.0]
+        histogram[1 + bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def gauge_add(self, name, labels=(), value=1):
+        with self._lock:
+            self._gauges[(name, labels)] = self._gauges.get((name, labels), 0) + value
+
+    def register_collector(self, prefix, collect, labels=()):
+        """
+        Register a function returning a dict of numbers (e.g. a cache's stats()); each value is
+        exported as the gauge <prefix>_<key> when /metrics is scraped. Lists are exported as their length,
+        and stats with hits and misses also get a <prefix>_hit_ratio.
+        """
+        self._collectors.append((prefix, collect, labels))
+
+    @staticmethod
+    def _merge(target, shard):
+        for key, value in list(shard.counters.items()):
+            target.counters[key] = target.counters.get(key, 0) + value
+        for key, histogram in list(shard.histograms.items()):
+            merged = target.histograms.get(key)
+            if merged is None:
+                target.histograms[key] = list(histogram)
+            else:
+                for i in range(1, len(histogram)):
+                    merged[i] += histogram[i]
+
+    def snapshot(self):
+        """Merge all shards, retiring those of finished threads"""
+        merged = _Shard()
+        with self._lock:
+            alive = []
+            for thread_ref, shard in self._shards:
+                thread = thread_ref()
+                if thread is None or not thread.is_alive():
+                    self._merge(self._retired, shard)
+                else:
+                    alive.append((thread_ref, shard))
+            self._shards = alive
+            self._merge(merged, self._retired)
+            gauges = dict(self._gauges)
+        for _, shard in alive:
+            self._merge(merged, shard)
+        return merged, gauges
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        merged, gauges = self.snapshot()
+        families = {}
+
+        for (name, labels), value in merged.counters.items():
+            families.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+
+        for (name, labels), histogram in merged.histograms.items():
+            lines = families.setdefault(name, [])
+            buckets, counts, total = histogram[0], histogram[1:-1], histogram[-1]
+            cumulative = 0
+            for bound, count in zip(buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+
+        for (name, labels), value in gauges.items():
+            families.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+
+        for prefix, collect, labels in self._collectors:
+            try:
+                stats = collect()
+            except Exception as e:
+                logger.warning(f"Metrics collector {prefix} failed: {str(e)}")
+                continue
+            for key, value in stats.items():
+                if isinstance(value, (list, tuple, set, dict)):
+                    value = len(value)
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                families.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+            if 'hits' in stats and 'misses' in stats:
+                hits = sum(stats.get(key, 0) for key in ('hits', 'stale_hits', 'disk_hits'))
+                lookups = hits + stats['misses']
+                name = f"{prefix}_hit_ratio"
+                families.setdefault(name, []).append(f"{name}{format_labels(labels)} {hits / lookups if lookups else 0}")
+
+        output = []
+        for name in sorted(families):
+            kind, help_text = self._help.get(name, ('gauge', None))
+            if help_text:
+                output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(families[name])
+        return '\n'.join(output) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels) + '}'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = MetricsRegistry()
+registry.describe('explorer_http_requests_total', 'counter', 'Requests served by the Explorer backend')
+registry.describe('explorer_http_request_duration_seconds', 'histogram', 'Time to produce the response (time to first byte for streams)')
+registry.describe('explorer_http_response_size_bytes', 'histogram', 'Response body sizes of buffered responses')
+registry.describe('explorer_upstream_requests_total', 'counter', 'Requests sent to upstream services')
+registry.describe('explorer_upstream_request_duration_seconds', 'histogram', 'Upstream time until response headers')
+registry.describe('explorer_sse_subscribers', 'gauge', 'Connected Server-Sent Events clients')
+
+_upstream_names = {}
+
+
+def upstream_name(url):
+    """Name of the upstream service a URL belongs to"""
+    netloc = urlparse(url).netloc
+    name = _upstream_names.get(netloc)
+    if name is None:
+        name = netloc
+        for service, variable in UPSTREAM_SERVICE_URLS:
+            if urlparse(os.environ.get(variable) or '').netloc == netloc:
+                name = service
+                break
+        _upstream_names[netloc] = name
+    return name
+
+
+def record_upstream_response(response, *args, **kwargs):
+    """requests response hook counting upstream calls and their latency"""
+    labels = (('upstream', upstream_name(response.url)), ('method', response.request.method))
+    registry.inc('explorer_upstream_requests_total', labels + (('status', str(response.status_code)),))
+    registry.observe('explorer_upstream_request_duration_seconds', labels,
+                     response.elapsed.total_seconds(), LATENCY_BUCKETS)
+
+
+def record_upstream_error(method, url):
+    """Count an upstream call that failed before a response arrived"""
+    registry.inc('explorer_upstream_requests_total',
+                 (('upstream', upstream_name(url)), ('method', method), ('status', 'error')))
+
+
+def instrument_session(session):
+    """Record every request sent through a requests session"""
+    session.hooks['response'].append(record_upstream_response)
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+
+
+def _after_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    labels = (('route', route), ('method', request.method))
+    registry.inc('explorer_http_requests_total', labels + (('status', str(response.status_code)),))
+    registry.observe('explorer_http_request_duration_seconds', labels, time.perf_counter() - started, LATENCY_BUCKETS)
+    if not response.is_streamed:
+        registry.observe('explorer_http_response_size_bytes', labels, response.calculate_content_length() or 0, SIZE_BUCKETS)
+    return response
+
+
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """Record request metrics and expose them on /metrics"""
+    if not METRICS_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
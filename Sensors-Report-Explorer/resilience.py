@@ -0,0 +1,210 @@
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+
+def parse_overrides(value):
+    """Parse per-upstream overrides such as "quantumleap=60,orion-ld=10" into a dict"""
+    return {
+        name.strip(): float(setting)
+        for name, _, setting in (item.partition('=') for item in (value or '').split(','))
+        if name.strip() and setting
+    }
+
+
+# Time to establish an upstream connection, and to wait for each read once connected
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '3.05'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', '30'))
+UPSTREAM_READ_TIMEOUT_OVERRIDES = parse_overrides(os.environ.get('UPSTREAM_READ_TIMEOUT_OVERRIDES'))
+# Bulkhead: concurrent calls per upstream (per worker), so one slow upstream cannot hold every request thread
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', '8'))
+UPSTREAM_MAX_CONCURRENCY_OVERRIDES = parse_overrides(os.environ.get('UPSTREAM_MAX_CONCURRENCY_OVERRIDES'))
+# How long a call may wait for a free bulkhead slot before it is rejected
+UPSTREAM_BULKHEAD_WAIT_SECONDS = float(os.environ.get('UPSTREAM_BULKHEAD_WAIT_SECONDS', '2'))
+# Consecutive failures (timeouts, connection errors, 502/503/504) that open the circuit
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', '5'))
+# How long an open circuit fails fast before a single trial call is let through
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.environ.get('CIRCUIT_BREAKER_RESET_SECONDS', '30'))
+
+# Upstream statuses that count as the upstream being unavailable
+FAILURE_STATUSES = (502, 503, 504)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class UpstreamUnavailable(Exception):
+    """An upstream call was refused or failed because the upstream is unavailable (served as 503)"""
+
+    status_code = 503
+
+    def __init__(self, upstream, message, retry_after=1):
+        super().__init__(message)
+        self.upstream = upstream
+        self.retry_after = max(int(math.ceil(retry_after)), 1)
+
+
+class UpstreamGuard:
+    """
+    Timeouts, a bulkhead and a circuit breaker for one upstream service.
+    The breaker opens after CIRCUIT_BREAKER_FAILURE_THRESHOLD consecutive failures and
+    fails calls immediately; after CIRCUIT_BREAKER_RESET_SECONDS one trial call is let
+    through (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name, read_timeout=None, max_concurrency=None,
+                 failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_BREAKER_RESET_SECONDS):
+        self.name = name
+        if read_timeout is None:
+            read_timeout = UPSTREAM_READ_TIMEOUT_OVERRIDES.get(name, UPSTREAM_READ_TIMEOUT)
+        if max_concurrency is None:
+            max_concurrency = int(UPSTREAM_MAX_CONCURRENCY_OVERRIDES.get(name, UPSTREAM_MAX_CONCURRENCY))
+        self.timeout = (UPSTREAM_CONNECT_TIMEOUT, read_timeout)
+        self.max_concurrency = max_concurrency
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.opened_at = None
+        self.consecutive_failures = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.short_circuited = 0
+        self.rejected = 0
+        self.opened = 0
+
+    def retry_after(self):
+        if self.state == CLOSED or self.opened_at is None:
+            return 1
+        return self.reset_seconds - (time.monotonic() - self.opened_at)
+
+    def _admit(self):
+        """Check the circuit; returns True when this call is the half-open trial"""
+        with self._lock:
+            if self.state == CLOSED:
+                return False
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = HALF_OPEN
+                logger.info("Circuit for %s half-open, sending a trial call", self.name)
+                return True
+            self.short_circuited += 1
+        raise UpstreamUnavailable(self.name, f"{self.name} is unavailable (circuit open)", self.retry_after())
+
+    def _record(self, ok, trial):
+        with self._lock:
+            if ok:
+                if self.state != CLOSED:
+                    logger.info("Circuit for %s closed", self.name)
+                self.state = CLOSED
+                self.consecutive_failures = 0
+                return
+            self.failures += 1
+            self.consecutive_failures += 1
+            if trial or (self.state == CLOSED and self.consecutive_failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.opened += 1
+                logger.warning("Circuit for %s opened after %s consecutive failures; failing fast for %ss",
+                               self.name, self.consecutive_failures, self.reset_seconds)
+
+    @contextmanager
+    def call(self):
+        """
+        Guard one upstream call. The body must call record_status() with the response
+        status; timeouts and connection errors are raised as UpstreamUnavailable.
+        """
+        trial = self._admit()
+        if not self._slots.acquire(timeout=UPSTREAM_BULKHEAD_WAIT_SECONDS):
+            self.rejected += 1
+            if trial:
+                # Let the next caller run the trial instead
+                with self._lock:
+                    self.state = OPEN
+            raise UpstreamUnavailable(self.name, f"{self.name} is busy ({self.max_concurrency} calls in flight)")
+        with self._lock:
+            self.in_flight += 1
+            self.calls += 1
+        outcome = _Outcome()
+        try:
+            yield outcome
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            if isinstance(e, requests.exceptions.Timeout):
+                self.timeouts += 1
+            self._record(False, trial)
+            raise UpstreamUnavailable(self.name, f"{self.name} did not respond: {str(e)}", self.retry_after()) from e
+        except Exception:
+            # Not the upstream's fault (e.g. an oversized upload): count nothing, but let
+            # the next caller run the trial again
+            if trial:
+                with self._lock:
+                    self.state = OPEN
+            raise
+        else:
+            self._record(outcome.status_code not in FAILURE_STATUSES, trial)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def stats(self):
+        return {
+            'state': STATE_VALUES[self.state],
+            'in_flight': self.in_flight,
+            'max_concurrency': self.max_concurrency,
+            'calls': self.calls,
+            'failures': self.failures,
+            'timeouts': self.timeouts,
+            'short_circuited': self.short_circuited,
+            'rejected': self.rejected,
+            'opened': self.opened
+        }
+
+
+class _Outcome:
+    __slots__ = ('status_code',)
+
+    def __init__(self):
+        self.status_code = None
+
+    def record_status(self, status_code):
+        self.status_code = status_code
+
+
+_guards = {}
+_guards_lock = threading.Lock()
+
+
+def get_guard(name):
+    """Return the guard of an upstream service, creating it on first use"""
+    guard = _guards.get(name)
+    if guard is None:
+        with _guards_lock:
+            guard = _guards.get(name)
+            if guard is None:
+                guard = _guards[name] = UpstreamGuard(name)
+    return guard
+
+
+def pool_size(name, requested=0):
+    """
+    Worker count of a pool fanning calls out to one upstream: its bulkhead size unless fewer are
+    requested. A larger pool would only have its own calls rejected as busy while the upstream is
+    merely slow; with this size they queue in the pool instead.
+    """
+    limit = get_guard(name).max_concurrency
+    if requested > limit:
+        logger.warning("Fan-out pool for %s limited to its %s bulkhead slots (%s requested)", name, limit, requested)
+    return min(requested, limit) if requested > 0 else limit
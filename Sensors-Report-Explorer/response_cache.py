@@ -0,0 +1,174 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request, make_response
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+# Headers that partition cached responses per tenant
+TENANT_HEADERS = ('NGSILD-Tenant', 'Fiware-Service', 'Fiware-ServicePath')
+# How long past its TTL an entry may still be served when the upstream fails
+RESPONSE_CACHE_STALE_IF_ERROR = int(os.environ.get('RESPONSE_CACHE_STALE_IF_ERROR', '3600'))
+
+
+class CachedResponse:
+    """An upstream response body stored in the cache"""
+
+    __slots__ = ('content', 'status_code', 'content_type', 'etag', 'stored_at', 'ttl')
+
+    def __init__(self, content, status_code, content_type, ttl):
+        self.content = content
+        self.status_code = status_code
+        self.content_type = content_type
+        self.etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        self.stored_at = time.monotonic()
+        self.ttl = ttl
+
+    def age(self):
+        return time.monotonic() - self.stored_at
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache for upstream GET responses with TTLs, ETags,
+    stale-while-revalidate and stale-if-error. Entries are keyed by URL and tenant headers.
+    """
+
+    def __init__(self, name, ttl=60, stale_ttl=300, max_entries=256, stale_if_error=RESPONSE_CACHE_STALE_IF_ERROR):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.stale_if_error = stale_if_error
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._revalidating = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.errors_served_stale = 0
+
+    @staticmethod
+    def make_key(url, headers, params=None):
+        """Build a cache key from the target URL, query parameters and tenant headers"""
+        tenant = tuple((headers.get(name) or '').lower() for name in TENANT_HEADERS)
+        query = tuple(sorted(params.items())) if params else ()
+        return (url, query) + tenant
+
+    def get(self, key):
+        """Return the cached entry for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, content, status_code, content_type, ttl=None):
+        """Store a successful response and evict the least recently used entries"""
+        entry = CachedResponse(content, status_code, content_type, self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, key=None):
+        """Drop one entry, or the whole cache when no key is given"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def get_or_fetch(self, key, fetch, ttl=None):
+        """
+        Return (entry, state) where state is 'hit', 'stale' or 'miss'.
+        fetch() must return (content, status_code, content_type) and must not rely on
+        the Flask request context, since stale entries are revalidated in the background.
+        Non-200 responses are returned uncached. When fetch() fails or returns a 5xx, an
+        expired entry up to stale_if_error seconds past its TTL is served as 'stale' instead.
+        """
+        entry = self.get(key)
+        if entry is not None:
+            age = entry.age()
+            if age < entry.ttl:
+                self.hits += 1
+                return entry, 'hit'
+            if age < entry.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._revalidate(key, fetch, ttl)
+                return entry, 'stale'
+
+        self.misses += 1
+        can_serve_stale = entry is not None and entry.age() < entry.ttl + self.stale_if_error
+        try:
+            fetched = self._fetch(key, fetch, ttl)
+        except Exception as e:
+            if not can_serve_stale:
+                raise
+            self.errors_served_stale += 1
+            logger.warning("Serving stale %s cache entry: %s", self.name, e)
+            return entry, 'stale'
+        if fetched.status_code >= 500 and can_serve_stale:
+            self.errors_served_stale += 1
+            logger.warning("Serving stale %s cache entry: upstream returned %s", self.name, fetched.status_code)
+            return entry, 'stale'
+        return fetched, 'miss'
+
+    def _fetch(self, key, fetch, ttl):
+        content, status_code, content_type = fetch()
+        if status_code == 200:
+            return self.put(key, content, status_code, content_type, ttl)
+        return CachedResponse(content, status_code, content_type, 0)
+
+    def _revalidate(self, key, fetch, ttl):
+        """Refresh a stale entry in a background thread, at most once per key"""
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def worker():
+            try:
+                self._fetch(key, fetch, ttl)
+            except Exception as e:
+                logger.warning(f"Background revalidation failed for {self.name} cache: {str(e)}")
+            finally:
+                with self._lock:
+                    self._revalidating.discard(key)
+
+        threading.Thread(target=worker, name=f"{self.name}-revalidate", daemon=True).start()
+
+    def stats(self):
+        """Return hit/miss counters for monitoring"""
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'errors_served_stale': self.errors_served_stale
+        }
+
+    @staticmethod
+    def make_response(entry, state):
+        """Build a Flask response for a cache entry, honouring If-None-Match"""
+        if entry.status_code != 200:
+            response = make_response(entry.content, entry.status_code)
+        elif request.if_none_match.contains_weak(entry.etag.strip('"')):
+            response = make_response('', 304)
+        else:
+            response = make_response(entry.content, entry.status_code)
+            if entry.content_type:
+                response.headers['Content-Type'] = entry.content_type
+
+        if entry.status_code == 200:
+            response.headers['ETag'] = entry.etag
+            response.headers['Cache-Control'] = f"private, max-age={int(max(entry.ttl - entry.age(), 0))}"
+        response.headers['X-Cache'] = state.upper()
+        return response
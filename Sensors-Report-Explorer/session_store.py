@@ -0,0 +1,283 @@
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+# memory | sqlite | redis
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'memory').lower()
+# Idle lifetime of a session; sessions in use are saved again once half of it has passed
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', '86400'))
+SESSION_SQLITE_PATH = os.environ.get('SESSION_SQLITE_PATH', '/tmp/explorer-sessions.db')
+# Any server speaking the Redis protocol (Redis, Valkey, KeyDB, ...)
+SESSION_REDIS_URL = os.environ.get('SESSION_REDIS_URL', 'redis://localhost:6379/0')
+SESSION_KEY_PREFIX = os.environ.get('SESSION_KEY_PREFIX', 'explorer:session:')
+
+# Stored with the session data: when the session was last written to the store
+SAVED_AT_KEY = '_saved_at'
+
+
+class SessionStore:
+    """Interface of the server-side session stores; values are JSON-serialisable dicts"""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=SESSION_TTL_SECONDS):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=SESSION_TTL_SECONDS):
+        """Store value only if key is absent or expired; returns True when it was stored (usable as a lock)"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def purge_expired(self):
+        """Remove expired entries (stores with native TTLs do nothing)"""
+        return 0
+
+    def after_fork(self):
+        """Drop connections inherited from a parent process"""
+
+
+class MemorySessionStore(SessionStore):
+    """Process-local store; only suitable for a single Explorer replica"""
+
+    PURGE_EVERY = 256
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            return entry[0]
+
+    def set(self, key, value, ttl=SESSION_TTL_SECONDS):
+        with self._lock:
+            self._entries[key] = (json.loads(json.dumps(value)), time.time() + ttl)
+            self._writes += 1
+            purge = self._writes % self.PURGE_EVERY == 0
+        if purge:
+            self.purge_expired()
+
+    def add(self, key, value, ttl=SESSION_TTL_SECONDS):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                return False
+            self._entries[key] = (json.loads(json.dumps(value)), time.time() + ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [key for key, entry in self._entries.items() if entry[1] <= now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+
+class SQLiteSessionStore(SessionStore):
+    """File-backed store, shareable by workers on the same host or volume"""
+
+    PURGE_EVERY = 256
+
+    def __init__(self, path=SESSION_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM sessions WHERE key = ? AND expires_at > ?', (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=SESSION_TTL_SECONDS):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO sessions (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value), time.time() + ttl))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge_expired()
+
+    def add(self, key, value, ttl=SESSION_TTL_SECONDS):
+        connection = self._connection()
+        now = time.time()
+        # One write transaction, so two processes cannot both see the key absent
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM sessions WHERE key = ? AND expires_at <= ?', (key, now))
+            added = connection.execute(
+                'INSERT OR IGNORE INTO sessions (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), now + ttl)).rowcount == 1
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return added
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM sessions WHERE key = ?', (key,))
+
+    def after_fork(self):
+        # SQLite connections must not be used across fork()
+        self._local = threading.local()
+
+    def purge_expired(self):
+        return self._connection().execute('DELETE FROM sessions WHERE expires_at <= ?', (time.time(),)).rowcount
+
+
+class RedisSessionStore(SessionStore):
+    """Store on a Redis-protocol server; lets several Explorer replicas share sessions"""
+
+    def __init__(self, url=SESSION_REDIS_URL, prefix=SESSION_KEY_PREFIX):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SESSION_BACKEND=redis requires the 'redis' package")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value else None
+
+    def set(self, key, value, ttl=SESSION_TTL_SECONDS):
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl)
+
+    def add(self, key, value, ttl=SESSION_TTL_SECONDS):
+        return bool(self.client.set(self.prefix + key, json.dumps(value), ex=ttl, nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def create_session_store(backend=SESSION_BACKEND):
+    """Create the session store selected by SESSION_BACKEND"""
+    if backend == 'sqlite':
+        return SQLiteSessionStore()
+    if backend == 'redis':
+        return RedisSessionStore()
+    if backend != 'memory':
+        logger.warning(f"Unknown SESSION_BACKEND '{backend}', using memory")
+    return MemorySessionStore()
+
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+def get_session_store():
+    """Return the process-wide session store"""
+    global _session_store
+    if _session_store is None:
+        with _session_store_lock:
+            if _session_store is None:
+                _session_store = create_session_store()
+                logger.info(f"Using {type(_session_store).__name__} for server-side sessions")
+    return _session_store
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session data kept in a SessionStore; the cookie only carries the session id"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+        self.saved_at = None
+
+    def regenerate(self):
+        """Move the session to a new id (e.g. at login); the old one is deleted when the session is saved"""
+        if self.previous_sid is None and not self.new:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Flask session interface backed by a SessionStore. The expiry slides: a session used after
+    half of its TTL is saved again, so only sessions idle for the whole TTL expire.
+    """
+
+    def __init__(self, store, ttl=SESSION_TTL_SECONDS):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                session = ServerSideSession({key: value for key, value in data.items() if key != SAVED_AT_KEY}, sid=sid)
+                session.saved_at = data.get(SAVED_AT_KEY)
+                return session
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = time.time()
+        expiring = session.saved_at is None or now - session.saved_at >= self.ttl / 2
+        if not session.modified and not expiring and not self.should_set_cookie(app, session):
+            return
+
+        self.store.set(session.sid, dict(session, **{SAVED_AT_KEY: now}), self.ttl)
+        response.set_cookie(
+            name,
+            session.sid,
+            max_age=self.ttl,
+            httponly=self.get_cookie_httponly(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            domain=domain,
+            path=path
+        )
@@ -0,0 +1,545 @@
+import atexit
+import glob
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+from queue import Queue, Full, Empty
+
+import upstream
+from session_store import get_session_store
+from token_manager import get_token_manager
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+CONTEXT_BROKER_URL = os.environ.get('CONTEXT_BROKER_URL', 'http://orion-ld-broker:1026')
+# Where Orion-LD delivers notifications for the shared subscriptions (this backend's /api/notifications)
+NOTIFICATION_ENDPOINT_URL = os.environ.get('NOTIFICATION_ENDPOINT_URL',
+                                           'http://sensors-report-explorer-backend:5000/api/notifications')
+# Secret Orion-LD sends (through receiverInfo) with the notifications of the shared subscriptions;
+# notifications claiming one of them without it are refused. When empty, one is generated and kept
+# in the session store, so every worker and replica sharing the store uses the same one
+NOTIFICATION_SECRET = os.environ.get('NOTIFICATION_SECRET', '')
+NOTIFICATION_SECRET_HEADER = 'X-Notification-Secret'
+NOTIFICATION_SECRET_TTL_SECONDS = 10 * 365 * 86400
+# Shared subscriptions are created with expiresAt this far ahead and renewed while they have listeners,
+# so subscriptions left behind by a crashed worker expire on their own
+SHARED_SUBSCRIPTION_LEASE_SECONDS = int(os.environ.get('SHARED_SUBSCRIPTION_LEASE_SECONDS', '600'))
+# How long a shared subscription without listeners is kept (page reloads reuse it) before it is released
+SHARED_SUBSCRIPTION_IDLE_SECONDS = int(os.environ.get('SHARED_SUBSCRIPTION_IDLE_SECONDS', '60'))
+SHARED_SUBSCRIPTION_SWEEP_SECONDS = int(os.environ.get('SHARED_SUBSCRIPTION_SWEEP_SECONDS', '15'))
+# Notifications buffered per SSE client; a client that falls further behind loses the oldest ones
+NOTIFICATION_CLIENT_QUEUE_SIZE = int(os.environ.get('NOTIFICATION_CLIENT_QUEUE_SIZE', '1000'))
+# Directory of the Unix sockets that relay notifications between workers (empty disables the relay)
+NOTIFICATION_RELAY_DIR = os.environ.get('NOTIFICATION_RELAY_DIR', '')
+
+# Largest datagram read from the relay socket
+RELAY_MAX_BYTES = 4 * 1024 * 1024
+SHARED_SUBSCRIPTION_PREFIX = 'urn:ngsi-ld:Subscription:sr-explorer:'
+
+
+def subscription_key(tenant, entity_type, watched_attributes):
+    """Normalize what a client watches into the key of its shared subscription"""
+    attributes = tuple(sorted({attribute.strip() for attribute in watched_attributes or () if attribute.strip()}))
+    return (tenant or '', entity_type, attributes)
+
+
+def expires_at(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + seconds))
+
+
+class Listener:
+    """The notification queue of one SSE client"""
+
+    def __init__(self, subscription=None, sid=None):
+        self.queue = Queue(maxsize=NOTIFICATION_CLIENT_QUEUE_SIZE)
+        self.subscription = subscription
+        self.sid = sid
+        self.dropped = 0
+
+    def deliver(self, notification):
+        """Queue a notification without blocking, dropping the oldest one when the client lags"""
+        while True:
+            try:
+                self.queue.put_nowait(notification)
+                return
+            except Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except Empty:
+                    pass
+
+
+class SharedSubscription:
+    """One broker subscription shared by every listener watching the same tenant, type and attributes"""
+
+    def __init__(self, key):
+        self.key = key
+        self.tenant, self.entity_type, self.watched_attributes = key
+        digest = hashlib.sha1(repr((NOTIFICATION_ENDPOINT_URL,) + key).encode()).hexdigest()[:24]
+        self.subscription_id = f"{SHARED_SUBSCRIPTION_PREFIX}{digest}"
+        self.listeners = set()
+        self.active = False
+        self.renewed_at = 0.0
+        self.idle_since = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def notification(secret):
+        return {
+            'format': 'normalized',
+            'endpoint': {
+                'uri': NOTIFICATION_ENDPOINT_URL,
+                'accept': 'application/json',
+                'receiverInfo': [{'key': NOTIFICATION_SECRET_HEADER, 'value': secret}]
+            }
+        }
+
+    def payload(self, secret):
+        body = {
+            'id': self.subscription_id,
+            'type': 'Subscription',
+            'description': 'Shared Sensors Report Explorer subscription',
+            'entities': [{'type': self.entity_type}],
+            'notification': self.notification(secret),
+            'expiresAt': expires_at(SHARED_SUBSCRIPTION_LEASE_SECONDS)
+        }
+        if self.watched_attributes:
+            body['watchedAttributes'] = list(self.watched_attributes)
+        return body
+
+
+class SubscriptionManager:
+    """
+    Keeps one Orion-LD subscription per (tenant, entity type, watched attributes) and fans its
+    notifications out to the local SSE clients, so the broker sends each notification once
+    however many users are watching. Subscriptions are reference-counted by their listeners;
+    idle ones are released after SHARED_SUBSCRIPTION_IDLE_SECONDS and active ones have their
+    lease renewed by a background sweep.
+    """
+
+    def __init__(self, broker_url=CONTEXT_BROKER_URL):
+        self.broker_url = broker_url
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        self._by_id = {}
+        self._firehose = set()
+        self._observers = []
+        self._worker = None
+        self._worker_pid = None
+        self._secret = None
+        self.created = 0
+        self.adopted = 0
+        self.renewed = 0
+        self.released = 0
+        self.errors = 0
+        self.notifications = 0
+        self.deliveries = 0
+        # Notifications dropped by clients that have since disconnected
+        self._retired_drops = 0
+        self.forged = 0
+
+    # ---- observers ----
+
+    def observe(self, observer):
+        """
+        Register an object told about shared subscriptions: subscription_activated(subscription),
+        subscription_released(subscription) and subscription_notified(subscription, notification)
+        """
+        self._observers.append(observer)
+
+    def _notify_observers(self, event, *args):
+        for observer in self._observers:
+            try:
+                getattr(observer, event)(*args)
+            except Exception as e:
+                logger.warning(f"Subscription observer failed on {event}: {str(e)}")
+
+    def covers(self, tenant, entity_type, attributes=()):
+        """
+        True when an active shared subscription notifies every change of the given attributes
+        (all attributes when none are given) of the tenant's entities of this type
+        """
+        attributes = set(attributes or ())
+        return any(
+            not subscription.watched_attributes or (attributes and attributes <= set(subscription.watched_attributes))
+            for subscription in self.active_subscriptions(tenant, entity_type)
+        )
+
+    def active_subscriptions(self, tenant, entity_type):
+        """The active shared subscriptions on a tenant's entities of this type"""
+        with self._lock:
+            return [subscription for subscription in self._subscriptions.values()
+                    if subscription.active and subscription.tenant == (tenant or '') and subscription.entity_type == entity_type]
+
+    def broker_headers(self, tenant, entity_type):
+        """Headers for reading a subscribed tenant/type from the broker outside a request, or None"""
+        subscription = next(iter(self.active_subscriptions(tenant, entity_type)), None)
+        if subscription is None:
+            return None
+        headers = self._headers(subscription, self._access_token(subscription))
+        del headers['Content-Type']
+        return headers
+
+    def notification_secret(self):
+        """The per-deployment secret carried by the notifications of the shared subscriptions"""
+        if self._secret is None:
+            secret = NOTIFICATION_SECRET
+            if not secret:
+                store = get_session_store()
+                store.add('notification-secret', {'secret': secrets.token_urlsafe(32)}, NOTIFICATION_SECRET_TTL_SECONDS)
+                secret = store.get('notification-secret')['secret']
+            self._secret = secret
+        return self._secret
+
+    def authentic(self, notification, headers):
+        """
+        False for a notification that claims to come from a shared subscription but lacks the
+        secret Orion-LD sends with those; other notifications only reach the SSE clients
+        watching everything, never the shared subscriptions' clients or the live entity state
+        """
+        subscription_id = notification.get('subscriptionId') if isinstance(notification, dict) else None
+        if not isinstance(subscription_id, str) or not subscription_id.startswith(SHARED_SUBSCRIPTION_PREFIX):
+            return True
+        if hmac.compare_digest((headers.get(NOTIFICATION_SECRET_HEADER) or '').encode('utf-8'),
+                               self.notification_secret().encode('utf-8')):
+            return True
+        self.forged += 1
+        return False
+
+    # ---- listeners ----
+
+    def listen_all(self):
+        """Register an SSE client that receives every notification"""
+        listener = Listener()
+        with self._lock:
+            self._firehose.add(listener)
+        return listener
+
+    def subscribe(self, tenant, entity_type, watched_attributes, headers, sid=None):
+        """
+        Register an SSE client for a tenant/type/attributes set, creating the shared broker
+        subscription on first use. headers are the client's upstream headers; a client joining
+        an existing subscription is checked against the broker with a one-entity query.
+        Returns (listener, None) or (None, (status_code, message)).
+        """
+        key = subscription_key(tenant, entity_type, watched_attributes)
+        with self._lock:
+            subscription = self._subscriptions.get(key)
+            if subscription is None:
+                subscription = self._subscriptions[key] = SharedSubscription(key)
+                self._by_id[subscription.subscription_id] = subscription
+        self.start()
+
+        with subscription.lock:
+            if subscription.active:
+                error = self.check_access(subscription.tenant, subscription.entity_type, headers)
+            else:
+                error = self._create(subscription, headers)
+            if error is not None:
+                self._discard_if_unused(subscription)
+                return None, error
+            listener = Listener(subscription, sid)
+            with self._lock:
+                subscription.listeners.add(listener)
+                subscription.idle_since = None
+        logger.debug("SSE client joined %s (%s listeners)", subscription.subscription_id, len(subscription.listeners))
+        return listener, None
+
+    def unsubscribe(self, listener):
+        """Drop a client; its subscription is released once it stays unused for the idle period"""
+        with self._lock:
+            if listener in self._firehose or listener in getattr(listener.subscription, 'listeners', ()):
+                self._retired_drops += listener.dropped
+            self._firehose.discard(listener)
+            subscription = listener.subscription
+            if subscription is not None:
+                subscription.listeners.discard(listener)
+                if not subscription.listeners:
+                    subscription.idle_since = time.monotonic()
+
+    def dispatch(self, notification):
+        """Hand a notification to the clients of its subscription and to the clients watching everything"""
+        with self._lock:
+            subscription = self._by_id.get(notification.get('subscriptionId'))
+            targets = list(self._firehose)
+            if subscription is not None:
+                targets.extend(subscription.listeners)
+            self.notifications += 1
+            self.deliveries += len(targets)
+        for listener in targets:
+            listener.deliver(notification)
+        if subscription is not None:
+            self._notify_observers('subscription_notified', subscription, notification)
+        return len(targets)
+
+    # ---- broker calls ----
+
+    def _url(self, subscription=None):
+        url = f"{self.broker_url}/ngsi-ld/v1/subscriptions"
+        return f"{url}/{subscription.subscription_id}" if subscription is not None else url
+
+    @staticmethod
+    def _headers(subscription, access_token=None):
+        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+        if subscription.tenant:
+            headers['NGSILD-Tenant'] = subscription.tenant
+        if access_token:
+            headers['Authorization'] = f"Bearer {access_token}"
+        return headers
+
+    def _create(self, subscription, client_headers):
+        """Create (or adopt an existing) broker subscription; returns None or (status_code, message)"""
+        headers = self._headers(subscription)
+        if client_headers.get('Authorization'):
+            headers['Authorization'] = client_headers['Authorization']
+        try:
+            secret = self.notification_secret()
+            response = upstream.request('POST', self._url(), headers=headers, json=subscription.payload(secret))
+            if response.status_code == 409:
+                # Created earlier by another worker or a previous run: take it over and extend its lease
+                response = upstream.request('PATCH', self._url(subscription), headers=headers,
+                                            json={'notification': subscription.notification(secret),
+                                                  'expiresAt': expires_at(SHARED_SUBSCRIPTION_LEASE_SECONDS)})
+                if response.status_code < 300:
+                    self.adopted += 1
+            elif response.status_code < 300:
+                self.created += 1
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Could not create shared subscription for {subscription.key}: {str(e)}")
+            return 503, str(e)
+        if response.status_code >= 300:
+            self.errors += 1
+            logger.warning(f"Orion-LD refused shared subscription for {subscription.key}: "
+                           f"{response.status_code} {response.text[:200]}")
+            return response.status_code, response.text
+        subscription.active = True
+        subscription.renewed_at = time.monotonic()
+        logger.info(f"Shared subscription {subscription.subscription_id} active for {subscription.key}")
+        self._notify_observers('subscription_activated', subscription)
+        return None
+
+    def check_access(self, tenant, entity_type, client_headers):
+        """
+        Make sure a client may read a tenant's entities of this type (before it joins an existing
+        subscription or is served its notified state) with a one-entity query.
+        Returns None or (status_code, message).
+        """
+        headers = {name: value for name, value in client_headers.items() if name in ('Authorization', 'Link')}
+        headers['Accept'] = 'application/json'
+        if tenant:
+            headers['NGSILD-Tenant'] = tenant
+        try:
+            response = upstream.get(f"{self.broker_url}/ngsi-ld/v1/entities", headers=headers,
+                                    params={'type': entity_type, 'limit': 1})
+        except Exception as e:
+            return 503, str(e)
+        if response.status_code in (401, 403):
+            return response.status_code, response.text
+        return None
+
+    def _access_token(self, subscription):
+        """A current token of any client on the subscription, for renewals made outside a request"""
+        token_manager = get_token_manager()
+        for listener in list(subscription.listeners):
+            if listener.sid:
+                token = token_manager.get_access_token(listener.sid)
+                if token:
+                    return token
+        return None
+
+    def _renew(self, subscription):
+        headers = self._headers(subscription, self._access_token(subscription))
+        # The endpoint is sent again so a subscription keeps the current secret if the store lost it
+        response = upstream.request('PATCH', self._url(subscription), headers=headers,
+                                    json={'notification': subscription.notification(self.notification_secret()),
+                                          'expiresAt': expires_at(SHARED_SUBSCRIPTION_LEASE_SECONDS)})
+        if response.status_code == 404:
+            # Deleted or expired on the broker: create it again
+            subscription.active = False
+            if self._create(subscription, headers) is None:
+                return
+        elif response.status_code < 300:
+            subscription.renewed_at = time.monotonic()
+            self.renewed += 1
+            return
+        self.errors += 1
+        logger.warning(f"Could not renew shared subscription {subscription.subscription_id}: {response.status_code}")
+
+    def _release(self, subscription):
+        """Forget an idle subscription; it is deleted on the broker unless other workers may still use it"""
+        with self._lock:
+            if subscription.listeners or self._subscriptions.get(subscription.key) is not subscription:
+                return
+            del self._subscriptions[subscription.key]
+            self._by_id.pop(subscription.subscription_id, None)
+        self.released += 1
+        if not subscription.active:
+            return
+        self._notify_observers('subscription_released', subscription)
+        if relay.enabled:
+            # Other workers may be renewing it; left alone, it expires at the end of its lease
+            logger.info(f"Released shared subscription {subscription.subscription_id}")
+            return
+        try:
+            upstream.request('DELETE', self._url(subscription), headers=self._headers(subscription))
+            logger.info(f"Deleted idle shared subscription {subscription.subscription_id}")
+        except Exception as e:
+            logger.warning(f"Could not delete shared subscription {subscription.subscription_id}: {str(e)}")
+
+    def _discard_if_unused(self, subscription):
+        with self._lock:
+            if not subscription.listeners and not subscription.active:
+                if self._subscriptions.get(subscription.key) is subscription:
+                    del self._subscriptions[subscription.key]
+                    self._by_id.pop(subscription.subscription_id, None)
+
+    # ---- maintenance ----
+
+    def sweep(self):
+        """Release subscriptions idle for longer than the idle period and renew leases that are due"""
+        now = time.monotonic()
+        with self._lock:
+            subscriptions = list(self._subscriptions.values())
+        for subscription in subscriptions:
+            try:
+                if subscription.idle_since is not None and now - subscription.idle_since >= SHARED_SUBSCRIPTION_IDLE_SECONDS:
+                    with subscription.lock:
+                        self._release(subscription)
+                elif subscription.active and now - subscription.renewed_at >= SHARED_SUBSCRIPTION_LEASE_SECONDS / 3:
+                    with subscription.lock:
+                        self._renew(subscription)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Shared subscription sweep failed for {subscription.key}: {str(e)}")
+
+    def start(self):
+        """Start the sweep worker in this process (after a fork it is started again)"""
+        if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name='subscription-sweep', daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            time.sleep(SHARED_SUBSCRIPTION_SWEEP_SECONDS)
+            self.sweep()
+
+    def stats(self):
+        with self._lock:
+            subscriptions = list(self._subscriptions.values())
+            listeners = list(self._firehose)
+            for subscription in subscriptions:
+                listeners.extend(subscription.listeners)
+            dropped = self._retired_drops + sum(listener.dropped for listener in listeners)
+        depths = [listener.queue.qsize() for listener in listeners]
+        return {
+            'subscriptions': len(subscriptions),
+            'idle_subscriptions': sum(1 for subscription in subscriptions if not subscription.listeners),
+            'listeners': len(listeners),
+            # Notifications waiting for slow SSE clients, and the ones lost when a client's queue overflowed
+            'queue_depth': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'listener_dropped': dropped,
+            'created': self.created,
+            'adopted': self.adopted,
+            'renewed': self.renewed,
+            'released': self.released,
+            'errors': self.errors,
+            'notifications': self.notifications,
+            'deliveries': self.deliveries,
+            'forged': self.forged,
+            'relayed': relay.sent,
+            'relay_dropped': relay.dropped
+        }
+
+
+class NotificationRelay:
+    """
+    Copies notifications received by one worker to the other workers over Unix datagram
+    sockets in NOTIFICATION_RELAY_DIR, since the broker posts each notification to one worker
+    only. Notifications larger than the socket buffer allows are not relayed.
+    """
+
+    def __init__(self, directory=NOTIFICATION_RELAY_DIR):
+        self.directory = directory
+        self.enabled = bool(directory)
+        self._socket = None
+        self._path = None
+        self.sent = 0
+        self.dropped = 0
+
+    def start(self, on_notification):
+        """Bind this worker's socket and deliver what other workers relay to on_notification"""
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._path = os.path.join(self.directory, f"{os.getpid()}.sock")
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self._path)
+        threading.Thread(target=self._receive, args=(self._socket, on_notification),
+                         name='notification-relay', daemon=True).start()
+
+    def _receive(self, sock, on_notification):
+        while True:
+            try:
+                data = sock.recv(RELAY_MAX_BYTES)
+                on_notification(json.loads(data))
+            except OSError:
+                return
+            except Exception as e:
+                logger.warning(f"Could not process relayed notification: {str(e)}")
+
+    def publish(self, notification):
+        """Send a notification to every other worker's socket"""
+        if self._socket is None:
+            return
+        data = json.dumps(notification, separators=(',', ':')).encode()
+        for path in glob.glob(os.path.join(self.directory, '*.sock')):
+            if path == self._path:
+                continue
+            try:
+                self._socket.sendto(data, socket.MSG_DONTWAIT, path)
+                self.sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a worker that exited
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                self.dropped += 1
+                logger.warning(f"Could not relay notification to {os.path.basename(path)}: {str(e)}")
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+
+
+subscription_manager = SubscriptionManager()
+relay = NotificationRelay()
+atexit.register(relay.close)
+
+
+def after_fork():
+    """Join the relay as a new worker; the sweep worker starts with the first shared subscription"""
+    relay.start(subscription_manager.dispatch)
@@ -0,0 +1,1570 @@
+"""
+Tests for the Explorer backend.
+
+They run against an in-process fake Orion-LD, so neither a broker nor Keycloak is needed:
+
+    python -m unittest test_backend
+"""
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Keycloak's signing key, published by the fake broker as the JWKS
+SIGNING_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+ISSUER = 'http://keycloak.test/realms/sr'
+
+
+def make_token(key=SIGNING_KEY, **claims):
+    claims = dict({'iss': ISSUER, 'sub': 'tester', 'exp': int(time.time()) + 300, 'jti': uuid.uuid4().hex}, **claims)
+    return jwt.encode(claims, key, algorithm='RS256', headers={'kid': 'test'})
+
+
+class FakeBroker(BaseHTTPRequestHandler):
+    """Minimal Orion-LD: entities live in `entities`, every request is recorded in `calls`"""
+
+    protocol_version = 'HTTP/1.1'
+    entities = {}
+    calls = []
+    # Bearer tokens the broker accepts; None accepts any request
+    accepted_tokens = None
+    # Seconds the JWKS endpoint takes to answer, and how often it was fetched
+    jwks_delay = 0
+    jwks_fetches = 0
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, status, document):
+        self._reply(status, json.dumps(document).encode(), {'Content-Type': 'application/json'})
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.path == '/jwks':
+            FakeBroker.jwks_fetches += 1
+            time.sleep(FakeBroker.jwks_delay)
+            jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(SIGNING_KEY.public_key()))
+            return self._json(200, {'keys': [dict(jwk, kid='test', use='sig', alg='RS256')]})
+        FakeBroker.calls.append((self.command, self.path, dict(self.headers), body))
+        token = (self.headers.get('Authorization') or '').replace('Bearer ', '') or None
+        if FakeBroker.accepted_tokens is not None and token not in FakeBroker.accepted_tokens:
+            return self._json(401, {'title': 'Unauthorized'})
+
+        path, _, query = self.path.partition('?')
+        params = dict(item.partition('=')[::2] for item in query.split('&') if item)
+        if path == '/ngsi-ld/v1/subscriptions' and self.command == 'POST':
+            return self._reply(201, headers={'Location': f"{path}/{json.loads(body)['id']}"})
+        if path.startswith('/ngsi-ld/v1/subscriptions/'):
+            return self._reply(204)
+        if path == '/ngsi-ld/v1/entities':
+            entities = [entity for entity in FakeBroker.entities.values()
+                        if not params.get('type') or entity['type'] == params['type']]
+            offset, limit = int(params.get('offset', 0)), int(params.get('limit', 20))
+            return self._json(200, entities[offset:offset + limit])
+        if path.startswith('/ngsi-ld/v1/entities/'):
+            entity = FakeBroker.entities.get(path.rsplit('/', 1)[1])
+            return self._json(200, entity) if entity else self._json(404, {'title': 'Not found'})
+        return self._json(200, {})
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+broker = ThreadingHTTPServer(('127.0.0.1', 0), FakeBroker)
+threading.Thread(target=broker.serve_forever, daemon=True).start()
+BROKER_URL = f"http://127.0.0.1:{broker.server_port}"
+
+os.environ.update({
+    'CONTEXT_BROKER_URL': BROKER_URL,
+    'QUANTUM_LEAP_URL': BROKER_URL,
+    'DATA_PRODUCT_URL': BROKER_URL,
+    'KEYCLOAK_DISCOVERY_URL': '',
+    'KEYCLOAK_JWKS_URL': f"{BROKER_URL}/jwks",
+    'KEYCLOAK_ISSUER': ISSUER,
+    'NGSI_LD_CONTEXTS': '',
+    'LOG_LEVEL': 'WARNING',
+    'LIVE_ENTITY_RECONCILE_SECONDS': '0',
+})
+
+
+def load_backend():
+    """Import backend-sr-explorer.py the way wsgi.py does"""
+    spec = importlib.util.spec_from_file_location(
+        'backend_sr_explorer', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend-sr-explorer.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+backend = load_backend()
+
+
+class DownsampleTests(unittest.TestCase):
+    def setUp(self):
+        import numpy as np
+        import timeseries
+        self.np = np
+        self.timeseries = timeseries
+        self.times = np.arange(0, 100_000, 1000, dtype=np.int64)
+        self.values = np.sin(np.arange(100) / 5.0)
+
+    def test_lttb_keeps_the_requested_number_of_points(self):
+        for threshold in (3, 10, 99):
+            selected = self.timeseries.lttb(self.times, self.values, threshold)
+            self.assertEqual(selected.size, threshold)
+            self.assertEqual((selected[0], selected[-1]), (0, 99))
+            self.assertTrue(self.np.all(self.np.diff(selected) > 0))
+
+    def test_lttb_below_three_points_keeps_the_ends(self):
+        self.assertEqual(self.timeseries.lttb(self.times, self.values, 1).tolist(), [0])
+        self.assertEqual(self.timeseries.lttb(self.times, self.values, 2).tolist(), [0, 99])
+
+    def test_lttb_returns_short_series_unchanged(self):
+        self.assertEqual(self.timeseries.lttb(self.times[:5], self.values[:5], 10).tolist(), [0, 1, 2, 3, 4])
+
+    def test_lttb_keeps_a_spike(self):
+        values = self.np.zeros(100)
+        values[42] = 50.0
+        self.assertIn(42, self.timeseries.lttb(self.times, values, 10).tolist())
+
+    def test_avg_and_minmax_buckets(self):
+        times = self.np.arange(0, 8, dtype=self.np.int64)
+        values = self.np.array([1, 3, 5, 7, 2, 4, float('nan'), 8], dtype=self.np.float64)
+        result = self.timeseries.downsample(times, values, 2, 'minmax')
+        self.assertEqual(result['values'], [4.0, 14 / 3])
+        self.assertEqual(result['min'], [1.0, 2.0])
+        self.assertEqual(result['max'], [7.0, 8.0])
+        self.assertEqual(result['index'], ['1970-01-01T00:00:00.000Z', '1970-01-01T00:00:00.004Z'])
+
+    def test_unsorted_samples_are_sorted(self):
+        times = self.np.array([3000, 1000, 2000], dtype=self.np.int64)
+        result = self.timeseries.downsample(times, self.np.array([3.0, 1.0, 2.0]), 10)
+        self.assertEqual(result['values'], [1.0, 2.0, 3.0])
+
+
+class HistoryQuantumLeap(BaseHTTPRequestHandler):
+    """
+    QuantumLeap serving the epoch-ms `samples` of one attribute (404 when a range has none);
+    entities in `entities` have their own samples, or fail with a 500 when mapped to None
+    """
+
+    protocol_version = 'HTTP/1.1'
+    samples = {}
+    entities = {}
+    calls = []
+
+    def do_GET(self):
+        import timeseries
+        from urllib.parse import parse_qs, urlsplit
+        url = urlsplit(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        HistoryQuantumLeap.calls.append((params, self.headers.get('Authorization')))
+        samples = HistoryQuantumLeap.entities.get(url.path.split('/')[3], HistoryQuantumLeap.samples)
+        start, end = timeseries.parse_timestamp(params['fromDate']), timeseries.parse_timestamp(params['toDate'])
+        times = sorted(t for t in samples or {} if start <= t <= end)
+        if samples is None:
+            status, body = 500, {'error': 'Internal Server Error'}
+        elif times:
+            status, body = 200, {'index': timeseries.format_index(times), 'values': [samples[t] for t in times]}
+        else:
+            status, body = 404, {'error': 'Not Found'}
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TileCacheTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        import tile_cache
+        self.tile_cache = tile_cache
+        self.tile_dir = tempfile.TemporaryDirectory()
+        self.cache = tile_cache.TileCache(tile_dir=self.tile_dir.name)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), HistoryQuantumLeap)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        HistoryQuantumLeap.samples, HistoryQuantumLeap.entities, HistoryQuantumLeap.calls = {}, {}, []
+        self.span = tile_cache.TileCache.tile_span_ms(0)
+        self.hour = int(time.time() * 1000) // self.span * self.span
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tile_dir.cleanup()
+
+    def get(self, start, headers=None, cache=None):
+        times, values, fetched, cached = (cache or self.cache).get_range(
+            self.url, 'urn:ngsi-ld:Sensor:1', 'temperature', headers or {}, start, start + self.span - 1)
+        return values.tolist(), fetched, cached
+
+    def age(self, seconds):
+        for tile in self.cache._tiles.values():
+            tile.fetched_at -= seconds
+
+    def persisted(self):
+        return [name for name in os.listdir(self.tile_dir.name) if name.endswith('.npz')]
+
+    def test_old_tiles_with_samples_are_immutable_and_persisted(self):
+        start = self.hour - 48 * self.span
+        HistoryQuantumLeap.samples = {start + 1000: 1.5, start + 2000: 2.5}
+        self.assertEqual(self.get(start), ([1.5, 2.5], 1, 0))
+        self.age(10 * self.tile_cache.TILE_EMPTY_TTL_SECONDS)
+        self.assertEqual(self.get(start), ([1.5, 2.5], 0, 1))
+        self.assertEqual(len(self.persisted()), 1)
+
+        restarted = self.tile_cache.TileCache(tile_dir=self.tile_dir.name)
+        self.assertEqual(self.get(start, cache=restarted), ([1.5, 2.5], 0, 1))
+        self.assertEqual(restarted.disk_hits, 1)
+        self.assertEqual(len(HistoryQuantumLeap.calls), 1)
+
+    def test_empty_closed_tiles_are_revalidated(self):
+        start = self.hour - 48 * self.span
+        self.assertEqual(self.get(start), ([], 1, 0))
+        HistoryQuantumLeap.samples = {start + 1000: 4.0}
+        self.assertEqual(self.get(start), ([], 0, 1))
+        self.assertEqual(self.persisted(), [])
+
+        self.age(self.tile_cache.TILE_EMPTY_TTL_SECONDS + 1)
+        self.assertEqual(self.get(start), ([4.0], 1, 0))
+        self.assertEqual(len(self.persisted()), 1)
+
+    def test_tiles_within_the_grace_period_pick_up_late_data(self):
+        start = self.hour - self.span
+        HistoryQuantumLeap.samples = {start + 1000: 1.0}
+        self.assertEqual(self.get(start), ([1.0], 1, 0))
+        HistoryQuantumLeap.samples[self.hour - 1000] = 2.0
+        self.age(self.tile_cache.TILE_LIVE_TTL_SECONDS + 1)
+        self.assertEqual(self.get(start), ([1.0], 0, 1))
+
+        self.age(self.tile_cache.TILE_RECENT_TTL_SECONDS)
+        self.assertEqual(self.get(start), ([1.0, 2.0], 1, 0))
+        self.assertEqual(self.persisted(), [])
+
+    def test_tiles_are_shared_per_token_subject_only(self):
+        start = self.hour - 48 * self.span
+        HistoryQuantumLeap.samples = {start + 1000: 1.0}
+        self.assertEqual(self.get(start, {'Authorization': f"Bearer {make_token(sub='alice')}"})[1:], (1, 0))
+        self.assertEqual(self.get(start, {'Authorization': f"Bearer {make_token(sub='alice')}"})[1:], (0, 1))
+        self.assertEqual(self.get(start, {'Authorization': f"Bearer {make_token(sub='bob')}"})[1:], (1, 0))
+        self.assertEqual(self.get(start, {'Authorization': 'Bearer forged'})[1:], (1, 0))
+        self.assertEqual(self.get(start)[1:], (1, 0))
+        self.assertEqual(self.get(start, {'NGSILD-Tenant': 'other'})[1:], (1, 0))
+        self.assertEqual(len(HistoryQuantumLeap.calls), 5)
+
+
+class MultiEntityHistoryTests(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), HistoryQuantumLeap)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url, os.environ['QUANTUM_LEAP_URL'] = os.environ['QUANTUM_LEAP_URL'], f"http://127.0.0.1:{self.server.server_port}"
+        HistoryQuantumLeap.samples, HistoryQuantumLeap.calls = {}, []
+        HistoryQuantumLeap.entities = {'a': {1000: 1.0, 2000: 2.0}, 'b': {2000: 20.0, 3000: 30.0}, 'c': {}, 'd': None}
+        self.client = backend.app.test_client()
+        self.range = 'fromDate=1970-01-01T00:00:00Z&toDate=1970-01-01T01:00:00Z'
+
+    def tearDown(self):
+        HistoryQuantumLeap.entities = {}
+        os.environ['QUANTUM_LEAP_URL'] = self.url
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_series_are_aligned_on_a_shared_index(self):
+        response = self.client.get(f"/api/quantum/v2/history?id=a,b,c,d&attrs=temperature&{self.range}")
+        self.assertEqual(response.status_code, 200)
+        result = response.get_json()
+        self.assertEqual(result['index'], ['1970-01-01T00:00:01.000Z', '1970-01-01T00:00:02.000Z',
+                                           '1970-01-01T00:00:03.000Z'])
+        self.assertEqual([(column['entityId'], column['values']) for column in result['columns']],
+                         [('a', [1.0, 2.0, None]), ('b', [None, 20.0, 30.0]), ('c', [None, None, None])])
+        self.assertEqual([(error['entityId'], error['status']) for error in result['errors']], [('d', 500)])
+        self.assertTrue(all(params['fromDate'] == '1970-01-01T00:00:00Z' for params, _ in HistoryQuantumLeap.calls))
+
+    def test_ndjson_streams_one_line_per_series(self):
+        response = self.client.get(f"/api/quantum/v2/history?id=a,b&attrs=temperature,humidity&format=ndjson&{self.range}")
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(sorted((line['entityId'], line['attrName']) for line in lines),
+                         [('a', 'humidity'), ('a', 'temperature'), ('b', 'humidity'), ('b', 'temperature')])
+
+    def test_invalid_requests(self):
+        import endpoints
+        self.assertEqual(self.client.get('/api/quantum/v2/history?id=a').status_code, 400)
+        self.assertEqual(self.client.get('/api/quantum/v2/history?id=a&attrs=t&format=xml').status_code, 400)
+        ids = ','.join(str(i) for i in range(endpoints.QUANTUM_LEAP_HISTORY_MAX_SERIES + 1))
+        self.assertEqual(self.client.get(f"/api/quantum/v2/history?id={ids}&attrs=t").status_code, 400)
+        self.assertEqual(HistoryQuantumLeap.calls, [])
+
+
+class SchemaTests(unittest.TestCase):
+    def setUp(self):
+        self.client = backend.app.test_client()
+
+    def test_compressed_schema_revalidates_with_weak_etag(self):
+        import compression
+        min_size, compression.COMPRESSION_MIN_SIZE = compression.COMPRESSION_MIN_SIZE, 1
+        try:
+            response = self.client.get('/api/schemas/entity.json', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            etag = response.headers['ETag']
+            self.assertTrue(etag.startswith('W/'))
+
+            response = self.client.get('/api/schemas/entity.json',
+                                       headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+        finally:
+            compression.COMPRESSION_MIN_SIZE = min_size
+
+
+class CompressionTests(unittest.TestCase):
+    def setUp(self):
+        import gzip
+        from flask import Flask, Response, jsonify
+        import compression
+        from upstream import UpstreamResponse
+        self.gzip = gzip
+        self.compression = compression
+        self.body = json.dumps([{'id': f"urn:ngsi-ld:Sensor:{i}", 'type': 'Sensor'} for i in range(100)]).encode()
+        app = Flask(__name__)
+        compression.init_app(app)
+
+        @app.route('/json')
+        def json_body():
+            response = Response(self.body, mimetype='application/json')
+            response.headers['ETag'] = '"v1"'
+            return response
+
+        @app.route('/small')
+        def small():
+            return jsonify({'ok': True})
+
+        @app.route('/stream')
+        def stream():
+            return Response((line + '\n' for line in ('{"a": 1}', '{"b": 2}')), mimetype='application/x-ndjson')
+
+        @app.route('/events')
+        def events():
+            return Response(self.body, mimetype='text/event-stream')
+
+        @app.route('/upstream')
+        def upstream():
+            encoded = gzip.compress(self.body)
+            return compression.make_upstream_response(UpstreamResponse(
+                200, {'Content-Type': 'application/json'}, encoded, content_encoding='gzip'))
+
+        self.client = app.test_client()
+
+    def test_gzip_when_accepted(self):
+        response = self.client.get('/json', headers={'Accept-Encoding': 'br;q=0.5, gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(response.headers['ETag'], 'W/"v1"')
+        self.assertEqual(self.gzip.decompress(response.data), self.body)
+
+    def test_identity_when_not_accepted(self):
+        for accept in (None, 'identity', 'gzip;q=0'):
+            response = self.client.get('/json', headers={'Accept-Encoding': accept} if accept else {})
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.headers['ETag'], '"v1"')
+            self.assertEqual(response.data, self.body)
+
+    def test_small_and_event_stream_bodies_are_not_compressed(self):
+        for path in ('/small', '/events'):
+            response = self.client.get(path, headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_streamed_bodies_are_compressed_incrementally(self):
+        response = self.client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(self.gzip.decompress(response.data), b'{"a": 1}\n{"b": 2}\n')
+
+    def test_upstream_encoding_is_passed_through_or_decoded(self):
+        response = self.client.get('/upstream', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(self.gzip.decompress(response.data), self.body)
+
+        response = self.client.get('/upstream', headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, self.body)
+
+    def test_decode_content(self):
+        import zlib
+        self.assertEqual(self.compression.decode_content(self.gzip.compress(b'x' * 10), 'gzip'), b'x' * 10)
+        self.assertEqual(self.compression.decode_content(zlib.compress(b'abc'), 'deflate'), b'abc')
+        raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        self.assertEqual(self.compression.decode_content(raw.compress(b'abc') + raw.flush(), 'deflate'), b'abc')
+        with self.assertRaises(ValueError):
+            self.compression.decode_content(b'abc', 'compress')
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        from response_cache import ResponseCache
+        self.ResponseCache = ResponseCache
+        self.cache = ResponseCache('test', ttl=60, stale_ttl=60, max_entries=2, stale_if_error=600)
+        self.fetches = []
+
+    def fetcher(self, content=b'{"v": 1}', status_code=200, error=None):
+        def fetch():
+            self.fetches.append(content)
+            if error:
+                raise error
+            return content, status_code, 'application/json'
+        return fetch
+
+    def age(self, key, seconds):
+        self.cache.get(key).stored_at -= seconds
+
+    def test_hits_and_tenant_partitioned_keys(self):
+        key = self.ResponseCache.make_key('http://ql/v2/types', {'Fiware-Service': 'A'}, {'limit': 10})
+        self.assertEqual(key, self.ResponseCache.make_key('http://ql/v2/types', {'Fiware-Service': 'a'}, {'limit': 10}))
+        self.assertNotEqual(key, self.ResponseCache.make_key('http://ql/v2/types', {'Fiware-Service': 'b'}, {'limit': 10}))
+
+        self.assertEqual(self.cache.get_or_fetch(key, self.fetcher())[1], 'miss')
+        entry, state = self.cache.get_or_fetch(key, self.fetcher(b'{"v": 2}'))
+        self.assertEqual((entry.content, state), (b'{"v": 1}', 'hit'))
+        self.assertEqual(len(self.fetches), 1)
+
+    def test_errors_are_not_cached_and_entries_are_evicted(self):
+        entry, state = self.cache.get_or_fetch('a', self.fetcher(b'{}', 404))
+        self.assertEqual((entry.status_code, state), (404, 'miss'))
+        self.assertIsNone(self.cache.get('a'))
+
+        for key in ('a', 'b', 'c'):
+            self.cache.get_or_fetch(key, self.fetcher())
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['entries'], 2)
+
+    def test_stale_while_revalidate(self):
+        self.cache.get_or_fetch('a', self.fetcher())
+        self.age('a', 90)
+        entry, state = self.cache.get_or_fetch('a', self.fetcher(b'{"v": 2}'))
+        self.assertEqual((entry.content, state), (b'{"v": 1}', 'stale'))
+        deadline = time.monotonic() + 5
+        while self.cache.get('a').content != b'{"v": 2}' and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.cache.get_or_fetch('a', self.fetcher(b'{"v": 3}')), (self.cache.get('a'), 'hit'))
+        self.assertEqual(self.cache.get('a').content, b'{"v": 2}')
+
+    def test_stale_if_error(self):
+        self.cache.get_or_fetch('a', self.fetcher())
+        self.age('a', 300)
+        entry, state = self.cache.get_or_fetch('a', self.fetcher(error=ConnectionError('down')))
+        self.assertEqual((entry.content, state), (b'{"v": 1}', 'stale'))
+        entry, state = self.cache.get_or_fetch('a', self.fetcher(b'{}', 503))
+        self.assertEqual((entry.content, state), (b'{"v": 1}', 'stale'))
+        self.assertEqual(self.cache.stats()['errors_served_stale'], 2)
+
+        self.age('a', 600)
+        with self.assertRaises(ConnectionError):
+            self.cache.get_or_fetch('a', self.fetcher(error=ConnectionError('down')))
+        self.assertEqual(self.cache.get_or_fetch('a', self.fetcher(b'{}', 503))[0].status_code, 503)
+
+    def test_etag_revalidation(self):
+        entry, _ = self.cache.get_or_fetch('a', self.fetcher())
+        with backend.app.test_request_context('/', headers={'If-None-Match': 'W/' + entry.etag}):
+            response = self.ResponseCache.make_response(entry, 'hit')
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], entry.etag)
+            self.assertEqual(response.headers['X-Cache'], 'HIT')
+        with backend.app.test_request_context('/', headers={'If-None-Match': '"other"'}):
+            response = self.ResponseCache.make_response(entry, 'stale')
+            self.assertEqual((response.status_code, response.get_data()), (200, b'{"v": 1}'))
+            self.assertEqual(response.headers['Content-Type'], 'application/json')
+            self.assertTrue(response.headers['Cache-Control'].startswith('private, max-age='))
+
+
+class ExportTests(unittest.TestCase):
+    def setUp(self):
+        import admission
+        # Exports are expensive for admission control: start every test with full buckets
+        with admission.admission_controller._lock:
+            admission.admission_controller._buckets.clear()
+        self.client = backend.app.test_client()
+        self.entities = FakeBroker.entities
+        FakeBroker.entities = {
+            f"urn:ngsi-ld:Sensor:{i}": {'id': f"urn:ngsi-ld:Sensor:{i}", 'type': 'Sensor',
+                                        'temperature': {'type': 'Property', 'value': i, 'unitCode': 'CEL'}}
+            for i in range(5)
+        }
+        FakeBroker.entities['urn:ngsi-ld:Room:1'] = {'id': 'urn:ngsi-ld:Room:1', 'type': 'Room',
+                                                    'inside': {'type': 'Relationship', 'object': 'urn:ngsi-ld:Building:1'}}
+        FakeBroker.calls = []
+
+    def tearDown(self):
+        FakeBroker.entities = self.entities
+
+    def test_ndjson_export_walks_every_page(self):
+        response = self.client.get('/api/ngsi-ld/v1/export/entities?type=Sensor&limit=2')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(response.headers['Content-Disposition'], 'attachment; filename=entities.ndjson')
+        ids = [json.loads(line)['id'] for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(ids, [f"urn:ngsi-ld:Sensor:{i}" for i in range(5)])
+        offsets = [call[1] for call in FakeBroker.calls if call[1].startswith('/ngsi-ld/v1/entities?')]
+        self.assertEqual(len(offsets), 3)
+
+    def test_csv_export_has_one_row_per_attribute(self):
+        import csv
+        import io
+        response = self.client.get('/api/ngsi-ld/v1/export/entities?format=csv&limit=4')
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(len(rows), 7)
+        self.assertIn(['urn:ngsi-ld:Sensor:3', 'Sensor', 'temperature', 'Property', '3', 'CEL', ''], rows)
+        self.assertIn(['urn:ngsi-ld:Room:1', 'Room', 'inside', 'Relationship', 'urn:ngsi-ld:Building:1', '', ''], rows)
+
+    def test_invalid_format_and_upstream_errors(self):
+        self.assertEqual(self.client.get('/api/ngsi-ld/v1/export/entities?format=xml').status_code, 400)
+        FakeBroker.accepted_tokens = set()
+        try:
+            response = self.client.get('/api/ngsi-ld/v1/export/entities', headers={'Authorization': 'Bearer nope'})
+        finally:
+            FakeBroker.accepted_tokens = None
+        self.assertGreaterEqual(response.status_code, 400)
+
+
+class ForwardedHeaderTests(unittest.TestCase):
+    def setUp(self):
+        self.client = backend.app.test_client()
+        FakeBroker.calls = []
+
+    def test_only_whitelisted_headers_reach_the_broker(self):
+        self.client.get('/api/ngsi-ld/v1/entities/urn:ngsi-ld:Sensor:headers', headers={
+            'Authorization': 'Bearer abc', 'NGSILD-Tenant': 'acme', 'Fiware-Correlator': 'c-1',
+            'Cookie': 'session=secret', 'X-Forwarded-For': '10.0.0.1', 'X-Custom': 'x', 'Connection': 'keep-alive, X-Custom'})
+        headers = {name.lower(): value for name, value in FakeBroker.calls[-1][2].items()}
+        self.assertEqual((headers['authorization'], headers['ngsild-tenant'], headers['fiware-correlator']),
+                         ('Bearer abc', 'acme', 'c-1'))
+        for name in ('cookie', 'x-forwarded-for', 'x-custom'):
+            self.assertNotIn(name, headers)
+
+    def test_default_tenant_is_dropped(self):
+        for tenant in ('default', 'Synchro'):
+            self.client.get('/api/ngsi-ld/v1/entities/urn:ngsi-ld:Sensor:headers', headers={'NGSILD-Tenant': tenant})
+            self.assertNotIn('ngsild-tenant', {name.lower() for name in FakeBroker.calls[-1][2]})
+
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        from upstream import SingleFlight
+        self.flight = SingleFlight()
+
+    def run_concurrently(self, key, fn, callers=4):
+        results = []
+
+        def call():
+            try:
+                results.append(self.flight.do(key, fn))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_concurrent_calls_share_one_execution(self):
+        release = threading.Event()
+        executions = []
+
+        def fetch():
+            executions.append(1)
+            release.wait(5)
+            return object()
+
+        threads, results = self.run_concurrently('a', fetch)
+        deadline = time.monotonic() + 5
+        while self.flight.shared < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(executions), 1)
+        self.assertEqual(len(set(map(id, results))), 1)
+        self.assertEqual(self.flight.stats(), {'executions': 1, 'shared': 3, 'in_flight': 0})
+
+        self.flight.do('a', fetch)
+        self.assertEqual(len(executions), 2)
+
+    def test_errors_are_shared_and_not_remembered(self):
+        release = threading.Event()
+
+        def fail():
+            release.wait(5)
+            raise RuntimeError('down')
+
+        threads, results = self.run_concurrently('a', fail, callers=2)
+        deadline = time.monotonic() + 5
+        while self.flight.shared < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertEqual(self.flight.do('a', lambda: 'ok'), 'ok')
+
+    def test_keys_separate_callers(self):
+        from upstream import single_flight_key
+        url = f"{BROKER_URL}/ngsi-ld/v1/entities"
+        key = single_flight_key(url, {'Authorization': 'Bearer a', 'NGSILD-Tenant': 't1'}, {'type': 'Sensor'})
+        self.assertEqual(key, single_flight_key(url, {'Authorization': 'Bearer a', 'NGSILD-Tenant': 't1'}, {'type': 'Sensor'}))
+        for headers, params in (({'Authorization': 'Bearer b', 'NGSILD-Tenant': 't1'}, {'type': 'Sensor'}),
+                                ({'Authorization': 'Bearer a', 'NGSILD-Tenant': 't2'}, {'type': 'Sensor'}),
+                                ({'NGSILD-Tenant': 't1'}, {'type': 'Sensor'}),
+                                ({'Authorization': 'Bearer a', 'NGSILD-Tenant': 't1'}, {'type': 'Room'})):
+            self.assertNotEqual(key, single_flight_key(url, headers, params))
+
+
+class BatchOperationTests(unittest.TestCase):
+    def setUp(self):
+        self.client = backend.app.test_client()
+
+    def test_non_object_items_are_rejected(self):
+        response = self.client.post('/api/ngsi-ld/v1/entityOperations/create', json=[1, 2])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Item 0', response.get_json()['error'])
+
+    def test_items_without_id_are_rejected(self):
+        response = self.client.post('/api/ngsi-ld/v1/entityOperations/upsert',
+                                    json=[{'id': 'urn:ngsi-ld:Device:1', 'type': 'Device'}, {'type': 'Device'}])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Item 1', response.get_json()['error'])
+
+    def test_delete_accepts_ids_and_objects(self):
+        response = self.client.post('/api/ngsi-ld/v1/entityOperations/delete',
+                                    json=['urn:ngsi-ld:Device:1', {'id': 'urn:ngsi-ld:Device:2'}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['total'], 2)
+
+
+class UploadRelayTests(unittest.TestCase):
+    def setUp(self):
+        import upload_relay
+        self.upload_relay = upload_relay
+        self.client = backend.app.test_client()
+        FakeBroker.calls = []
+
+    def test_multipart_body_is_relayed_byte_for_byte(self):
+        body = (b'--xyz\r\nContent-Disposition: form-data; name="file"; filename="a.csv"\r\n\r\n'
+                + b'a,b\r\n' * 5000 + b'\r\n--xyz--\r\n')
+        before = self.upload_relay.upload_stats.stats()
+        response = self.client.post('/api/dataProducts', data=body,
+                                    headers={'Content-Type': 'multipart/form-data; boundary=xyz'})
+        self.assertEqual(response.status_code, 200)
+        command, path, headers, relayed = FakeBroker.calls[-1]
+        self.assertEqual((command, path, relayed), ('POST', '/dataProducts', body))
+        self.assertEqual(headers['Content-Type'], 'multipart/form-data; boundary=xyz')
+        stats = self.upload_relay.upload_stats.stats()
+        self.assertEqual(stats['completed'], before['completed'] + 1)
+        self.assertEqual(stats['bytes_relayed'], before['bytes_relayed'] + len(body))
+        self.assertEqual(stats['active'], [])
+
+    def test_declared_oversized_upload_is_rejected_before_relaying(self):
+        import endpoints
+        rejected = self.upload_relay.upload_stats.rejected
+        limit, endpoints.DATA_PRODUCT_MAX_UPLOAD_BYTES = endpoints.DATA_PRODUCT_MAX_UPLOAD_BYTES, 10
+        try:
+            response = self.client.post('/api/dataProducts', data=b'{"name": "too large"}',
+                                        headers={'Content-Type': 'application/json'})
+        finally:
+            endpoints.DATA_PRODUCT_MAX_UPLOAD_BYTES = limit
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(FakeBroker.calls, [])
+        self.assertEqual(self.upload_relay.upload_stats.rejected, rejected + 1)
+
+    def test_body_stream_enforces_the_limit_while_reading(self):
+        import io
+        body = self.upload_relay.RequestBodyStream(io.BytesIO(b'x' * 25), None, limit=20)
+        self.assertTrue(body)
+        self.assertEqual(len(body), 0)
+        chunks = []
+        with self.assertRaises(self.upload_relay.UploadTooLarge):
+            for chunk in iter(lambda: body.read(10), b''):
+                chunks.append(chunk)
+        self.assertEqual(len(chunks), 2)
+        failed = self.upload_relay.upload_stats.failed
+        body.finish(False)
+        self.assertEqual(self.upload_relay.upload_stats.failed, failed + 1)
+
+        body = self.upload_relay.RequestBodyStream(io.BytesIO(b'abc'), 3)
+        self.assertEqual((len(body), b''.join(body)), (3, b'abc'))
+        body.finish(True)
+
+
+class CatalogManager(BaseHTTPRequestHandler):
+    """Data-product manager serving `products` with an ETag and answering 304 to a matching If-None-Match"""
+
+    protocol_version = 'HTTP/1.1'
+    products = []
+    conditional = []
+
+    def do_GET(self):
+        body = json.dumps({'data_products': CatalogManager.products}).encode()
+        etag = '"' + str(hash(body)) + '"'
+        CatalogManager.conditional.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DataProductCatalogTests(unittest.TestCase):
+    PRODUCTS = [
+        {'_id': '1', 'name': 'Air quality', 'tags': ['air', 'city'], 'owner': 'Env', 'description': 'Hourly PM10'},
+        {'_id': '2', 'name': 'Parking', 'tags': ['city'], 'owner': 'Mobility', 'description': 'Air-conditioned garages'},
+        {'_id': '3', 'name': 'Airport traffic', 'tags': ['traffic'], 'owner': 'Mobility', 'description': 'Flights'},
+    ]
+
+    def setUp(self):
+        from data_product_catalog import DataProductCatalog
+        self.catalog = DataProductCatalog(ttl=60)
+        self.catalog._apply(self.PRODUCTS)
+
+    def ids(self, **filters):
+        return [product['_id'] for product in self.catalog.search(**filters)['items']]
+
+    def test_text_search_prefix_matches_and_ranks_by_field(self):
+        self.assertEqual(self.ids(text='air'), ['1', '3', '2'])
+        self.assertEqual(self.ids(text='AIR city'), ['1', '2'])
+        self.assertEqual(self.ids(text='pm'), ['1'])
+        self.assertEqual(self.ids(text='nothing'), [])
+
+    def test_facets_and_pages(self):
+        self.assertEqual(self.ids(tags=['City']), ['1', '2'])
+        self.assertEqual(self.ids(owner='mobility', text='air'), ['3', '2'])
+        self.assertEqual(self.ids(tags=['city', 'traffic']), [])
+        result = self.catalog.search(page=2, page_size=2)
+        self.assertEqual((result['total'], [product['_id'] for product in result['items']]), (3, ['2']))
+
+    def test_only_changed_products_are_reindexed(self):
+        reindexed = self.catalog.reindexed
+        self.catalog._apply([dict(self.PRODUCTS[0], name='Water quality'), self.PRODUCTS[1]])
+        self.assertEqual(self.catalog.reindexed, reindexed + 1)
+        self.assertEqual(self.ids(text='water'), ['1'])
+        self.assertEqual(self.ids(text='airport'), [])
+        self.assertEqual(self.ids(tags=['traffic']), [])
+        self.assertEqual(self.catalog.stats()['products'], 2)
+
+    def test_refresh_is_conditional(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), CatalogManager)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url, os.environ['DATA_PRODUCT_URL'] = os.environ['DATA_PRODUCT_URL'], f"http://127.0.0.1:{server.server_port}"
+        CatalogManager.products, CatalogManager.conditional = self.PRODUCTS, []
+        try:
+            from data_product_catalog import DataProductCatalog
+            catalog = DataProductCatalog(ttl=60)
+            catalog.ensure_loaded()
+            self.assertEqual(catalog.stats()['products'], 3)
+            catalog.invalidate()
+            catalog.ensure_loaded()
+            self.assertEqual((catalog.refreshes, catalog.not_modified), (1, 1))
+            self.assertEqual(catalog.search(text='parking')['total'], 1)
+
+            CatalogManager.products = self.PRODUCTS[:1]
+            catalog.invalidate()
+            catalog.ensure_loaded()
+            self.assertEqual(catalog.stats()['products'], 1)
+            self.assertEqual(CatalogManager.conditional[0], None)
+            self.assertTrue(all(CatalogManager.conditional[1:]))
+        finally:
+            os.environ['DATA_PRODUCT_URL'] = url
+            server.shutdown()
+            server.server_close()
+
+
+class RecordingExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class TracingTests(unittest.TestCase):
+    PARENT = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+
+    def setUp(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from flask import Flask, jsonify
+        import tracing
+        import upstream
+        self.tracing = tracing
+        self.enabled, tracing.TRACING_ENABLED = tracing.TRACING_ENABLED, True
+        self.exporter, tracing.exporter = tracing.exporter, RecordingExporter()
+        app = Flask(__name__)
+        tracing.init_app(app)
+
+        @app.route('/api/things/<thing>')
+        def thing(thing):
+            with ThreadPoolExecutor(1) as pool:
+                status = pool.submit(tracing.wrap(lambda: upstream.get(f"{BROKER_URL}/ngsi-ld/v1/entities/{thing}").status_code)).result()
+            return jsonify({'status': status})
+
+        self.client = app.test_client()
+        FakeBroker.calls = []
+
+    def tearDown(self):
+        self.tracing.TRACING_ENABLED = self.enabled
+        self.tracing.exporter = self.exporter
+
+    def test_parse_traceparent(self):
+        self.assertEqual(self.tracing.parse_traceparent(self.PARENT),
+                         ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331', True))
+        self.assertEqual(self.tracing.parse_traceparent(self.PARENT[:-2] + '00')[2], False)
+        for header in (None, 'garbage', '01' + self.PARENT[2:], '00-' + '0' * 32 + '-b7ad6b7169203331-01'):
+            self.assertIsNone(self.tracing.parse_traceparent(header))
+
+    def test_sampled_trace_continues_through_pool_threads_to_the_upstream(self):
+        response = self.client.get('/api/things/urn:ngsi-ld:Sensor:traced', headers={'traceparent': self.PARENT})
+        self.assertEqual(response.headers['X-Trace-Id'], '0af7651916cd43dd8448eb211c80319c')
+        client, server = self.tracing.exporter.spans
+        self.assertEqual((server.kind, server.parent_id), ('server', 'b7ad6b7169203331'))
+        self.assertEqual(server.attributes['http.route'], '/api/things/<thing>')
+        self.assertEqual(server.attributes['http.status_code'], 200)
+        self.assertEqual((client.kind, client.trace_id, client.parent_id), ('client', server.trace_id, server.span_id))
+        self.assertEqual(client.attributes['http.status_code'], 404)
+        self.assertEqual(FakeBroker.calls[-1][2]['traceparent'], client.traceparent())
+
+    def test_unsampled_trace_is_propagated_but_not_exported(self):
+        response = self.client.get('/api/things/urn:ngsi-ld:Sensor:untraced',
+                                   headers={'traceparent': self.PARENT[:-2] + '00'})
+        self.assertNotIn('X-Trace-Id', response.headers)
+        self.assertEqual(self.tracing.exporter.spans, [])
+        traceparent = FakeBroker.calls[-1][2]['traceparent']
+        self.assertTrue(traceparent.startswith('00-0af7651916cd43dd8448eb211c80319c-'))
+        self.assertTrue(traceparent.endswith('-00'))
+
+    def test_exported_formats(self):
+        import tempfile
+        span = self.tracing.Span('0af7651916cd43dd8448eb211c80319c', None, 'GET /x', 'server', True)
+        span.attributes.update({'http.status_code': 500, 'http.method': 'GET'})
+        span.error = 'RuntimeError: boom'
+        span.end_ns = span.start_ns + 2_000_000
+        exported = self.tracing.otlp_payload([span])['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+        self.assertEqual((exported['kind'], exported['parentSpanId'], exported['status']['code']), (2, '', 2))
+        self.assertIn({'key': 'http.status_code', 'value': {'intValue': '500'}}, exported['attributes'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            trace_file, self.tracing.TRACE_FILE = self.tracing.TRACE_FILE, os.path.join(directory, 'spans.jsonl')
+            try:
+                self.tracing.SpanExporter().write([span, span])
+                with open(self.tracing.TRACE_FILE) as f:
+                    lines = [json.loads(line) for line in f]
+            finally:
+                self.tracing.TRACE_FILE = trace_file
+        self.assertEqual(len(lines), 2)
+        self.assertEqual((lines[0]['durationMs'], lines[0]['error']), (2.0, 'RuntimeError: boom'))
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        import metrics
+        self.metrics = metrics
+        self.registry = metrics.MetricsRegistry()
+
+    def lines(self):
+        return self.registry.render().splitlines()
+
+    def test_thread_shards_are_merged_and_retired(self):
+        def work():
+            for _ in range(100):
+                self.registry.inc('jobs_total', (('kind', 'a'),))
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.registry.inc('jobs_total', (('kind', 'a'),))
+        self.registry.describe('jobs_total', 'counter', 'Jobs done')
+        self.assertIn('jobs_total{kind="a"} 401', self.lines())
+        self.assertEqual(len(self.registry._shards), 1)
+        self.assertIn('jobs_total{kind="a"} 401', self.lines())
+        self.assertIn('# TYPE jobs_total counter', self.lines())
+
+    def test_histograms_are_cumulative(self):
+        for value in (0.001, 0.2, 0.2, 99):
+            self.registry.observe('latency_seconds', (('route', '/x'),), value, (0.01, 0.5))
+        lines = self.lines()
+        self.assertIn('latency_seconds_bucket{route="/x",le="0.01"} 1', lines)
+        self.assertIn('latency_seconds_bucket{route="/x",le="0.5"} 3', lines)
+        self.assertIn('latency_seconds_bucket{route="/x",le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_count{route="/x"} 4', lines)
+
+    def test_collectors_and_label_escaping(self):
+        self.registry.register_collector('cache', lambda: {'hits': 3, 'stale_hits': 1, 'misses': 4, 'active': [1, 2],
+                                                           'enabled': True, 'name': 'x'}, (('name', 'a"b'),))
+        self.registry.register_collector('broken', lambda: 1 / 0)
+        self.registry.gauge_add('subscribers', value=2)
+        self.registry.gauge_add('subscribers', value=-1)
+        lines = self.lines()
+        self.assertIn('cache_hit_ratio{name="a\\"b"} 0.5', lines)
+        self.assertIn('cache_active{name="a\\"b"} 2', lines)
+        self.assertIn('subscribers 1', lines)
+        self.assertFalse([line for line in lines if line.startswith(('cache_enabled', 'cache_name', 'broken'))])
+
+    def test_requests_and_upstream_calls_are_counted(self):
+        client = backend.app.test_client()
+        client.get('/api/ngsi-ld/v1/entities/urn:ngsi-ld:Sensor:missing')
+        body = client.get('/metrics').get_data(as_text=True)
+        self.assertRegex(body, r'explorer_http_requests_total\{route="/api/ngsi-ld/v1/entities/<[^"]+>",method="GET",status="404"\} \d+')
+        self.assertRegex(body, r'explorer_upstream_requests_total\{upstream="orion-ld",method="GET",status="404"\} \d+')
+        self.assertIn('explorer_http_request_duration_seconds_bucket', body)
+
+
+class LoggingTests(unittest.TestCase):
+    def test_queued_record_keeps_arguments_as_logged(self):
+        import logging
+        import queue
+        import log_config
+
+        handler = log_config.DroppingQueueHandler(queue.Queue())
+        record = logging.LogRecord('test', logging.INFO, __file__, 0, "Query parameters: %s", None, None)
+        params = {'type': 'Device', 'limit': '10'}
+        record.args = (params,)
+        handler.handle(record)
+        params.pop('limit')
+
+        queued = handler.queue.get_nowait()
+        self.assertEqual(queued.getMessage(), "Query parameters: {'type': 'Device', 'limit': '10'}")
+
+
+class NotificationTests(unittest.TestCase):
+    def test_slow_listener_depth_and_drops_are_exported(self):
+        import subscription_manager
+        manager = subscription_manager.SubscriptionManager(BROKER_URL)
+        listener = manager.listen_all()
+        listener.queue.maxsize = 2
+        for index in range(5):
+            manager.dispatch({'subscriptionId': 'urn:other', 'data': [{'id': f'urn:{index}', 'type': 'Device'}]})
+
+        stats = manager.stats()
+        self.assertEqual(stats['queue_depth'], 2)
+        self.assertEqual(stats['max_queue_depth'], 2)
+        self.assertEqual(stats['listener_dropped'], 3)
+        manager.unsubscribe(listener)
+        self.assertEqual(manager.stats()['listener_dropped'], 3)
+
+    def test_metrics_export_listener_queue(self):
+        text = backend.app.test_client().get('/metrics').get_data(as_text=True)
+        self.assertIn('explorer_shared_subscriptions_queue_depth', text)
+        self.assertIn('explorer_shared_subscriptions_listener_dropped', text)
+
+
+
+class LiveEntityAccessTests(unittest.TestCase):
+    ENTITY = {'id': 'urn:ngsi-ld:Sensor:1', 'type': 'Sensor',
+              'temperature': {'type': 'Property', 'value': 21.5}}
+
+    @classmethod
+    def setUpClass(cls):
+        from subscription_manager import subscription_manager
+        from entity_state import live_entity_cache
+        FakeBroker.entities = {cls.ENTITY['id']: cls.ENTITY}
+        cls.listener, error = subscription_manager.subscribe('', 'Sensor', (), {})
+        assert error is None, error
+        live_entity_cache.reconcile('', 'Sensor')
+
+    @classmethod
+    def tearDownClass(cls):
+        from subscription_manager import subscription_manager
+        subscription_manager.unsubscribe(cls.listener)
+        FakeBroker.entities = {}
+
+    def setUp(self):
+        self.client = backend.app.test_client()
+        self.token = make_token()
+        FakeBroker.accepted_tokens = {self.token}
+
+    def tearDown(self):
+        FakeBroker.accepted_tokens = None
+
+    def test_unauthenticated_read_is_not_served_from_memory(self):
+        for url in ('/api/ngsi-ld/v1/entities/urn:ngsi-ld:Sensor:1', '/api/ngsi-ld/v1/entities?type=Sensor'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 401)
+            self.assertNotEqual(response.headers.get('X-Cache'), 'LIVE')
+
+    def test_forged_token_is_not_served_from_memory(self):
+        forged = make_token(rsa.generate_private_key(public_exponent=65537, key_size=2048))
+        response = self.client.get('/api/ngsi-ld/v1/entities/urn:ngsi-ld:Sensor:1',
+                                   headers={'Authorization': f"Bearer {forged}"})
+        self.assertEqual(response.status_code, 401)
+        self.assertNotEqual(response.headers.get('X-Cache'), 'LIVE')
+
+    def test_token_refused_by_broker_is_not_served_from_memory(self):
+        FakeBroker.accepted_tokens = set()
+        response = self.client.get('/api/ngsi-ld/v1/entities?type=Sensor',
+                                   headers={'Authorization': f"Bearer {self.token}"})
+        self.assertEqual(response.status_code, 401)
+        self.assertNotEqual(response.headers.get('X-Cache'), 'LIVE')
+
+    def test_forged_notifications_do_not_reach_the_live_state(self):
+        from subscription_manager import subscription_manager, NOTIFICATION_SECRET_HEADER
+        created = [json.loads(body) for command, path, _, body in FakeBroker.calls
+                   if command == 'POST' and path == '/ngsi-ld/v1/subscriptions']
+        subscription_id = created[-1]['id']
+        secret = subscription_manager.notification_secret()
+        self.assertEqual(created[-1]['notification']['endpoint']['receiverInfo'],
+                         [{'key': NOTIFICATION_SECRET_HEADER, 'value': secret}])
+
+        forged = dict(self.ENTITY, temperature={'type': 'Property', 'value': -100})
+        notification = {'subscriptionId': subscription_id, 'data': [forged]}
+        for headers in ({}, {NOTIFICATION_SECRET_HEADER: 'guess'}):
+            response = self.client.post('/api/notifications', json=notification, headers=headers)
+            self.assertEqual(response.status_code, 401)
+            response = self.client.post('/api/notifications/batch', json=[notification], headers=headers)
+            self.assertEqual(response.status_code, 401)
+
+        response = self.client.get('/api/ngsi-ld/v1/entities/urn:ngsi-ld:Sensor:1',
+                                   headers={'Authorization': f"Bearer {self.token}"})
+        self.assertEqual(response.headers.get('X-Cache'), 'LIVE')
+        self.assertEqual(response.get_json(), self.ENTITY)
+
+        # Orion-LD's own notifications carry the secret
+        updated = dict(self.ENTITY, temperature={'type': 'Property', 'value': 22.0})
+        response = self.client.post('/api/notifications', json={'subscriptionId': subscription_id, 'data': [updated]},
+                                    headers={NOTIFICATION_SECRET_HEADER: secret})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/api/ngsi-ld/v1/entities/urn:ngsi-ld:Sensor:1',
+                                   headers={'Authorization': f"Bearer {self.token}"})
+        self.assertEqual(response.get_json(), updated)
+        FakeBroker.entities[self.ENTITY['id']] = self.ENTITY
+        subscription_manager.dispatch({'subscriptionId': subscription_id, 'data': [self.ENTITY]})
+
+    def test_authorized_reads_are_served_from_memory(self):
+        headers = {'Authorization': f"Bearer {self.token}"}
+        response = self.client.get('/api/ngsi-ld/v1/entities/urn:ngsi-ld:Sensor:1', headers=headers)
+        self.assertEqual(response.headers.get('X-Cache'), 'LIVE')
+        self.assertEqual(response.get_json(), self.ENTITY)
+
+        # The broker's answer for this token and type is reused
+        calls = len(FakeBroker.calls)
+        response = self.client.get('/api/ngsi-ld/v1/entities?type=Sensor', headers=headers)
+        self.assertEqual(response.headers.get('X-Cache'), 'LIVE')
+        self.assertEqual(response.get_json(), [self.ENTITY])
+        self.assertEqual(len(FakeBroker.calls), calls)
+
+
+
+class RotatingKeycloak:
+    """Keycloak stand-in whose refresh tokens work once, like Keycloak with refresh token rotation"""
+
+    def __init__(self, delay=0.0):
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.delay = delay
+        self.issued = 0
+        self.valid = set()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def issue(self, expires_in=0):
+        with self.lock:
+            self.issued += 1
+            refresh_token = f"refresh-{self.issued}"
+            self.valid.add(refresh_token)
+            return {'access_token': f"access-{self.issued}", 'refresh_token': refresh_token, 'expires_in': expires_in}
+
+    def refresh(self, refresh_token):
+        self.calls += 1
+        time.sleep(self.delay)
+        with self.lock:
+            if refresh_token not in self.valid:
+                raise Exception('invalid_grant')
+            self.valid.discard(refresh_token)
+        return self.issue(expires_in=300)
+
+
+class TokenManagerTests(unittest.TestCase):
+    """Two TokenManagers sharing one SQLite store stand for two gunicorn workers"""
+
+    def setUp(self):
+        import tempfile
+        import session_store
+        import token_manager
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = session_store.SQLiteSessionStore(os.path.join(self.directory.name, 'sessions.db'))
+        self.keycloak = RotatingKeycloak()
+        self.first = token_manager.TokenManager(self.keycloak, self.store)
+        self.second = token_manager.TokenManager(self.keycloak, session_store.SQLiteSessionStore(self.store.path))
+        self.sid = self.first.register(self.keycloak.issue())
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_worker_takes_over_tokens_refreshed_elsewhere(self):
+        # Both workers hold the session in memory before either refreshes it
+        self.assertIsNotNone(self.second._get(self.sid))
+        access_token = self.first.get_access_token(self.sid)
+        self.assertEqual(self.second.get_access_token(self.sid), access_token)
+        self.assertEqual(self.keycloak.calls, 1)
+        self.assertEqual(self.second.adopted, 1)
+        self.assertEqual(self.second.refresh_failures, 0)
+
+    def test_concurrent_refreshes_use_the_refresh_token_once(self):
+        self.keycloak.delay = 0.3
+        self.second._get(self.sid)
+        results = []
+        threads = [threading.Thread(target=lambda manager=manager: results.append(manager.get_access_token(self.sid)))
+                   for manager in (self.first, self.second)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.keycloak.calls, 1)
+        self.assertEqual(results, ['access-2', 'access-2'])
+
+    def test_store_lock_is_taken_once(self):
+        self.assertTrue(self.store.add('lock', {}, 30))
+        self.assertFalse(self.store.add('lock', {}, 30))
+        self.store.delete('lock')
+        self.assertTrue(self.store.add('lock', {}, 30))
+
+
+class LoginTests(unittest.TestCase):
+    def test_login_moves_the_session_to_new_ids(self):
+        from unittest import mock
+        from session_store import get_session_store
+        import keycloak_auth
+
+        store = get_session_store()
+        cookie_name = backend.app.config['SESSION_COOKIE_NAME']
+        store.set('planted-session', {'sid': 'planted-tokens'})
+        store.set('tokens:planted-tokens', {'access_token': 'old'})
+        client = backend.app.test_client()
+        client.set_cookie(cookie_name, 'planted-session')
+
+        with mock.patch.object(keycloak_auth.get_keycloak_auth(), 'exchange_code',
+                               return_value={'access_token': 'a', 'refresh_token': 'r', 'expires_in': 300}):
+            response = client.get('/api/auth/callback?code=c&state=s')
+        self.assertEqual(response.status_code, 302)
+
+        sid = client.get_cookie(cookie_name).value
+        self.assertNotEqual(sid, 'planted-session')
+        self.assertIsNone(store.get('planted-session'))
+        self.assertIsNone(store.get('tokens:planted-tokens'))
+        self.assertNotEqual(store.get(sid)['sid'], 'planted-tokens')
+
+
+
+class SessionExpiryTests(unittest.TestCase):
+    def setUp(self):
+        from flask import Flask, session
+        import session_store
+        self.session_store = session_store
+        self.store = session_store.MemorySessionStore()
+        app = Flask(__name__)
+        app.session_interface = session_store.ServerSideSessionInterface(self.store, ttl=100)
+
+        @app.route('/login')
+        def login():
+            session['user'] = 'alice'
+            return ''
+
+        @app.route('/whoami')
+        def whoami():
+            return dict(session)
+
+        self.client = app.test_client()
+        self.client.get('/login')
+        self.sid = self.client.get_cookie(app.config['SESSION_COOKIE_NAME']).value
+
+    def saved(self, age):
+        data = self.store.get(self.sid)
+        data[self.session_store.SAVED_AT_KEY] = time.time() - age
+        self.store.set(self.sid, data, 100 - age)
+
+    def test_recently_saved_sessions_are_not_written_again(self):
+        self.saved(10)
+        response = self.client.get('/whoami')
+        self.assertEqual(response.get_json(), {'user': 'alice'})
+        self.assertNotIn('Set-Cookie', response.headers)
+        self.assertLess(self.store.get(self.sid)[self.session_store.SAVED_AT_KEY], time.time() - 9)
+
+    def test_sessions_in_use_slide_their_expiry(self):
+        self.saved(60)
+        response = self.client.get('/whoami')
+        self.assertEqual(response.get_json(), {'user': 'alice'})
+        self.assertIn('Max-Age=100', response.headers['Set-Cookie'])
+        self.assertGreater(self.store.get(self.sid)[self.session_store.SAVED_AT_KEY], time.time() - 1)
+        self.assertGreater(self.store._entries[self.sid][1], time.time() + 99)
+
+    def test_sessions_stored_without_a_save_time_are_written_again(self):
+        data = self.store.get(self.sid)
+        del data[self.session_store.SAVED_AT_KEY]
+        self.store.set(self.sid, data, 10)
+        self.assertIn('Set-Cookie', self.client.get('/whoami').headers)
+        self.assertIn(self.session_store.SAVED_AT_KEY, self.store.get(self.sid))
+
+
+class AdmissionTenantTests(unittest.TestCase):
+    def setUp(self):
+        import admission
+        self.admission = admission
+        admission.admission_controller.apply({'tenants': {'acme': {}}})
+
+    def tearDown(self):
+        controller = self.admission.admission_controller
+        controller.apply({})
+        with controller._lock:
+            controller._buckets.clear()
+
+    def tenant(self, headers):
+        with backend.app.test_request_context('/api/ngsi-ld/v1/entities', headers=headers):
+            return self.admission.request_tenant()
+
+    def test_unknown_header_tenants_share_one_bucket(self):
+        self.assertEqual(self.tenant({'NGSILD-Tenant': 'Acme'}), 'acme')
+        self.assertEqual(self.tenant({'NGSILD-Tenant': 'made-up-1'}), 'other')
+        self.assertEqual(self.tenant({'Fiware-Service': 'made-up-2'}), 'other')
+        self.assertEqual(self.tenant({'NGSILD-Tenant': 'Synchro'}), 'default')
+
+    def test_validated_token_decides_the_tenant(self):
+        token = make_token(TenantId=['Globex', 'Initech'])
+        headers = {'Authorization': f"Bearer {token}"}
+        self.assertEqual(self.tenant(dict(headers, **{'NGSILD-Tenant': 'initech'})), 'initech')
+        self.assertEqual(self.tenant(dict(headers, **{'NGSILD-Tenant': 'acme'})), 'globex')
+        self.assertEqual(self.tenant(headers), 'globex')
+        forged = make_token(rsa.generate_private_key(public_exponent=65537, key_size=2048), TenantId=['Globex'])
+        self.assertEqual(self.tenant({'Authorization': f"Bearer {forged}", 'NGSILD-Tenant': 'globex'}), 'other')
+
+    def test_rejections_are_labelled_with_known_tenants_only(self):
+        self.admission.admission_controller.apply({'tenant': {'rate': 0.001, 'burst': 1}})
+        client = backend.app.test_client()
+        for tenant in ('unknown-a', 'unknown-b'):
+            client.get('/api/ngsi-ld/v1/entities/urn:x', headers={'NGSILD-Tenant': tenant})
+        response = client.get('/api/ngsi-ld/v1/entities/urn:x', headers={'NGSILD-Tenant': 'unknown-c'})
+        self.assertEqual(response.status_code, 429)
+
+        text = client.get('/metrics').get_data(as_text=True)
+        rejected = [line for line in text.splitlines() if line.startswith('explorer_admission_rejected_total{')]
+        self.assertTrue(rejected)
+        self.assertTrue(all('tenant="other"' in line for line in rejected if 'scope="tenant"' in line))
+        self.assertNotIn('unknown-', text)
+
+
+
+class OIDCDiscovery(BaseHTTPRequestHandler):
+    """Keycloak discovery document answered after `delay` seconds, or a 500 when `fail` is set"""
+
+    protocol_version = 'HTTP/1.1'
+    delay = 0
+    fail = False
+
+    def do_GET(self):
+        time.sleep(OIDCDiscovery.delay)
+        status = 500 if OIDCDiscovery.fail else 200
+        body = json.dumps({} if OIDCDiscovery.fail else {
+            'authorization_endpoint': 'http://keycloak.discovered/auth',
+            'token_endpoint': 'http://keycloak.discovered/token',
+            'end_session_endpoint': 'http://keycloak.discovered/logout',
+            'issuer': ISSUER
+        }).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DiscoveryTests(unittest.TestCase):
+    def setUp(self):
+        import keycloak_auth
+        self.keycloak_auth = keycloak_auth
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), OIDCDiscovery)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/realms/sr/.well-known/openid-configuration"
+        OIDCDiscovery.delay, OIDCDiscovery.fail = 0, False
+        self.keycloak = keycloak_auth.KeycloakAuth()
+        self.configured = self.keycloak.auth_url
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_discovery_does_not_block_startup(self):
+        OIDCDiscovery.delay = 0.5
+        started = time.monotonic()
+        self.keycloak.preload(self.url)
+        self.assertLess(time.monotonic() - started, 0.3)
+        self.assertEqual(self.keycloak.auth_url, self.configured)
+
+        self.assertTrue(self.keycloak.login_url('s').startswith('http://keycloak.discovered/auth?'))
+        self.assertEqual(self.keycloak.logout_url, 'http://keycloak.discovered/logout')
+
+    def test_failed_discovery_keeps_the_configured_endpoints(self):
+        OIDCDiscovery.fail = True
+        self.keycloak.preload(self.url)
+        self.keycloak.ensure_discovered()
+        self.assertEqual(self.keycloak.auth_url, self.configured)
+        self.assertTrue(self.keycloak.login_url('s').startswith(self.configured))
+
+    def test_discovery_unfinished_at_fork_is_restarted(self):
+        self.keycloak._discovery_pid = -1
+        self.keycloak.preload(self.url)
+        self.keycloak.ensure_discovered()
+        self.assertEqual(self.keycloak.token_url, 'http://keycloak.discovered/token')
+
+
+class JWKSTests(unittest.TestCase):
+    def setUp(self):
+        import keycloak_auth
+        self.keycloak_auth = keycloak_auth
+        self.cache = keycloak_auth.JWKSCache(f"{BROKER_URL}/jwks")
+        FakeBroker.jwks_fetches = 0
+
+    def tearDown(self):
+        FakeBroker.jwks_delay = 0
+
+    def concurrently(self, count):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get_signing_key('test')))
+                   for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_stale_keys_are_served_while_one_fetch_refreshes_them(self):
+        self.assertIsNotNone(self.cache.get_signing_key('test'))
+        self.cache._fetched_at -= self.keycloak_auth.JWKS_REFRESH_SECONDS + 1
+        self.cache._attempted_at -= self.keycloak_auth.JWKS_MIN_REFETCH_SECONDS + 1
+        FakeBroker.jwks_delay = 1
+
+        started = time.monotonic()
+        threads, results = self.concurrently(8)
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(key is not None for key in results))
+
+        # The refresh still completes in the background, once
+        deadline = time.monotonic() + 5
+        while self.cache._fetching is not None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(FakeBroker.jwks_fetches, 2)
+        self.assertLess(time.monotonic() - self.cache._fetched_at, self.keycloak_auth.JWKS_REFRESH_SECONDS)
+
+    def test_first_use_waits_for_a_single_fetch(self):
+        FakeBroker.jwks_delay = 0.3
+        threads, results = self.concurrently(8)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(FakeBroker.jwks_fetches, 1)
+        self.assertTrue(all(key is not None for key in results))
+
+
+
+class NotificationStreamTests(unittest.TestCase):
+    def setUp(self):
+        self.client = backend.app.test_client()
+        self.slots, backend.sse_slots = backend.sse_slots, threading.BoundedSemaphore(1)
+        # The test client reads the first frame; make it a prompt keepalive
+        self.keepalive, backend.NOTIFICATION_KEEPALIVE_SECONDS = backend.NOTIFICATION_KEEPALIVE_SECONDS, 0.01
+
+    def tearDown(self):
+        backend.sse_slots = self.slots
+        backend.NOTIFICATION_KEEPALIVE_SECONDS = self.keepalive
+
+    def test_streams_over_the_cap_are_refused(self):
+        first = self.client.get('/api/notifications/stream', buffered=False)
+        self.assertEqual(first.status_code, 200)
+
+        refused = self.client.get('/api/notifications/stream', buffered=False)
+        self.assertEqual(refused.status_code, 503)
+        self.assertEqual(refused.headers['Retry-After'], str(backend.SSE_RETRY_AFTER_SECONDS))
+
+        # Closing a stream frees its slot
+        first.close()
+        second = self.client.get('/api/notifications/stream', buffered=False)
+        self.assertEqual(second.status_code, 200)
+        second.close()
+
+    def test_failed_subscription_frees_its_slot(self):
+        FakeBroker.accepted_tokens = set()
+        try:
+            response = self.client.get('/api/notifications/stream?type=Forbidden')
+            self.assertEqual(response.status_code, 401)
+        finally:
+            FakeBroker.accepted_tokens = None
+        response = self.client.get('/api/notifications/stream', buffered=False)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+
+
+class UpstreamGuardTests(unittest.TestCase):
+    def setUp(self):
+        import requests
+        import resilience
+        self.requests = requests
+        self.resilience = resilience
+        self.guard = resilience.UpstreamGuard('test', max_concurrency=1, failure_threshold=2, reset_seconds=0.05)
+        self.wait, resilience.UPSTREAM_BULKHEAD_WAIT_SECONDS = resilience.UPSTREAM_BULKHEAD_WAIT_SECONDS, 0.05
+
+    def tearDown(self):
+        self.resilience.UPSTREAM_BULKHEAD_WAIT_SECONDS = self.wait
+
+    def call(self, status=200, error=None):
+        with self.guard.call() as outcome:
+            if error:
+                raise error
+            outcome.record_status(status)
+
+    def test_opens_after_consecutive_failures_only(self):
+        self.call(503)
+        self.call(200)
+        self.call(502)
+        self.assertEqual(self.guard.state, self.resilience.CLOSED)
+        with self.assertRaises(self.resilience.UpstreamUnavailable):
+            self.call(error=self.requests.exceptions.ReadTimeout('slow'))
+        self.assertEqual(self.guard.state, self.resilience.OPEN)
+        self.assertEqual((self.guard.failures, self.guard.timeouts, self.guard.opened), (3, 1, 1))
+
+        with self.assertRaises(self.resilience.UpstreamUnavailable) as raised:
+            self.call()
+        self.assertEqual(raised.exception.upstream, 'test')
+        self.assertEqual(self.guard.short_circuited, 1)
+        self.assertEqual(self.guard.calls, 4)
+
+    def test_half_open_trial_closes_or_reopens(self):
+        self.call(503)
+        self.call(503)
+        time.sleep(0.06)
+        self.call(504)
+        self.assertEqual(self.guard.state, self.resilience.OPEN)
+        self.assertEqual(self.guard.opened, 2)
+
+        time.sleep(0.06)
+        self.call(404)
+        self.assertEqual(self.guard.state, self.resilience.CLOSED)
+        self.assertEqual(self.guard.consecutive_failures, 0)
+
+    def test_failed_trial_for_other_reasons_leaves_the_circuit_open(self):
+        self.call(503)
+        self.call(503)
+        time.sleep(0.06)
+        with self.assertRaises(ValueError):
+            self.call(error=ValueError('too large'))
+        self.assertEqual(self.guard.state, self.resilience.OPEN)
+        self.assertEqual(self.guard.failures, 2)
+        self.call(200)
+        self.assertEqual(self.guard.state, self.resilience.CLOSED)
+
+    def test_bulkhead_rejects_calls_over_its_limit(self):
+        entered, release = threading.Event(), threading.Event()
+
+        def hold():
+            with self.guard.call() as outcome:
+                entered.set()
+                release.wait(5)
+                outcome.record_status(200)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        entered.wait(5)
+        try:
+            with self.assertRaises(self.resilience.UpstreamUnavailable):
+                self.call()
+            self.assertEqual(self.guard.stats()['in_flight'], 1)
+        finally:
+            release.set()
+            holder.join()
+        self.call()
+        self.assertEqual(self.guard.stats()['rejected'], 1)
+        self.assertEqual(self.guard.stats()['calls'], 2)
+        self.assertEqual(self.guard.state, self.resilience.CLOSED)
+
+
+class SlowQuantumLeap(BaseHTTPRequestHandler):
+    """QuantumLeap answering every attribute history after `delay` seconds"""
+
+    protocol_version = 'HTTP/1.1'
+    delay = 0.5
+
+    def do_GET(self):
+        time.sleep(SlowQuantumLeap.delay)
+        body = json.dumps({'index': ['2024-01-01T00:00:00.000+00:00'], 'values': [1]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FanOutTests(unittest.TestCase):
+    def setUp(self):
+        import resilience
+        self.resilience = resilience
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SlowQuantumLeap)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url, os.environ['QUANTUM_LEAP_URL'] = os.environ['QUANTUM_LEAP_URL'], f"http://127.0.0.1:{self.server.server_port}"
+        self.wait, resilience.UPSTREAM_BULKHEAD_WAIT_SECONDS = resilience.UPSTREAM_BULKHEAD_WAIT_SECONDS, 0.1
+
+    def tearDown(self):
+        self.resilience.UPSTREAM_BULKHEAD_WAIT_SECONDS = self.wait
+        os.environ['QUANTUM_LEAP_URL'] = self.url
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pools_fit_their_bulkheads(self):
+        import endpoints
+        self.assertLessEqual(endpoints.quantum_lead_executor._max_workers,
+                             self.resilience.get_guard('quantumleap').max_concurrency)
+        self.assertLessEqual(endpoints.ngsi_ld_executor._max_workers,
+                             self.resilience.get_guard('orion-ld').max_concurrency)
+
+    def test_slow_history_fan_out_is_not_rejected_as_busy(self):
+        guard = self.resilience.get_guard('quantumleap')
+        rejected = guard.rejected
+        ids = ','.join(f"urn:ngsi-ld:Sensor:{index}" for index in range(2 * guard.max_concurrency))
+        response = backend.app.test_client().get(f"/api/quantum/v2/history?id={ids}&attrs=temperature")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['errors'], [])
+        self.assertEqual(guard.rejected, rejected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import timeseries
+import upstream
+from keycloak_auth import get_keycloak_auth
+from response_cache import TENANT_HEADERS
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+# Number of aggregation buckets per tile when a resolution is requested
+TILE_BUCKETS = int(os.environ.get('TILE_BUCKETS', '1000'))
+# Time span (s) of a raw (resolution=0) tile
+TILE_RAW_SPAN_SECONDS = int(os.environ.get('TILE_RAW_SPAN_SECONDS', '3600'))
+# A tile is closed (immutable) once its end is older than this grace period (s) for late-arriving data
+TILE_CLOSE_GRACE_SECONDS = int(os.environ.get('TILE_CLOSE_GRACE_SECONDS', '3600'))
+# How long (s) the open "live" tile may be served before it is refetched
+TILE_LIVE_TTL_SECONDS = int(os.environ.get('TILE_LIVE_TTL_SECONDS', '5'))
+# How long (s) a tile that has ended but is still within the grace period may be served before it is refetched
+TILE_RECENT_TTL_SECONDS = int(os.environ.get('TILE_RECENT_TTL_SECONDS', '60'))
+# How long (s) a closed tile without samples may be served before it is refetched; empty tiles are never persisted
+TILE_EMPTY_TTL_SECONDS = int(os.environ.get('TILE_EMPTY_TTL_SECONDS', '3600'))
+# Maximum number of tiles kept in memory
+TILE_CACHE_MAX_TILES = int(os.environ.get('TILE_CACHE_MAX_TILES', '4096'))
+# Optional directory where closed tiles are persisted as .npz files
+TILE_CACHE_DIR = os.environ.get('TILE_CACHE_DIR', '')
+# Page size used when reading a tile from QuantumLeap
+TILE_FETCH_PAGE_SIZE = int(os.environ.get('TILE_FETCH_PAGE_SIZE', '10000'))
+
+
+class Tile:
+    """Columnar storage of one time bucket: epoch-ms times and float64 values"""
+
+    __slots__ = ('times', 'values', 'closed', 'ttl', 'fetched_at')
+
+    def __init__(self, times, values, closed, ttl=TILE_LIVE_TTL_SECONDS):
+        # Only closed tiles with samples are immutable; a closed empty tile may still be backfilled
+        self.times = times
+        self.values = values
+        self.closed = closed and times.size > 0
+        self.ttl = TILE_EMPTY_TTL_SECONDS if closed and not self.closed else ttl
+        self.fetched_at = time.monotonic()
+
+    def is_fresh(self):
+        return self.closed or time.monotonic() - self.fetched_at < self.ttl
+
+
+def auth_scope(headers):
+    """
+    The caller a tile is read for. QuantumLeap (or the PEP in front of it) authorizes each read
+    by its bearer token, so tiles are only shared between requests of the same token subject;
+    a token that cannot be validated here only shares tiles with itself.
+    """
+    authorization = headers.get('Authorization')
+    if not authorization:
+        return ''
+    _, _, token = authorization.partition(' ')
+    try:
+        claims = get_keycloak_auth().validate_token(token)
+    except Exception:
+        claims = {}
+    if claims.get('active') and claims.get('sub'):
+        return f"sub:{claims['sub']}"
+    return 'token:' + hashlib.sha1(authorization.encode('utf-8')).hexdigest()[:16]
+
+
+class TileCache:
+    """
+    Cache of QuantumLeap history split into fixed time tiles per
+    (tenant, caller, entity, attribute, resolution, tile index). Closed tiles
+    with samples are immutable and kept forever (on disk when TILE_CACHE_DIR is
+    set); the live tile, tiles within the close grace period and empty tiles
+    are refetched once their TTL expires.
+    """
+
+    def __init__(self, max_tiles=TILE_CACHE_MAX_TILES, tile_dir=TILE_CACHE_DIR):
+        self.max_tiles = max_tiles
+        self.tile_dir = tile_dir
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.errors_served_stale = 0
+        if tile_dir:
+            os.makedirs(tile_dir, exist_ok=True)
+
+    @staticmethod
+    def tile_span_ms(resolution):
+        """Return the time span of a tile in milliseconds for a resolution in seconds"""
+        if resolution > 0:
+            return resolution * 1000 * TILE_BUCKETS
+        return TILE_RAW_SPAN_SECONDS * 1000
+
+    def get_range(self, base_url, entity_id, attr_name, headers, start, end, resolution=0):
+        """Return (times, values, fetched_tiles, cached_tiles) for [start, end] in epoch ms"""
+        span = self.tile_span_ms(resolution)
+        scope = tuple((headers.get(name) or '').lower() for name in TENANT_HEADERS) + (auth_scope(headers),)
+        times, values = [], []
+        fetched = cached = 0
+
+        for tile_index in range(start // span, end // span + 1):
+            key = scope + (entity_id, attr_name, resolution, tile_index)
+            tile = self._get(key)
+            if tile is None or not tile.is_fresh():
+                try:
+                    refreshed = self._fetch(base_url, entity_id, attr_name, headers, tile_index * span, span, resolution)
+                except Exception as e:
+                    if tile is None:
+                        raise
+                    # Keep serving the last copy of the tile while QuantumLeap is unavailable
+                    self.errors_served_stale += 1
+                    logger.warning("Serving stale tile: %s", e)
+                    cached += 1
+                else:
+                    tile = refreshed
+                    self._put(key, tile)
+                    fetched += 1
+            else:
+                cached += 1
+            times.append(tile.times)
+            values.append(tile.values)
+
+        times = np.concatenate(times) if times else np.empty(0, dtype=np.int64)
+        values = np.concatenate(values) if values else np.empty(0, dtype=np.float64)
+        mask = (times >= start) & (times <= end)
+        return times[mask], values[mask], fetched, cached
+
+    def _get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+
+        tile = self._load(key)
+        if tile is not None:
+            self.disk_hits += 1
+            self._put(key, tile, persist=False)
+        else:
+            self.misses += 1
+        return tile
+
+    def _put(self, key, tile, persist=True):
+        with self._lock:
+            self._tiles[key] = tile
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        if persist and tile.closed:
+            self._store(key, tile)
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.tile_dir, f"{digest}.npz")
+
+    def _load(self, key):
+        if not self.tile_dir:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                tile = Tile(data['times'], data['values'], closed=True)
+            # Empty tiles persisted by earlier versions are revalidated, not trusted
+            return tile if tile.closed else None
+        except Exception as e:
+            logger.warning(f"Could not read tile {path}: {str(e)}")
+            return None
+
+    def _store(self, key, tile):
+        if not self.tile_dir:
+            return
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp.npz"
+        try:
+            np.savez(temp_path, times=tile.times, values=tile.values)
+            os.replace(temp_path, path)
+        except Exception as e:
+            logger.warning(f"Could not persist tile {path}: {str(e)}")
+
+    def _fetch(self, base_url, entity_id, attr_name, headers, tile_start, span, resolution):
+        """Read one tile from QuantumLeap, page by page, and aggregate it to the tile resolution"""
+        tile_end = tile_start + span - 1
+        now = time.time() * 1000
+        closed = tile_start + span <= now - TILE_CLOSE_GRACE_SECONDS * 1000
+        ttl = TILE_LIVE_TTL_SECONDS if tile_start + span > now else TILE_RECENT_TTL_SECONDS
+        target_url = f"{base_url}/v2/entities/{entity_id}/attrs/{attr_name}"
+        from_date, to_date = timeseries.format_index([tile_start, tile_end])
+        times, values = [], []
+        offset = 0
+
+        while True:
+            params = {'fromDate': from_date, 'toDate': to_date, 'limit': TILE_FETCH_PAGE_SIZE, 'offset': offset}
+            response = upstream.get(target_url, headers=headers, params=params)
+            if response.status_code == 404:
+                break
+            if response.status_code != 200:
+                raise RuntimeError(f"QuantumLeap returned {response.status_code} for tile starting at {from_date}")
+            data = response.json()
+            index = data.get('index', [])
+            times.append(timeseries.parse_index(index))
+            values.append(timeseries.to_float(data.get('values', [])))
+            if len(index) < TILE_FETCH_PAGE_SIZE:
+                break
+            offset += len(index)
+
+        times = np.concatenate(times) if times else np.empty(0, dtype=np.int64)
+        values = np.concatenate(values) if values else np.empty(0, dtype=np.float64)
+        times, values = timeseries.prepare_series(times, values)
+        if resolution > 0 and times.size:
+            times, values, _, _, _ = timeseries.bucket_aggregate(times, values, TILE_BUCKETS, tile_start, tile_end)
+        return Tile(times, values, closed, ttl)
+
+    def stats(self):
+        """Return hit/miss counters for monitoring"""
+        return {'tiles': len(self._tiles), 'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'errors_served_stale': self.errors_served_stale}
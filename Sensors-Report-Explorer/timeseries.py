@@ -0,0 +1,122 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+DOWNSAMPLE_METHODS = ('lttb', 'avg', 'minmax')
+
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp into epoch milliseconds (naive timestamps are UTC)"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def parse_index(index):
+    """Convert a QuantumLeap index (list of ISO timestamps) into an int64 array of epoch milliseconds"""
+    return np.fromiter((parse_timestamp(value) for value in index), dtype=np.int64, count=len(index))
+
+
+def format_index(times):
+    """Convert epoch milliseconds back into ISO 8601 UTC timestamps"""
+    return np.datetime_as_string(np.asarray(times, dtype='datetime64[ms]'), unit='ms', timezone='UTC').tolist()
+
+
+def to_float(values):
+    """
+    Convert attribute values into a float64 array with NaN for missing values.
+    Raises ValueError when the values are not numeric.
+    """
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError("Attribute values are not numeric")
+
+
+def prepare_series(times, values):
+    """Drop NaN samples and sort by time"""
+    mask = ~np.isnan(values)
+    times, values = times[mask], values[mask]
+    if times.size > 1 and np.any(np.diff(times) < 0):
+        order = np.argsort(times, kind='stable')
+        times, values = times[order], values[order]
+    return times, values
+
+
+def bucket_aggregate(times, values, buckets, start=None, end=None):
+    """
+    Aggregate a sorted series into fixed-width time buckets.
+    Returns (bucket_start_times, avg, min, max, count) for the non-empty buckets.
+    """
+    start = times[0] if start is None else start
+    end = times[-1] if end is None else end
+    width = max((end - start + 1) / buckets, 1)
+    bucket_ids = np.clip(((times - start) // width).astype(np.int64), 0, buckets - 1)
+
+    # Times are sorted, so every bucket is a contiguous run and reduceat can work on segments
+    boundaries = np.flatnonzero(np.diff(bucket_ids)) + 1
+    segment_starts = np.concatenate(([0], boundaries))
+    counts = np.diff(np.concatenate((segment_starts, [times.size])))
+    sums = np.add.reduceat(values, segment_starts)
+    minimums = np.minimum.reduceat(values, segment_starts)
+    maximums = np.maximum.reduceat(values, segment_starts)
+    bucket_times = (start + bucket_ids[segment_starts] * width).astype(np.int64)
+    return bucket_times, sums / counts, minimums, maximums, counts
+
+
+def lttb(times, values, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Returns the indices of the selected points.
+    The per-bucket triangle areas are computed with NumPy; only the bucket walk is sequential.
+    """
+    size = times.size
+    if threshold >= size:
+        return np.arange(size)
+    if threshold < 3:
+        # Too few points for a middle bucket: keep the first (and last) point
+        return np.array([0, size - 1][:max(threshold, 1)], dtype=np.int64)
+
+    x = times.astype(np.float64)
+    edges = np.floor(np.linspace(1, size - 1, threshold - 1)).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = size - 1
+    previous = 0
+
+    for bucket in range(threshold - 2):
+        low, high = edges[bucket], edges[bucket + 1]
+        next_low = high
+        next_high = edges[bucket + 2] if bucket + 2 < len(edges) else size
+        average_x = x[next_low:next_high].mean()
+        average_y = values[next_low:next_high].mean()
+
+        areas = np.abs(
+            (x[previous] - average_x) * (values[low:high] - values[previous])
+            - (x[previous] - x[low:high]) * (average_y - values[previous])
+        )
+        previous = low + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+
+    return selected
+
+
+def downsample(times, values, buckets, method='lttb', start=None, end=None):
+    """
+    Downsample a series to roughly `buckets` points.
+    Returns a dict with 'index' and 'values', plus 'min'/'max' for the minmax method.
+    """
+    times, values = prepare_series(times, values)
+    if times.size == 0:
+        return {'index': [], 'values': []}
+
+    if method == 'lttb':
+        selected = lttb(times, values, buckets)
+        return {'index': format_index(times[selected]), 'values': values[selected].tolist()}
+
+    bucket_times, averages, minimums, maximums, _ = bucket_aggregate(times, values, buckets, start, end)
+    result = {'index': format_index(bucket_times), 'values': averages.tolist()}
+    if method == 'minmax':
+        result['min'] = minimums.tolist()
+        result['max'] = maximums.tolist()
+    return result
@@ -0,0 +1,250 @@
+import logging
+import os
+import secrets
+import threading
+import time
+
+from flask import session, has_request_context
+
+from keycloak_auth import get_keycloak_auth
+from session_store import get_session_store, SESSION_TTL_SECONDS
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+# Refresh access tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get('TOKEN_REFRESH_MARGIN_SECONDS', '60'))
+# How often the background worker looks for sessions to refresh
+TOKEN_REFRESH_CHECK_SECONDS = int(os.environ.get('TOKEN_REFRESH_CHECK_SECONDS', '15'))
+# Sessions not used for this long are no longer refreshed and are forgotten
+TOKEN_REFRESH_IDLE_SECONDS = int(os.environ.get('TOKEN_REFRESH_IDLE_SECONDS', '1800'))
+# Longest a process holds a session's refresh lock in the session store; others wait for its result meanwhile
+TOKEN_REFRESH_LOCK_SECONDS = int(os.environ.get('TOKEN_REFRESH_LOCK_SECONDS', '30'))
+TOKEN_REFRESH_POLL_SECONDS = 0.1
+
+
+class SessionTokens:
+    """Tokens of one Explorer session and their expiry times (epoch seconds)"""
+
+    __slots__ = ('access_token', 'refresh_token', 'expires_at', 'refresh_expires_at', 'last_used')
+
+    def __init__(self, token_response):
+        self.last_used = time.time()
+        self.update(token_response)
+
+    def update(self, token_response):
+        now = time.time()
+        self.access_token = token_response.get('access_token')
+        self.refresh_token = token_response.get('refresh_token') or getattr(self, 'refresh_token', None)
+        self.expires_at = now + int(token_response.get('expires_in') or 0)
+        refresh_expires_in = token_response.get('refresh_expires_in')
+        self.refresh_expires_at = now + int(refresh_expires_in) if refresh_expires_in else None
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def adopt(self, data):
+        """Take over tokens another process stored when they are newer than these; returns True if so"""
+        if not data or (data.get('expires_at') or 0) <= (self.expires_at or 0):
+            return False
+        for name in ('access_token', 'refresh_token', 'expires_at', 'refresh_expires_at'):
+            setattr(self, name, data.get(name))
+        return True
+
+    @classmethod
+    def from_dict(cls, data):
+        tokens = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(tokens, name, data.get(name))
+        tokens.last_used = time.time()
+        return tokens
+
+    def needs_refresh(self, now):
+        return self.expires_at - now <= TOKEN_REFRESH_MARGIN_SECONDS
+
+    def is_dead(self, now):
+        if now - self.last_used > TOKEN_REFRESH_IDLE_SECONDS:
+            return True
+        return self.refresh_expires_at is not None and self.refresh_expires_at <= now
+
+
+class TokenManager:
+    """
+    Tracks the tokens of every logged-in session and refreshes them before they expire
+    in a background worker. Concurrent refreshes of the same session share one request.
+    Token state is persisted in the session store so other workers and replicas can pick
+    it up; a lock in the store lets one process at a time refresh a session, and the
+    others take over its result, since Keycloak rotates refresh tokens on every use.
+    """
+
+    def __init__(self, keycloak, store=None):
+        self.keycloak = keycloak
+        self.store = store
+        self._sessions = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._worker = None
+        self._worker_pid = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.adopted = 0
+
+    def register(self, token_response, sid=None):
+        """Start tracking the tokens of a session and return its session id"""
+        sid = sid or secrets.token_urlsafe(24)
+        tokens = SessionTokens(token_response)
+        with self._lock:
+            self._sessions[sid] = tokens
+        self._persist(sid, tokens)
+        self.start()
+        return sid
+
+    def remove(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+        if self.store is not None:
+            self.store.delete(f"tokens:{sid}")
+
+    def _persist(self, sid, tokens):
+        if self.store is not None:
+            self.store.set(f"tokens:{sid}", tokens.to_dict(), SESSION_TTL_SECONDS)
+
+    def _load(self, sid):
+        return self.store.get(f"tokens:{sid}") if self.store is not None else None
+
+    def _get(self, sid):
+        """Return the tokens of a session, loading them from the session store when another process created them"""
+        with self._lock:
+            tokens = self._sessions.get(sid)
+        if tokens is None and self.store is not None:
+            data = self._load(sid)
+            if data is not None:
+                tokens = SessionTokens.from_dict(data)
+                with self._lock:
+                    tokens = self._sessions.setdefault(sid, tokens)
+                self.start()
+        return tokens
+
+    def refresh(self, sid):
+        """Refresh the tokens of a session; returns a Future shared by concurrent callers, or None"""
+        tokens = self._get(sid)
+        with self._lock:
+            future = self._in_flight.get(sid)
+            if future is not None:
+                return future
+            if tokens is None or not tokens.refresh_token:
+                return None
+            future = self._in_flight[sid] = self.keycloak.executor.submit(self._refresh, sid, tokens)
+            return future
+
+    def _adopt(self, sid, tokens):
+        """Take over tokens another process refreshed meanwhile; True when that makes this refresh unnecessary"""
+        if not tokens.adopt(self._load(sid)):
+            return False
+        self.adopted += 1
+        return not tokens.needs_refresh(time.time())
+
+    def _refresh(self, sid, tokens):
+        try:
+            if self.store is None:
+                tokens.update(self.keycloak.refresh(tokens.refresh_token))
+                self.refreshes += 1
+                return tokens.access_token
+
+            # The refresh token held here may already have been used (and rotated) by another process
+            lock = f"tokens-refresh:{sid}"
+            deadline = time.monotonic() + TOKEN_REFRESH_LOCK_SECONDS
+            while not self._adopt(sid, tokens):
+                if self.store.add(lock, {'pid': os.getpid()}, TOKEN_REFRESH_LOCK_SECONDS):
+                    try:
+                        if not self._adopt(sid, tokens):
+                            tokens.update(self.keycloak.refresh(tokens.refresh_token))
+                            self._persist(sid, tokens)
+                            self.refreshes += 1
+                    finally:
+                        self.store.delete(lock)
+                    break
+                if time.monotonic() >= deadline:
+                    raise TimeoutError("another process did not finish refreshing the session in time")
+                time.sleep(TOKEN_REFRESH_POLL_SECONDS)
+            return tokens.access_token
+        except Exception as e:
+            self.refresh_failures += 1
+            logger.warning(f"Token refresh failed for a session: {str(e)}")
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(sid, None)
+
+    def get_access_token(self, sid):
+        """Return a fresh access token for the session, refreshing it first when it is about to expire"""
+        tokens = self._get(sid)
+        if tokens is None:
+            return None
+        tokens.last_used = now = time.time()
+        if tokens.needs_refresh(now):
+            future = self.refresh(sid)
+            if future is not None:
+                try:
+                    future.result()
+                except Exception:
+                    pass
+            if tokens.expires_at <= time.time():
+                return None
+        return tokens.access_token
+
+    def current_access_token(self):
+        """Return the fresh access token of the session bound to the current request, if any"""
+        if not has_request_context():
+            return None
+        sid = session.get('sid')
+        return self.get_access_token(sid) if sid else None
+
+    def start(self):
+        """Start the background refresh worker in this process (after a fork it is started again)"""
+        if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name='token-refresh', daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            time.sleep(TOKEN_REFRESH_CHECK_SECONDS)
+            try:
+                self.refresh_expiring()
+            except Exception as e:
+                logger.error(f"Token refresh worker error: {str(e)}")
+
+    def refresh_expiring(self):
+        """Refresh every active session that is close to expiry and forget dead ones"""
+        now = time.time()
+        with self._lock:
+            dead = [sid for sid, tokens in self._sessions.items() if tokens.is_dead(now)]
+            for sid in dead:
+                del self._sessions[sid]
+            expiring = [sid for sid, tokens in self._sessions.items() if tokens.needs_refresh(now)]
+        for sid in expiring:
+            self.refresh(sid)
+        if dead or expiring:
+            logger.debug("Token refresh worker: %s refreshing, %s expired sessions dropped", len(expiring), len(dead))
+
+    def stats(self):
+        return {'sessions': len(self._sessions), 'refreshes': self.refreshes, 'refresh_failures': self.refresh_failures,
+                'adopted': self.adopted}
+
+
+_token_manager = None
+_token_manager_lock = threading.Lock()
+
+def get_token_manager():
+    """Return the process-wide TokenManager"""
+    global _token_manager
+    if _token_manager is None:
+        with _token_manager_lock:
+            if _token_manager is None:
+                _token_manager = TokenManager(get_keycloak_auth(), get_session_store())
+    return _token_manager
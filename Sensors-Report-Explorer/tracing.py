@@ -0,0 +1,252 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+import requests
+from flask import request, g
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'false').lower() in ('true', 't', '1', 'yes')
+# Fraction of new traces that are recorded; requests with a traceparent follow its sampled flag
+TRACE_SAMPLE_RATIO = float(os.environ.get('TRACE_SAMPLE_RATIO', '0.01'))
+# file: JSON lines in TRACE_FILE | otlp: OTLP/HTTP JSON to TRACE_COLLECTOR_URL
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'file').lower()
+TRACE_FILE = os.environ.get('TRACE_FILE', '/tmp/explorer-spans.jsonl')
+TRACE_COLLECTOR_URL = os.environ.get('TRACE_COLLECTOR_URL', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'sr-explorer')
+TRACE_EXPORT_INTERVAL_SECONDS = float(os.environ.get('TRACE_EXPORT_INTERVAL_SECONDS', '2'))
+TRACE_EXPORT_BATCH_SIZE = int(os.environ.get('TRACE_EXPORT_BATCH_SIZE', '512'))
+# Spans beyond this backlog are dropped rather than slowing requests down
+TRACE_QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', '8192'))
+
+TRACEPARENT_PATTERN = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """A timed operation of a trace; only sampled spans are exported"""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'sampled', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, trace_id, parent_id, name, kind, sampled):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = {}
+        self.error = None
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self):
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start': self.start_ns,
+            'end': self.end_ns,
+            'durationMs': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+            'service': TRACE_SERVICE_NAME
+        }
+
+
+def parse_traceparent(header):
+    """Return (trace_id, parent_span_id, sampled) from a W3C traceparent header, or None"""
+    match = TRACEPARENT_PATTERN.match((header or '').strip().lower())
+    if not match or match.group(1) == '0' * 32 or match.group(2) == '0' * 16:
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def wrap(fn):
+    """Run fn in a copy of the caller's context so pool threads keep the current trace"""
+    if not TRACING_ENABLED:
+        return fn
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def start_client_span(method, url, headers):
+    """
+    Start a span for an upstream call and return (span, headers) where headers carry the
+    traceparent. Returns (None, headers) untouched when there is no current trace.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return None, headers
+    span = Span(parent.trace_id, parent.span_id, f"{method} {url.split('?', 1)[0]}", 'client', parent.sampled)
+    span.attributes['http.method'] = method
+    span.attributes['http.url'] = url
+    headers = dict(headers or {})
+    headers['traceparent'] = span.traceparent()
+    return span, headers
+
+
+def end_span(span, status_code=None, error=None):
+    if span is None:
+        return
+    span.end_ns = time.time_ns()
+    if status_code is not None:
+        span.attributes['http.status_code'] = status_code
+    if error is not None:
+        span.error = f"{type(error).__name__}: {error}"
+    if span.sampled:
+        exporter.export(span)
+
+
+class SpanExporter:
+    """Hands sampled spans to a background thread that writes them in batches"""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self._worker = None
+        self._worker_pid = None
+        self._lock = threading.Lock()
+        self._session = None
+        self.exported = 0
+        self.dropped = 0
+
+    def export(self, span):
+        if self._worker_pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        # Also (re)started after a fork, since threads do not survive it
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + TRACE_EXPORT_INTERVAL_SECONDS
+            while len(batch) < TRACE_EXPORT_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+                self.exported += len(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                logger.warning(f"Could not export {len(batch)} spans: {str(e)}")
+
+    def write(self, spans):
+        if TRACE_EXPORTER == 'otlp':
+            if self._session is None:
+                self._session = requests.Session()
+            self._session.post(TRACE_COLLECTOR_URL, json=otlp_payload(spans), timeout=10).raise_for_status()
+        else:
+            with open(TRACE_FILE, 'a') as f:
+                f.write(''.join(json.dumps(span.to_dict(), separators=(',', ':')) + '\n' for span in spans))
+
+    def stats(self):
+        return {'queued': self._queue.qsize(), 'exported': self.exported, 'dropped': self.dropped}
+
+
+def otlp_payload(spans):
+    """Encode spans as an OTLP/HTTP JSON ExportTraceServiceRequest"""
+    kinds = {'server': 2, 'client': 3}
+
+    def attribute(key, value):
+        if isinstance(value, bool):
+            return {'key': key, 'value': {'boolValue': value}}
+        if isinstance(value, int):
+            return {'key': key, 'value': {'intValue': str(value)}}
+        return {'key': key, 'value': {'stringValue': str(value)}}
+
+    return {'resourceSpans': [{
+        'resource': {'attributes': [attribute('service.name', TRACE_SERVICE_NAME)]},
+        'scopeSpans': [{
+            'scope': {'name': 'sr-explorer.tracing'},
+            'spans': [{
+                'traceId': span.trace_id,
+                'spanId': span.span_id,
+                'parentSpanId': span.parent_id or '',
+                'name': span.name,
+                'kind': kinds.get(span.kind, 1),
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(span.end_ns),
+                'attributes': [attribute(key, value) for key, value in span.attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.error else {'code': 1}
+            } for span in spans]
+        }]
+    }]}
+
+
+exporter = SpanExporter()
+
+
+def _before_request():
+    parent = parse_traceparent(request.headers.get('traceparent'))
+    if parent is not None:
+        trace_id, parent_id, sampled = parent
+    else:
+        trace_id, parent_id, sampled = f"{random.getrandbits(128):032x}", None, random.random() < TRACE_SAMPLE_RATIO
+    span = Span(trace_id, parent_id, f"{request.method} {request.path}", 'server', sampled)
+    span.attributes['http.method'] = request.method
+    span.attributes['http.target'] = request.full_path.rstrip('?')
+    g.trace_span = span
+    g.trace_token = _current_span.set(span)
+
+
+def _after_request(response):
+    span = g.get('trace_span')
+    if span is not None:
+        if request.url_rule is not None:
+            span.name = f"{request.method} {request.url_rule.rule}"
+            span.attributes['http.route'] = request.url_rule.rule
+        if span.sampled:
+            response.headers['X-Trace-Id'] = span.trace_id
+        end_span(span, status_code=response.status_code)
+        g.trace_span = None
+    return response
+
+
+def _teardown_request(error):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        _current_span.reset(token)
+
+
+def init_app(app):
+    """Trace incoming requests (W3C traceparent) when TRACING_ENABLED is set"""
+    if not TRACING_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    logger.info(f"Tracing enabled: sample ratio {TRACE_SAMPLE_RATIO}, exporter {TRACE_EXPORTER}")
@@ -0,0 +1,113 @@
+import logging
+import os
+import threading
+import time
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+# Largest request body relayed to the data-product manager
+DATA_PRODUCT_MAX_UPLOAD_BYTES = int(os.environ.get('DATA_PRODUCT_MAX_UPLOAD_BYTES', str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', '65536'))
+
+
+class UploadTooLarge(Exception):
+    """The request body exceeded the configured upload limit"""
+
+
+class UploadStats:
+    """Counters for relayed uploads, including the progress of the ones in flight"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = {}
+        self._next_id = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.bytes_relayed = 0
+
+    def start(self, expected):
+        with self._lock:
+            self._next_id += 1
+            self._active[self._next_id] = [0, expected, time.monotonic()]
+            return self._next_id
+
+    def progress(self, upload_id, received):
+        # Called for every chunk, so keep it to a single list update
+        self._active[upload_id][0] = received
+
+    def finish(self, upload_id, ok):
+        with self._lock:
+            received, _, started = self._active.pop(upload_id)
+            self.bytes_relayed += received
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+        return received, time.monotonic() - started
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def stats(self):
+        with self._lock:
+            active = [
+                {'received': received, 'expected': expected, 'seconds': round(time.monotonic() - started, 3)}
+                for received, expected, started in self._active.values()
+            ]
+        return {
+            'active': active,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'bytes_relayed': self.bytes_relayed + sum(upload['received'] for upload in active)
+        }
+
+
+upload_stats = UploadStats()
+
+
+class RequestBodyStream:
+    """
+    File-like view of an incoming request body that requests can send without buffering it:
+    it is read in chunks as the upstream connection consumes it, enforces the size limit and
+    reports progress. len() returns the declared Content-Length so no chunked encoding is needed.
+    """
+
+    def __init__(self, stream, content_length, limit=DATA_PRODUCT_MAX_UPLOAD_BYTES):
+        self.stream = stream
+        self.content_length = content_length
+        self.limit = limit
+        self.received = 0
+        self.upload_id = upload_stats.start(content_length)
+
+    def __len__(self):
+        return self.content_length or 0
+
+    def __bool__(self):
+        # An unknown length must not make the body look empty
+        return True
+
+    def read(self, size=UPLOAD_CHUNK_SIZE):
+        if size is None or size < 0:
+            size = UPLOAD_CHUNK_SIZE
+        chunk = self.stream.read(size)
+        self.received += len(chunk)
+        if self.received > self.limit:
+            raise UploadTooLarge(f"Upload exceeds {self.limit} bytes")
+        upload_stats.progress(self.upload_id, self.received)
+        return chunk
+
+    def __iter__(self):
+        # Used by requests for bodies of unknown length (chunked transfer encoding)
+        while True:
+            chunk = self.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def finish(self, ok):
+        received, seconds = upload_stats.finish(self.upload_id, ok)
+        logger.debug("Relayed %s bytes upstream in %.3fs", received, seconds)
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import compression
+import metrics
+import resilience
+import tracing
+
+# Initialize logging
+logger = logging.getLogger(__name__)
+
+# Connection pool size for each upstream host (Orion-LD, QuantumLeap, data-product manager)
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', '32'))
+
+# Headers that change the upstream answer and therefore belong in the single-flight key
+SINGLE_FLIGHT_HEADERS = ('NGSILD-Tenant', 'Fiware-Service', 'Fiware-ServicePath', 'Accept', 'Link')
+
+# Upstream encodings kept as-is so they can be passed through to clients that accept them
+PASSTHROUGH_ENCODINGS = ('gzip', 'deflate') + tuple(
+    encoding for encoding in compression.AVAILABLE_ENCODINGS if encoding != 'gzip')
+
+
+class UpstreamResponse:
+    """
+    A fully read upstream response that can be shared between request threads.
+    When the upstream compressed the body, the encoded bytes are kept so they can be
+    passed through to the client, and the decoded content is produced on first use.
+    """
+
+    __slots__ = ('status_code', 'headers', 'url', 'encoded_content', 'content_encoding', '_content')
+
+    def __init__(self, status_code, headers, content, url=None, content_encoding=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.url = url
+        self.content_encoding = content_encoding
+        if content_encoding:
+            self.encoded_content = content
+            self._content = None
+        else:
+            self.encoded_content = None
+            self._content = content
+
+    @classmethod
+    def from_requests(cls, response):
+        """Build from a requests response opened with stream=True, without decoding the body"""
+        try:
+            encoding = response.headers.get('Content-Encoding', '').strip().lower() or None
+            if encoding in PASSTHROUGH_ENCODINGS:
+                body = response.raw.read(decode_content=False)
+            else:
+                encoding = None
+                body = response.content
+        finally:
+            response.close()
+        return cls(response.status_code, response.headers, body, response.url, encoding)
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = compression.decode_content(self.encoded_content, self.content_encoding)
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into a single execution"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executions = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        """Run fn() once per key at a time; concurrent callers wait for and share its result"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.shared += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+            if call.waiters:
+                logger.debug("Single-flight shared upstream response with %s waiting request(s)", call.waiters)
+
+    def stats(self):
+        return {'executions': self.executions, 'shared': self.shared, 'in_flight': len(self._calls)}
+
+
+# Pooled HTTP session shared by all proxied calls
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=UPSTREAM_POOL_SIZE, pool_maxsize=UPSTREAM_POOL_SIZE)
+session.mount('http://', _adapter)
+session.mount('https://', _adapter)
+metrics.instrument_session(session)
+
+single_flight = SingleFlight()
+
+
+def single_flight_key(url, headers, params=None):
+    """Key an upstream GET on URL, query, tenant and the caller's authorization scope"""
+    headers = headers or {}
+    query = tuple(sorted(params.items())) if params else ()
+    authorization = headers.get('Authorization')
+    auth_scope = hashlib.sha1(authorization.encode('utf-8')).hexdigest() if authorization else None
+    return (url, query, auth_scope) + tuple(headers.get(name) for name in SINGLE_FLIGHT_HEADERS)
+
+
+def get(url, headers=None, params=None):
+    """
+    Perform a GET against an upstream service. Identical concurrent GETs share
+    one upstream request and its UpstreamResponse. Raises UpstreamUnavailable when the
+    upstream's circuit is open, its bulkhead is full or it does not respond in time.
+    """
+    span, traced_headers = tracing.start_client_span('GET', url, headers)
+    guard = resilience.get_guard(metrics.upstream_name(url))
+
+    def fetch():
+        with guard.call() as outcome:
+            try:
+                response = session.get(url, headers=traced_headers, params=params, stream=True, timeout=guard.timeout)
+            except Exception:
+                metrics.record_upstream_error('GET', url)
+                raise
+            outcome.record_status(response.status_code)
+            return UpstreamResponse.from_requests(response)
+
+    try:
+        response = single_flight.do(single_flight_key(url, headers, params), fetch)
+    except Exception as e:
+        tracing.end_span(span, error=e)
+        raise
+    tracing.end_span(span, status_code=response.status_code)
+    return response
+
+
+def request(method, url, **kwargs):
+    """
+    Perform a non-coalesced request against an upstream service through the pooled session,
+    guarded like get()
+    """
+    span, kwargs['headers'] = tracing.start_client_span(method, url, kwargs.get('headers'))
+    guard = resilience.get_guard(metrics.upstream_name(url))
+    kwargs.setdefault('timeout', guard.timeout)
+    try:
+        with guard.call() as outcome:
+            try:
+                response = session.request(method, url, stream=True, **kwargs)
+            except Exception:
+                metrics.record_upstream_error(method, url)
+                raise
+            outcome.record_status(response.status_code)
+            response = UpstreamResponse.from_requests(response)
+    except Exception as e:
+        tracing.end_span(span, error=e)
+        raise
+    tracing.end_span(span, status_code=response.status_code)
+    return response
@@ -0,0 +1,160 @@
+"""
+Production launcher for the Explorer backend.
+
+Runs the Flask app under gunicorn with threaded workers sized from the CPU count:
+
+    python wsgi.py
+
+The app is imported once in the master before forking (preload), so workers share its
+memory. SIGHUP reloads gracefully, SIGTERM drains in-flight requests within
+WEB_GRACEFUL_TIMEOUT. A self-check runs before the first worker starts and aborts
+startup on fatal misconfiguration.
+"""
+import importlib.util
+import logging
+import os
+import sys
+
+# Initialize logging
+logger = logging.getLogger('wsgi')
+
+BACKEND_MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend-sr-explorer.py')
+
+
+def available_cpus():
+    """CPUs this process may run on (respects container CPU sets)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+CPU_COUNT = available_cpus()
+WEB_BIND = os.environ.get('WEB_BIND', f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '5000')}")
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', str(min(2 * CPU_COUNT + 1, int(os.environ.get('WEB_MAX_WORKERS', '8'))))))
+# Each worker thread serves one request at a time; SSE streams hold a thread for their lifetime,
+# so size it as SSE_MAX_STREAMS plus the threads API requests need (see README, Production Server)
+WEB_THREADS = int(os.environ.get('WEB_THREADS', '16'))
+WEB_TIMEOUT = int(os.environ.get('WEB_TIMEOUT', '60'))
+WEB_GRACEFUL_TIMEOUT = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', '30'))
+WEB_KEEPALIVE = int(os.environ.get('WEB_KEEPALIVE', '5'))
+# Recycle workers after this many requests (0 disables) to bound memory growth
+WEB_MAX_REQUESTS = int(os.environ.get('WEB_MAX_REQUESTS', '10000'))
+WEB_MAX_REQUESTS_JITTER = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', '1000'))
+WEB_BACKLOG = int(os.environ.get('WEB_BACKLOG', '2048'))
+WEB_SELF_CHECK_STRICT = os.environ.get('WEB_SELF_CHECK_STRICT', 'true').lower() in ('true', 't', '1', 'yes')
+
+if WEB_WORKERS > 1:
+    # Workers must share sessions; the process-local memory store cannot
+    os.environ.setdefault('SESSION_BACKEND', 'sqlite')
+    # Orion-LD posts each notification to one worker; the relay hands it to the others' SSE clients
+    os.environ.setdefault('NOTIFICATION_RELAY_DIR', '/tmp/sr-explorer-relay')
+
+
+def load_backend():
+    """Import backend-sr-explorer.py (its file name is not importable with a plain import)"""
+    spec = importlib.util.spec_from_file_location('backend_sr_explorer', BACKEND_MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def self_check(backend):
+    """Return (errors, warnings) found in the loaded app and its configuration"""
+    from session_store import get_session_store, MemorySessionStore
+
+    errors, warnings = [], []
+
+    rules = {rule.rule for rule in backend.app.url_map.iter_rules()}
+    for rule in ('/health', '/api/notifications', '/api/notifications/stream', '/api/ngsi-ld/v1/entities'):
+        if rule not in rules:
+            errors.append(f"route {rule} is not registered")
+
+    store = get_session_store()
+    try:
+        store.set('self-check', {'pid': os.getpid()}, 60)
+        if store.get('self-check') != {'pid': os.getpid()}:
+            errors.append(f"{type(store).__name__} did not return the value just written")
+        store.delete('self-check')
+    except Exception as e:
+        errors.append(f"session store is not usable: {str(e)}")
+    if WEB_WORKERS > 1 and isinstance(store, MemorySessionStore):
+        errors.append("SESSION_BACKEND=memory cannot be shared by several workers; use sqlite or redis")
+
+    if backend.SECRET_KEY == 'dev-secret-key':
+        warnings.append("SECRET_KEY is the development default")
+    if backend.SSE_MAX_STREAMS >= WEB_THREADS:
+        warnings.append(f"SSE_MAX_STREAMS ({backend.SSE_MAX_STREAMS}) is not below WEB_THREADS ({WEB_THREADS}); "
+                        "open SSE streams can occupy every thread of a worker")
+    if WEB_WORKERS > 1 and not os.environ.get('NOTIFICATION_RELAY_DIR'):
+        warnings.append("NOTIFICATION_RELAY_DIR is empty; SSE clients only see notifications "
+                        "delivered to their own worker")
+    for name in ('CONTEXT_BROKER_URL', 'QUANTUM_LEAP_URL', 'DATA_PRODUCT_URL'):
+        if not getattr(backend, name, None):
+            warnings.append(f"{name} is not set")
+
+    return errors, warnings
+
+
+def post_fork(server, worker):
+    """Drop connections inherited from the master so workers never share sockets"""
+    import log_config
+    import subscription_manager
+    import upstream
+    from keycloak_auth import get_keycloak_auth
+    from session_store import get_session_store
+
+    log_config.after_fork()
+    upstream.session.close()
+    get_keycloak_auth().session.close()
+    # Finish OIDC discovery in the worker if the master had not when it forked
+    get_keycloak_auth().preload()
+    get_session_store().after_fork()
+    subscription_manager.after_fork()
+
+
+def run():
+    from gunicorn.app.base import BaseApplication
+
+    backend = load_backend()
+    errors, warnings = self_check(backend)
+    for warning in warnings:
+        logger.warning(f"Self-check: {warning}")
+    for error in errors:
+        logger.error(f"Self-check: {error}")
+    if errors and WEB_SELF_CHECK_STRICT:
+        sys.exit(1)
+
+    class ExplorerServer(BaseApplication):
+        def load_config(self):
+            settings = {
+                'bind': WEB_BIND,
+                'workers': WEB_WORKERS,
+                'worker_class': 'gthread',
+                'threads': WEB_THREADS,
+                'timeout': WEB_TIMEOUT,
+                'graceful_timeout': WEB_GRACEFUL_TIMEOUT,
+                'keepalive': WEB_KEEPALIVE,
+                'max_requests': WEB_MAX_REQUESTS,
+                'max_requests_jitter': WEB_MAX_REQUESTS_JITTER,
+                'backlog': WEB_BACKLOG,
+                'preload_app': True,
+                'post_fork': post_fork,
+                'accesslog': os.environ.get('WEB_ACCESS_LOG') or None,
+                'loglevel': os.environ.get('LOG_LEVEL', 'info').lower(),
+                'proc_name': 'sr-explorer'
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return backend.app
+
+    logger.info(f"Starting gunicorn on {WEB_BIND}: {WEB_WORKERS} workers x {WEB_THREADS} threads "
+                f"({CPU_COUNT} CPUs), timeout {WEB_TIMEOUT}s")
+    ExplorerServer().run()
+
+
+if __name__ == '__main__':
+    run()